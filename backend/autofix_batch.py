@@ -0,0 +1,264 @@
+"""
+🗂️ Batch Auto-Fix CLI
+=====================
+إعادة معالجة آلاف صور الفواتير المخزنة بعد تغيير منطق التصحيح.
+
+Features:
+- المدخلات: مجلد (بحث متكرر عن الصور)، أو glob، أو ملف manifest (مسار في كل سطر)
+- توزيع العمل على كل الأنوية (ProcessPoolExecutor) مع عدد محدود من المهام المعلّقة
+- كتابة ذرّية للمخرجات (ملف مؤقت ثم os.replace) فلا تبقى صورة نصف مكتوبة
+- قابل للاستئناف: ملف checkpoint (JSONL) يسجل كل صورة انتهت، وإعادة التشغيل تتخطاها
+- في النهاية: الإنتاجية (images/s) و p50/p95/p99 لكل مرحلة
+
+Usage:
+    python -m backend.autofix_batch receipts/ --output-dir fixed/
+    python -m backend.autofix_batch "receipts/**/*.jpg" --output-dir fixed/ --workers 8
+    python -m backend.autofix_batch manifest.txt --in-place   # JPEG inputs only
+"""
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from backend.utils_image_autofix import auto_fix_image_bytes
+
+logger = logging.getLogger("backend.autofix_batch")
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+JPEG_EXTENSIONS = {".jpg", ".jpeg"}
+DEFAULT_CHECKPOINT_NAME = ".autofix_checkpoint.jsonl"
+
+
+# ================================================================
+# 📥 Inputs
+# ================================================================
+def resolve_inputs(source: str) -> Tuple[List[Path], Path]:
+    """
+    Expand a directory, glob pattern or manifest file into image paths.
+
+    Returns:
+        (sorted paths, root) - root is used to mirror relative paths under --output-dir
+    """
+    path = Path(source)
+    if path.is_dir():
+        files = [p for p in path.rglob("*") if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS]
+        root = path
+    elif path.is_file() and path.suffix.lower() not in IMAGE_EXTENSIONS:
+        # Manifest: one path per line (blank lines and # comments ignored), relative to the manifest
+        files = []
+        for line in path.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = Path(line)
+            files.append(entry if entry.is_absolute() else path.parent / entry)
+        root = None
+    elif path.is_file():
+        files, root = [path], path.parent
+    else:
+        files = [Path(p) for p in glob.glob(source, recursive=True)
+                 if Path(p).is_file() and Path(p).suffix.lower() in IMAGE_EXTENSIONS]
+        root = None
+
+    files = sorted({p.resolve() for p in files})
+    if root is None:
+        root = Path(os.path.commonpath([str(p.parent) for p in files])) if files else Path(".")
+    return files, root.resolve()
+
+
+def is_jpeg_path(path: Path) -> bool:
+    return path.suffix.lower() in JPEG_EXTENSIONS
+
+
+def output_path_for(src: Path, root: Path, output_dir: Optional[Path]) -> Path:
+    """
+    Mirror src under output_dir (or overwrite in place). Output is always JPEG.
+    In place only works for JPEG inputs: a PNG would otherwise leave the original next to a new a.jpg.
+    """
+    if output_dir is None:
+        if not is_jpeg_path(src):
+            raise ValueError(f"--in-place only rewrites JPEG files: {src}")
+        return src
+    dst = output_dir / src.relative_to(root)
+    if not is_jpeg_path(dst):
+        dst = dst.with_suffix(".jpg")
+    return dst
+
+
+# ================================================================
+# 👷 Worker (runs in a child process)
+# ================================================================
+def _atomic_write(dst: Path, data: bytes):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, dst)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _process_one(src: str, dst: str, quality: int) -> Tuple[str, str, Dict[str, float], Optional[str]]:
+    """Returns (src, status, stage timings, error)"""
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    try:
+        t0 = time.perf_counter()
+        data = Path(src).read_bytes()
+        timings["read"] = time.perf_counter() - t0
+
+        fixed = auto_fix_image_bytes(data, quality=quality, timings=timings)
+        if fixed is None:
+            return src, "failed", timings, "auto-fix returned no image"
+
+        t0 = time.perf_counter()
+        _atomic_write(Path(dst), fixed)
+        timings["write"] = time.perf_counter() - t0
+        timings["total"] = time.perf_counter() - start
+        return src, "ok", timings, None
+    except Exception as e:
+        return src, "failed", timings, str(e)
+
+
+# ================================================================
+# 📌 Checkpoint
+# ================================================================
+def load_checkpoint(path: Path, retry_failed: bool) -> Set[str]:
+    """Paths already handled by a previous run (failed ones too, unless retry_failed)"""
+    done: Set[str] = set()
+    if not path.exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line from a killed run
+            if entry.get("status") == "ok" or not retry_failed:
+                done.add(entry["src"])
+    return done
+
+
+# ================================================================
+# 📊 Report
+# ================================================================
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def print_report(stages: Dict[str, List[float]], counts: Dict[str, int], elapsed: float):
+    processed = counts["ok"] + counts["failed"]
+    print()
+    print(f"✅ ok={counts['ok']}  ❌ failed={counts['failed']}  ⏭️ skipped={counts['skipped']}")
+    print(f"⏱️ {processed} images in {elapsed:.1f}s → {processed / elapsed if elapsed else 0:.2f} images/s")
+    if not stages:
+        return
+    print(f"{'stage':<24} | {'count':>7} | {'p50 (ms)':>9} | {'p95 (ms)':>9} | {'p99 (ms)':>9}")
+    print("-" * 70)
+    for stage, values in sorted(stages.items()):
+        ordered = sorted(values)
+        print(f"{stage:<24} | {len(ordered):>7} | {_percentile(ordered, 0.50) * 1000:>9.1f} | "
+              f"{_percentile(ordered, 0.95) * 1000:>9.1f} | {_percentile(ordered, 0.99) * 1000:>9.1f}")
+
+
+# ================================================================
+# 🚀 Main
+# ================================================================
+def run_batch(files: List[Path], root: Path, output_dir: Optional[Path], checkpoint: Path,
+              workers: int, quality: int, retry_failed: bool = False):
+    done = load_checkpoint(checkpoint, retry_failed)
+    pending = [p for p in files if str(p) not in done]
+    counts = {"ok": 0, "failed": 0, "skipped": len(files) - len(pending)}
+    stages: Dict[str, List[float]] = {}
+
+    print(f"🗂️ {len(files)} images found, {counts['skipped']} already in checkpoint, {len(pending)} to process "
+          f"with {workers} workers")
+    if not pending:
+        return counts
+
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    max_in_flight = workers * 4  # bounded: don't materialize tens of thousands of futures
+    start = time.perf_counter()
+    last_report = 0
+
+    with open(checkpoint, "a", encoding="utf-8") as ckpt, ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        queue = iter(pending)
+        in_flight = set()
+        while True:
+            for src in queue:
+                dst = output_path_for(src, root, output_dir)
+                in_flight.add(executor.submit(_process_one, str(src), str(dst), quality))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                src, status, timings, error = future.result()
+                counts[status] += 1
+                for stage, seconds in timings.items():
+                    stages.setdefault(stage, []).append(seconds)
+                ckpt.write(json.dumps({"src": src, "status": status, "error": error}, ensure_ascii=False) + "\n")
+                if error:
+                    logger.warning(f"⚠️ {src}: {error}")
+            ckpt.flush()
+
+            processed = counts["ok"] + counts["failed"]
+            if processed - last_report >= 100:
+                last_report = processed
+                rate = processed / (time.perf_counter() - start)
+                print(f"🔄 {processed}/{len(pending)} ({rate:.2f} images/s)", flush=True)
+
+    print_report(stages, counts, time.perf_counter() - start)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch auto-fix (rotation, deskew, perspective) for stored receipts")
+    parser.add_argument("source", help="directory, glob pattern (quote it) or manifest file")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--output-dir", type=Path, help="write corrected images here, mirroring the input tree")
+    target.add_argument("--in-place", action="store_true", help="overwrite the input images")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of the output")
+    parser.add_argument("--checkpoint", type=Path, default=None,
+                        help=f"resume file (default: <output-dir or root>/{DEFAULT_CHECKPOINT_NAME})")
+    parser.add_argument("--retry-failed", action="store_true", help="reprocess images that failed in a previous run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    files, root = resolve_inputs(args.source)
+    if not files:
+        print(f"❌ No images found for: {args.source}")
+        sys.exit(1)
+
+    if args.in_place:
+        not_jpeg = [p for p in files if not is_jpeg_path(p)]
+        if not_jpeg:
+            print(f"❌ --in-place only rewrites JPEG files; {len(not_jpeg)} inputs are not JPEG "
+                  f"(e.g. {not_jpeg[0]}). Use --output-dir for those.")
+            sys.exit(2)
+
+    output_dir = None if args.in_place else args.output_dir.resolve()
+    checkpoint = args.checkpoint or (output_dir or root) / DEFAULT_CHECKPOINT_NAME
+    counts = run_batch(files, root, output_dir, checkpoint, args.workers, args.quality, args.retry_failed)
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+🏭 Auto-Fix Process Pool
+========================
+تشغيل تصحيح الصور (OSD + Deskew + Perspective) في ProcessPoolExecutor
+بدلاً من تنفيذه داخل الـ event loop.
+
+ملفات PDF تُعرض وتُصحَّح وتُرمَّز داخل نفس العملية (run_pdf_autofix)،
+فلا تمر الصفحة بترميز JPEG وسيط قبل التصحيح.
+
+Features:
+- يستخدم كل الأنوية (CPU cores) بدل نواة واحدة
+- طابور محدود: عند امتلائه نرفع الصورة الأصلية بدون تصحيح (لا ننتظر)
+- مهلة لكل مهمة: عند تجاوزها نستخدم الصورة الأصلية
+- مقاييس: عمق الطابور وزمن كل مرحلة وعدد مرات اللجوء إلى OSD (GET /upload/autofix/metrics)
+
+Configuration:
+- AUTOFIX_WORKERS          (default: عدد الأنوية)
+- AUTOFIX_MAX_QUEUE        (default: AUTOFIX_WORKERS × 4)
+- AUTOFIX_TIMEOUT_SECONDS  (default 20)
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from backend.derivatives import make_derivatives_from_bytes
+from backend.utils_image_autofix import auto_fix_image_bytes
+from backend.utils_pdf import render_pdf_page_jpeg
+from backend.vlm_image_prep import PreparedImage, prepare_image_bytes
+
+logger = logging.getLogger("backend.autofix_pool")
+
+AUTOFIX_WORKERS = int(os.getenv("AUTOFIX_WORKERS", str(os.cpu_count() or 2)))
+AUTOFIX_MAX_QUEUE = int(os.getenv("AUTOFIX_MAX_QUEUE", str(AUTOFIX_WORKERS * 4)))
+AUTOFIX_TIMEOUT_SECONDS = float(os.getenv("AUTOFIX_TIMEOUT_SECONDS", "20"))
+_TIMING_WINDOW = 500  # last N samples per stage for percentiles
+
+
+# ================================================================
+# 👷 Worker (runs in a child process)
+# ================================================================
+def _autofix_worker(file_bytes: bytes) -> Tuple[Optional[bytes], Dict[str, float]]:
+    """Auto-fix one image inside a pool process, fully in memory. Returns (fixed bytes or None, stage timings)."""
+    timings: Dict[str, float] = {}
+    return auto_fix_image_bytes(file_bytes, timings=timings), timings
+
+
+def _autofix_derivatives_worker(file_bytes: bytes) -> Tuple[Optional[Tuple[bytes, Dict[str, bytes]]], Dict[str, float]]:
+    """Auto-fix one image and derive its WebP renditions from the corrected pixels in the same process."""
+    timings: Dict[str, float] = {}
+    derivatives: Dict[str, bytes] = {}
+    fixed = auto_fix_image_bytes(file_bytes, timings=timings, derivatives=derivatives)
+    return ((fixed, derivatives) if fixed is not None else None), timings
+
+
+def _derivatives_worker(image_bytes: bytes) -> Tuple[Optional[Dict[str, bytes]], Dict[str, float]]:
+    """WebP renditions of an already-final image (PDF pages, or when auto-fix was skipped)."""
+    timings: Dict[str, float] = {}
+    return (make_derivatives_from_bytes(image_bytes, timings) or None), timings
+
+
+def _vlm_prep_worker(image_bytes: bytes) -> Tuple[Optional[PreparedImage], Dict[str, float]]:
+    """Crop + downscale an image for the VLM (backend.vlm_image_prep)."""
+    t0 = time.perf_counter()
+    prepared = prepare_image_bytes(image_bytes)
+    return prepared, {"vlm_prep": time.perf_counter() - t0}
+
+
+def _pdf_autofix_worker(pdf_bytes: bytes, page_index: int = 0) -> Tuple[Optional[bytes], Dict[str, float]]:
+    """Render one PDF page, auto-fix the raw pixels and encode JPEG once."""
+    timings: Dict[str, float] = {}
+    try:
+        return render_pdf_page_jpeg(pdf_bytes, page_index=page_index, timings=timings), timings
+    except Exception as e:
+        logging.getLogger("backend.autofix_pool").error(f"❌ PDF render failed (page {page_index}): {e}")
+        return None, timings
+
+
+# ================================================================
+# 📊 Metrics
+# ================================================================
+class AutoFixMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._stages: Dict[str, deque] = defaultdict(lambda: deque(maxlen=_TIMING_WINDOW))
+        self._stage_totals: Dict[str, int] = defaultdict(int)
+
+    def record_stages(self, timings: Dict[str, float]):
+        with self._lock:
+            for stage, seconds in timings.items():
+                self._stages[stage].append(seconds)
+                self._stage_totals[stage] += 1
+
+    @staticmethod
+    def _percentile(values, q: float) -> float:
+        ordered = sorted(values)
+        idx = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": len(values),
+                    "avg_ms": round(sum(values) / len(values) * 1000, 1),
+                    "p50_ms": round(self._percentile(values, 0.50) * 1000, 1),
+                    "p95_ms": round(self._percentile(values, 0.95) * 1000, 1),
+                    "max_ms": round(max(values) * 1000, 1),
+                }
+                for stage, values in self._stages.items() if values
+            }
+            classified = self._stage_totals["orientation_classifier"]
+            osd_runs = self._stage_totals["orientation_osd"]
+        return {
+            "workers": AUTOFIX_WORKERS,
+            "max_queue": AUTOFIX_MAX_QUEUE,
+            "timeout_seconds": AUTOFIX_TIMEOUT_SECONDS,
+            "queue_depth": self.in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "stages": stages,
+            "orientation": {
+                # OSD runs on every page; "without_osd" > 0 means Tesseract is missing (no rotation)
+                "osd": osd_runs,
+                "without_osd": classified - osd_runs,
+            },
+        }
+
+
+metrics = AutoFixMetrics()
+
+# ================================================================
+# 🏭 Pool
+# ================================================================
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Lazily start the pool ('spawn' - forking a process that holds OpenCV threads can deadlock)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=AUTOFIX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info(f"🏭 Auto-fix pool started with {AUTOFIX_WORKERS} workers")
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _release_slot(_future):
+    with metrics._lock:
+        metrics.in_flight -= 1
+
+
+async def _run_in_pool(worker, *args) -> Optional[bytes]:
+    """Submit one task to the bounded pool. None → queue full, timeout or worker failure."""
+    with metrics._lock:
+        if metrics.in_flight >= AUTOFIX_MAX_QUEUE:
+            metrics.rejected += 1
+            logger.warning(f"⚠️ Auto-fix queue full ({metrics.in_flight}). Using original image.")
+            return None
+        metrics.in_flight += 1
+        metrics.submitted += 1
+
+    start = time.perf_counter()
+    try:
+        future = get_executor().submit(worker, *args)
+    except Exception:
+        _release_slot(None)
+        raise
+    # The slot is freed when the process actually finishes, even after a timeout,
+    # so the queue bound reflects real CPU work still in progress.
+    future.add_done_callback(_release_slot)
+
+    try:
+        fixed, timings = await asyncio.wait_for(asyncio.wrap_future(future), timeout=AUTOFIX_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        metrics.timeouts += 1
+        logger.warning(f"⏱️ Auto-fix exceeded {AUTOFIX_TIMEOUT_SECONDS}s. Using original image.")
+        return None
+    except Exception as e:
+        metrics.failed += 1
+        logger.warning(f"⚠️ Auto-fix worker error: {e}. Using original image.")
+        return None
+
+    timings["total"] = time.perf_counter() - start
+    metrics.record_stages(timings)
+    if fixed is None:
+        metrics.failed += 1
+        return None
+    metrics.completed += 1
+    return fixed
+
+
+async def run_autofix(file_bytes: bytes) -> Optional[bytes]:
+    """
+    🔧 Auto-fix image bytes in the process pool without blocking the event loop.
+
+    Returns:
+        corrected JPEG bytes, or None → caller keeps the original image
+        (queue full, timeout, or correction failed)
+    """
+    return await _run_in_pool(_autofix_worker, file_bytes)
+
+
+async def run_autofix_with_derivatives(file_bytes: bytes) -> Optional[Tuple[bytes, Dict[str, bytes]]]:
+    """
+    🔧🖼️ Like run_autofix, plus the WebP renditions (backend.derivatives) in the same pool task.
+
+    Returns:
+        (corrected JPEG bytes, {"medium": ..., "small": ...}), or None → caller keeps the original
+    """
+    return await _run_in_pool(_autofix_derivatives_worker, file_bytes)
+
+
+async def run_derivatives(image_bytes: bytes) -> Dict[str, bytes]:
+    """🖼️ WebP renditions of a final image in the process pool ({} when the pool can't take it)."""
+    return await _run_in_pool(_derivatives_worker, image_bytes) or {}
+
+
+async def run_vlm_prep(image_bytes: bytes) -> Optional[PreparedImage]:
+    """🎯 Prepare an image for the VLM in the process pool. None → send the original URL."""
+    return await _run_in_pool(_vlm_prep_worker, image_bytes)
+
+
+async def run_pdf_autofix(pdf_bytes: bytes, page_index: int = 0) -> Optional[bytes]:
+    """
+    📄 PDF page → auto-fixed JPEG in the process pool (render, fix and encode in one worker).
+
+    Returns:
+        JPEG bytes, or None → caller renders the page without auto-fix
+    """
+    return await _run_in_pool(_pdf_autofix_worker, pdf_bytes, page_index)
+
+
+async def run_pdf_pages_autofix(pdf_bytes: bytes, page_indexes: List[int]) -> List[Optional[bytes]]:
+    """
+    📚 Render + auto-fix several PDF pages in parallel (one pool task per page), in page order.
+    Pages the pool couldn't take come back as None.
+    """
+    results = await asyncio.gather(*(run_pdf_autofix(pdf_bytes, i) for i in page_indexes), return_exceptions=True)
+    return [None if isinstance(r, BaseException) else r for r in results]
@@ -0,0 +1,125 @@
+"""
+⏱️ Benchmark: Image auto-fix - full-resolution analysis vs downscaled analysis
+==============================================================================
+يقارن بين تقدير الهندسة (الميل + أركان الفاتورة) على الصورة الكاملة (الطريقة القديمة)
+وتقديرها على نسخة مصغّرة ثم تطبيق التصحيح مرة واحدة بالدقة الكاملة.
+
+الصور اصطناعية: إيصال أبيض بأسطر نص على خلفية داكنة، مائل ومصوّر بزاوية (12MP افتراضياً).
+كل وضع يعمل في عملية مستقلة حتى يكون قياس الذاكرة (ru_maxrss) نظيفاً.
+
+Usage:
+    python -m backend.benchmarks.bench_autofix --images 10 --width 4000 --height 3000 --analysis-sides 0 1024
+
+    --analysis-sides 0 = التقدير بالدقة الكاملة (before)
+"""
+
+import argparse
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+
+def make_receipt(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    """Synthetic photo: a skewed, perspective-distorted white receipt with text lines on a dark table"""
+    canvas = np.full((height, width, 3), 60, dtype=np.uint8)
+    canvas += rng.integers(0, 20, size=(height, width, 1), dtype=np.uint8)
+
+    receipt_w, receipt_h = int(width * 0.45), int(height * 0.85)
+    receipt = np.full((receipt_h, receipt_w, 3), 245, dtype=np.uint8)
+    line_height = max(12, receipt_h // 60)
+    font_scale = line_height / 30.0
+    for i, y in enumerate(range(line_height * 2, receipt_h - line_height, int(line_height * 1.6))):
+        text = f"ITEM {i:03d} ....... {rng.integers(100, 99999) / 100:.2f} SAR"
+        cv2.putText(receipt, text, (line_height, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (20, 20, 20),
+                    max(1, line_height // 12), cv2.LINE_AA)
+
+    # Place the receipt with a random skew and a mild perspective tilt
+    angle = np.deg2rad(rng.uniform(-12, 12))
+    cx, cy = width / 2, height / 2
+    corners = np.array([[-receipt_w / 2, -receipt_h / 2], [receipt_w / 2, -receipt_h / 2],
+                        [receipt_w / 2, receipt_h / 2], [-receipt_w / 2, receipt_h / 2]])
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    dst = corners @ rotation.T + [cx, cy]
+    dst += rng.uniform(-0.03, 0.03, size=dst.shape) * [width, height]
+    src = np.array([[0, 0], [receipt_w - 1, 0], [receipt_w - 1, receipt_h - 1], [0, receipt_h - 1]], dtype="float32")
+    M = cv2.getPerspectiveTransform(src, dst.astype("float32"))
+    cv2.warpPerspective(receipt, M, (width, height), dst=canvas, borderMode=cv2.BORDER_TRANSPARENT)
+    return canvas
+
+
+def run_mode(analysis_side: int, args, queue):
+    """Child process: auto-fix every synthetic image with one analysis size"""
+    from backend import utils_image_autofix
+
+    if args.skip_osd:
+        utils_image_autofix.TESSERACT_AVAILABLE = False
+
+    rng = np.random.default_rng(args.seed)
+    images = [make_receipt(rng, args.width, args.height) for _ in range(args.images)]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    latencies, peaks, stages = [], [], {}
+    for img in images:
+        timings = {}
+        tracemalloc.start()
+        start = time.perf_counter()
+        utils_image_autofix.auto_fix_image_array(img, timings=timings, analysis_max_side=analysis_side)
+        latencies.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+
+    queue.put({
+        "latencies": latencies,
+        "peaks": peaks,
+        "stages": {stage: statistics.median(values) for stage, values in stages.items()},
+        # ru_maxrss is KiB on Linux; includes OpenCV's internal buffers that tracemalloc can't see
+        "rss_growth_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image auto-fix geometry estimation")
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--analysis-sides", type=int, nargs="+", default=[0, 1024],
+                        help="analysis max side per mode (0 = full resolution)")
+    parser.add_argument("--skip-osd", action="store_true", help="disable Tesseract OSD to isolate geometry cost")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if sys.platform == "win32":
+        print("❌ resource module is not available on Windows")
+        raise SystemExit(1)
+
+    print(f"🧾 {args.images} synthetic receipts at {args.width}x{args.height}")
+    print(f"{'analysis':>10} | {'p50 (ms)':>9} | {'p95 (ms)':>9} | {'peak numpy (MB)':>15} | "
+          f"{'peak RSS +MB':>12} | stages p50 (ms)")
+    print("-" * 100)
+
+    ctx = multiprocessing.get_context("spawn")
+    for side in args.analysis_sides:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_mode, args=(side, args, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+
+        latencies = sorted(result["latencies"])
+        p95 = latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+        stages = ", ".join(f"{k}={v * 1000:.0f}" for k, v in result["stages"].items())
+        label = "full" if side <= 0 else str(side)
+        print(f"{label:>10} | {statistics.median(latencies) * 1000:>9.1f} | {p95 * 1000:>9.1f} | "
+              f"{max(result['peaks']) / 2**20:>15.1f} | {result['rss_growth_mb']:>12.1f} | {stages}")
+
+
+if __name__ == "__main__":
+    main()
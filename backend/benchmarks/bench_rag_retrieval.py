@@ -0,0 +1,151 @@
+"""
+⏱️ Benchmark: RAG retrieval - Python full scan vs pgvector ORDER BY <=> LIMIT k
+================================================================================
+يقارن بين الطريقة القديمة (جلب جميع الـ embeddings وحساب cosine similarity في Python)
+والطريقة الجديدة (الترتيب داخل Postgres وإرجاع أفضل k فقط).
+
+يعمل على جدول مؤقت (TEMP TABLE) فلا يلمس بيانات الإنتاج.
+
+Usage:
+    python -m backend.benchmarks.bench_rag_retrieval --sizes 10000 100000 1000000 --queries 5
+
+Requires:
+    BENCH_DATABASE_URL (or DATABASE_URL) pointing to a Postgres with the `vector` extension.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+from backend.vector_index import EMBEDDING_DIM
+from backend.vector_search import to_vector_literal
+
+load_dotenv()
+
+
+def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
+    """Same per-row cosine similarity used by the old execute_rag loop"""
+    dot_product = np.dot(vec1, vec2)
+    norm1 = np.linalg.norm(vec1)
+    norm2 = np.linalg.norm(vec2)
+    if norm1 == 0 or norm2 == 0:
+        return 0.0
+    return dot_product / (norm1 * norm2)
+
+
+def populate(conn, size: int, dim: int):
+    """Fill the temp table with `size` random vectors generated server-side"""
+    conn.execute(text("DROP TABLE IF EXISTS bench_embeddings"))
+    conn.execute(text(f"CREATE TEMP TABLE bench_embeddings (id SERIAL PRIMARY KEY, embedding VECTOR({dim}))"))
+    batch = 10_000
+    for offset in range(0, size, batch):
+        n = min(batch, size - offset)
+        conn.execute(
+            text("""
+                INSERT INTO bench_embeddings (embedding)
+                SELECT ARRAY(SELECT random() - 0.5 FROM generate_series(1, :dim) WHERE g > 0)::vector
+                FROM generate_series(1, :n) AS g
+            """),
+            {"dim": dim, "n": n},
+        )
+    conn.execute(text("ANALYZE bench_embeddings"))
+
+
+def full_scan(conn, query: np.ndarray, top_k: int):
+    """Old path: pull every vector over the wire and score each row in Python"""
+    rows = conn.execute(text("SELECT id, embedding FROM bench_embeddings")).fetchall()
+    similarities = []
+    for row in rows:
+        embedding_data = row.embedding
+        if isinstance(embedding_data, str):
+            vec = np.array(json.loads(embedding_data))
+        else:
+            vec = np.array(embedding_data)
+        similarities.append((row.id, float(cosine_similarity(query, vec))))
+    similarities.sort(key=lambda x: x[1], reverse=True)
+    return similarities[:top_k]
+
+
+def pgvector_topk(conn, query: np.ndarray, top_k: int):
+    """New path: rank inside Postgres and return only top_k rows"""
+    rows = conn.execute(
+        text("""
+            SELECT id, 1 - (embedding <=> CAST(:q AS vector)) AS similarity
+            FROM bench_embeddings
+            ORDER BY embedding <=> CAST(:q AS vector)
+            LIMIT :k
+        """),
+        {"q": to_vector_literal(query), "k": top_k},
+    ).fetchall()
+    return [(row.id, float(row.similarity)) for row in rows]
+
+
+def time_it(fn, *args, repeats: int):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RAG retrieval strategies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=5, help="timed repeats per strategy")
+    parser.add_argument("--skip-full-scan-above", type=int, default=None,
+                        help="skip the Python full scan for sizes above this (it is very slow at 1M)")
+    args = parser.parse_args()
+
+    database_url = os.getenv("BENCH_DATABASE_URL") or os.getenv("DATABASE_URL")
+    if not database_url:
+        print("❌ BENCH_DATABASE_URL / DATABASE_URL not set")
+        raise SystemExit(1)
+
+    engine = create_engine(database_url)
+    rng = np.random.default_rng(42)
+
+    print(f"{'size':>10} | {'strategy':<12} | {'p50 (ms)':>10} | {'mean (ms)':>10} | {'top-k overlap':>13}")
+    print("-" * 68)
+
+    with engine.connect() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        for size in args.sizes:
+            print(f"🔄 Populating {size:,} vectors (dim={args.dim})...", flush=True)
+            populate(conn, size, args.dim)
+            query = rng.random(args.dim) - 0.5
+
+            pg_times, pg_result = time_it(pgvector_topk, conn, query, args.top_k, repeats=args.queries)
+
+            if args.skip_full_scan_above is not None and size > args.skip_full_scan_above:
+                scan_times, scan_result = None, None
+            else:
+                scan_times, scan_result = time_it(full_scan, conn, query, args.top_k, repeats=args.queries)
+
+            overlap = "-"
+            if scan_result is not None:
+                overlap = f"{len({i for i, _ in scan_result} & {i for i, _ in pg_result})}/{args.top_k}"
+
+            if scan_times is not None:
+                print(f"{size:>10,} | {'full_scan':<12} | {statistics.median(scan_times) * 1000:>10.1f} | "
+                      f"{statistics.mean(scan_times) * 1000:>10.1f} | {'':>13}")
+            else:
+                print(f"{size:>10,} | {'full_scan':<12} | {'skipped':>10} | {'skipped':>10} | {'':>13}")
+            print(f"{size:>10,} | {'pgvector':<12} | {statistics.median(pg_times) * 1000:>10.1f} | "
+                  f"{statistics.mean(pg_times) * 1000:>10.1f} | {overlap:>13}")
+
+        conn.execute(text("DROP TABLE IF EXISTS bench_embeddings"))
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main()
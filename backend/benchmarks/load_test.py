@@ -0,0 +1,305 @@
+"""
+🚦 Load Test: /vlm/analyze, /invoices/save-analyzed, /chat/ask
+==============================================================
+يرسل طلبات متزامنة إلى الـ FastAPI app ويقيس p50/p95/p99 والإنتاجية (req/s) لكل endpoint.
+
+يعمل بدون إنترنت وبدون مزود مدفوع: مع --spawn يشغّل backend/benchmarks/mock_ai_server.py
+والـ app (uvicorn) كعمليتين محليتين، ويوجّه FRIENDLI_URL و OPENAI_BASE_URL إلى الخادم الوهمي.
+الصور تُجلب من الخادم الوهمي (/_images/{n}.png)، وكل طلب VLM يستخدم صورة جديدة
+(فلا يقيس الـ VLM cache) إلا مع --reuse-images.
+
+Usage:
+    # كل شيء محلياً (تحتاج DATABASE_URL لقاعدة Postgres محلية، DATABASE_SSLMODE=disable)
+    python -m backend.benchmarks.load_test --spawn --concurrency 8 --requests 200
+
+    # زمن VLM بذيل طويل + 2% أخطاء 5xx من المزود
+    python -m backend.benchmarks.load_test --spawn --mock-args "--vlm-latency pareto:2:1.8 --error-rate 0.02"
+
+    # app يعمل مسبقاً (شغّله مع VLM_IMAGE_FETCH_ALLOWED_PREFIXES=http://127.0.0.1:9100/_images/
+    # وإلا يرفض الخادم جلب صور الخادم الوهمي)
+    python -m backend.benchmarks.load_test --base-url http://127.0.0.1:8000 --mock-url http://127.0.0.1:9100
+
+Options:
+    --endpoints vlm_analyze save_analyzed chat_ask   (default: الثلاثة)
+    --mixed          تشغيل الـ endpoints معاً بدل واحد تلو الآخر
+    --warmup N       طلبات تمهيدية لكل endpoint لا تُحتسب
+    --json PATH      حفظ النتائج
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from backend.benchmarks.mock_ai_server import canned_invoice
+
+ENDPOINTS = ("vlm_analyze", "save_analyzed", "chat_ask")
+CHAT_QUESTIONS = [
+    "وش آخر فاتورة من المطاعم؟",
+    "كم مجموع فواتيري هذا الشهر؟",
+    "ورني فاتورة الصيدلية",
+    "أعلى فاتورة من السوبرماركت",
+    "كم عدد فواتيري؟",
+]
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+# ================================================================
+# 📨 Requests per endpoint
+# ================================================================
+def edited_invoice_body(seed: str, image_url: str) -> dict:
+    """EditedInvoiceData for /invoices/save-analyzed, from the same canned invoice the mock VLM returns."""
+    inv = canned_invoice(seed)
+    return {
+        "invoice_number": inv["Invoice Number"],
+        "date": inv["Date"],
+        "vendor": inv["Vendor"],
+        "tax_number": inv["Tax Number"],
+        "cashier": inv["Cashier"],
+        "branch": inv["Branch"],
+        "phone": inv["Phone"],
+        "subtotal": inv["Subtotal"],
+        "tax": inv["Tax"],
+        "total_amount": inv["Total Amount"],
+        "grand_total": inv["Grand Total (before tax)"],
+        "discounts": inv["Discounts"],
+        "amount_paid": inv["Amount Paid"],
+        "payment_method": inv["Payment Method"],
+        "invoice_type": inv["Invoice_Type"],
+        "category": {"ar": inv["Category"], "en": inv["Category"]},
+        "ai_insight": inv["AI_Insight"],
+        "image_url": image_url,
+        "items": inv["Items"],
+    }
+
+
+class RequestFactory:
+    """(path, json body) for the n-th request of an endpoint."""
+
+    def __init__(self, mock_url: str, reuse_images: int):
+        self.mock_url = mock_url.rstrip("/")
+        self.reuse_images = reuse_images
+        self.run_id = random.randrange(10**6, 10**7)  # fresh images per run → no VLM cache hits
+
+    def image_url(self, n: int) -> str:
+        index = n % self.reuse_images if self.reuse_images else self.run_id * 100_000 + n
+        return f"{self.mock_url}/_images/{index}.png"
+
+    def build(self, endpoint: str, n: int):
+        if endpoint == "vlm_analyze":
+            return "/vlm/analyze", {"image_url": self.image_url(n)}
+        if endpoint == "save_analyzed":
+            url = self.image_url(n)
+            return "/invoices/save-analyzed", edited_invoice_body(url, url)
+        if endpoint == "chat_ask":
+            return "/chat/ask", {"message": CHAT_QUESTIONS[n % len(CHAT_QUESTIONS)]}
+        raise ValueError(f"unknown endpoint {endpoint}")
+
+
+# ================================================================
+# 🏃 Runner
+# ================================================================
+class EndpointResult:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.latencies = []
+        self.statuses: Counter = Counter()
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def record(self, seconds: float, status, ok: bool):
+        self.latencies.append(seconds)
+        self.statuses[str(status)] += 1
+        self.errors += int(not ok)
+
+    def summary(self) -> dict:
+        wall = (self.finished - self.started) if self.started and self.finished else 0.0
+        ms = lambda v: round(v * 1000, 1) if v is not None else None  # noqa: E731
+        return {
+            "endpoint": self.endpoint,
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "statuses": dict(self.statuses),
+            "p50_ms": ms(percentile(self.latencies, 0.50)),
+            "p95_ms": ms(percentile(self.latencies, 0.95)),
+            "p99_ms": ms(percentile(self.latencies, 0.99)),
+            "max_ms": ms(max(self.latencies) if self.latencies else None),
+            "mean_ms": ms(statistics.fmean(self.latencies) if self.latencies else None),
+            "wall_seconds": round(wall, 2),
+            "throughput_rps": round(len(self.latencies) / wall, 2) if wall else None,
+        }
+
+
+async def send(client: httpx.AsyncClient, path: str, body: dict):
+    """(seconds, status, ok). A 200 with {"status": "error"} (unparseable VLM output) counts as an error."""
+    start = time.perf_counter()
+    try:
+        response = await client.post(path, json=body)
+    except httpx.HTTPError as e:
+        return time.perf_counter() - start, type(e).__name__, False
+    elapsed = time.perf_counter() - start
+    ok = response.status_code == 200
+    if ok:
+        try:
+            ok = response.json().get("status") != "error"
+        except ValueError:
+            ok = False
+    return elapsed, response.status_code, ok
+
+
+async def run_endpoint(client: httpx.AsyncClient, factory: RequestFactory, endpoint: str,
+                       requests: int, concurrency: int, warmup: int) -> EndpointResult:
+    counter = itertools.count()
+    for n in range(warmup):
+        await send(client, *factory.build(endpoint, -1 - n))
+
+    result = EndpointResult(endpoint)
+
+    async def worker():
+        while True:
+            n = next(counter)
+            if n >= requests:
+                return
+            seconds, status, ok = await send(client, *factory.build(endpoint, n))
+            result.record(seconds, status, ok)
+
+    result.started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result.finished = time.perf_counter()
+    return result
+
+
+async def run(args) -> list:
+    factory = RequestFactory(args.mock_url, args.reuse_images)
+    limits = httpx.Limits(max_connections=args.concurrency * len(args.endpoints) + 4)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        if args.mixed:
+            results = await asyncio.gather(*(
+                run_endpoint(client, factory, ep, args.requests, args.concurrency, args.warmup)
+                for ep in args.endpoints
+            ))
+        else:
+            results = []
+            for ep in args.endpoints:
+                print(f"▶️  {ep}: {args.requests} requests @ concurrency {args.concurrency}", flush=True)
+                results.append(await run_endpoint(client, factory, ep, args.requests, args.concurrency, args.warmup))
+        try:
+            print(f"🛡️  resilience: {(await client.get('/resilience/metrics')).json()}")
+        except (httpx.HTTPError, ValueError):
+            pass
+    return [r.summary() for r in results]
+
+
+# ================================================================
+# 🧰 Local processes (--spawn)
+# ================================================================
+def wait_healthy(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"❌ {url} did not become healthy within {timeout:.0f}s")
+
+
+def spawn(args) -> list:
+    mock_port = int(args.mock_url.rsplit(":", 1)[1].rstrip("/"))
+    app_port = int(args.base_url.rsplit(":", 1)[1].rstrip("/"))
+    mock = subprocess.Popen([sys.executable, "-m", "backend.benchmarks.mock_ai_server",
+                             "--port", str(mock_port), *shlex.split(args.mock_args)])
+    env = {
+        **os.environ,
+        "FRIENDLI_URL": f"{args.mock_url}/v1/chat/completions",
+        "FRIENDLI_TOKEN": "mock",
+        "OPENAI_BASE_URL": f"{args.mock_url}/v1",
+        "OPENAI_API_KEY": "mock",
+        "STORAGE_BACKEND": os.environ.get("STORAGE_BACKEND", "local"),
+        "STORAGE_PUBLIC_BASE_URL": args.base_url,
+        # The mock's /_images/ are not in our storage → allow the server-side fetch explicitly
+        "VLM_IMAGE_FETCH_ALLOWED_PREFIXES": f"{args.mock_url}/_images/",
+    }
+    if not env.get("DATABASE_URL"):
+        print("⚠️  DATABASE_URL is not set - save/analyze/chat need a (local) Postgres")
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(app_port),
+                            "--workers", str(args.app_workers), "--log-level", "warning"], env=env)
+    procs = [mock, app]
+    try:
+        wait_healthy(f"{args.mock_url}/healthz")
+        wait_healthy(f"{args.base_url}/healthz")
+    except SystemExit:
+        stop(procs)
+        raise
+    return procs
+
+
+def stop(procs: list):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the invoice API against the offline mock provider")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8800")
+    parser.add_argument("--mock-url", default="http://127.0.0.1:9100")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--mixed", action="store_true", help="run all endpoints at the same time")
+    parser.add_argument("--reuse-images", type=int, default=0, help="cycle over N images (measures the VLM cache)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--spawn", action="store_true", help="start the mock provider and the app locally")
+    parser.add_argument("--app-workers", type=int, default=1)
+    parser.add_argument("--mock-args", default="", help="extra mock_ai_server flags, e.g. \"--error-rate 0.05\"")
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args()
+
+    procs = spawn(args) if args.spawn else []
+    try:
+        summaries = asyncio.run(run(args))
+    finally:
+        stop(procs)
+
+    print(f"\n{'endpoint':>14} | {'reqs':>5} | {'errors':>6} | {'p50 ms':>8} | {'p95 ms':>8} | "
+          f"{'p99 ms':>8} | {'max ms':>8} | {'req/s':>7} | statuses")
+    print("-" * 110)
+    for s in summaries:
+        fmt = lambda v: "-" if v is None else f"{v:.1f}"  # noqa: E731
+        print(f"{s['endpoint']:>14} | {s['requests']:>5} | {s['errors']:>6} | {fmt(s['p50_ms']):>8} | "
+              f"{fmt(s['p95_ms']):>8} | {fmt(s['p99_ms']):>8} | {fmt(s['max_ms']):>8} | "
+              f"{fmt(s['throughput_rps']):>7} | {s['statuses']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"concurrency": args.concurrency, "mixed": args.mixed, "results": summaries}, f,
+                      ensure_ascii=False, indent=2)
+        print(f"\n💾 Saved {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""
+🧪 Mock Friendli / OpenAI Server
+================================
+خادم محلي يحاكي واجهات chat completions و embeddings (بصيغة OpenAI التي يستخدمها Friendli أيضاً)،
+لقياس أداء /vlm/analyze و /invoices/save-analyzed و /chat/ask بدون مزود مدفوع وبدون إنترنت،
+ولاختبار طبقة backend/resilience.py (retry / circuit breaker / hedging) بحقن الأعطال.
+
+Replies:
+- طلب فيه صورة (VLM)        → JSON فاتورة جاهز (نفس حقول vlm_extraction.HEADER_FIELDS + Items)،
+                               يُختار بثبات حسب رابط الصورة
+- مراحل /chat/ask            → تُعرف من رسالة الـ system: refiner / router / SQL / الرد النهائي
+- embeddings                 → متجه ثابت لكل نص (sha256 seed) بطول 1536
+- stream: true               → SSE بنفس صيغة المزود، موزع على زمن الاستجابة المختار
+- GET /_images/{n}.png       → صورة فاتورة اصطناعية (PNG) مختلفة لكل n، ليجلبها الـ backend كما يجلب صور التخزين
+
+Latency (لكل نوع: vlm / chat / embeddings) - صيغة "توزيع:معامل:معامل" بالثواني:
+    fixed:0.5 | uniform:0.2:1.5 | normal:1.0:0.2 | lognormal:<median>:<sigma> | pareto:<min>:<alpha>
+
+Faults (نسب من 0 إلى 1، من سطر الأوامر أو أثناء التشغيل عبر POST /_faults):
+- error_rate       رد 500 أو 503
+- rate_limit_rate  رد 429 مع Retry-After
+- slow_rate        تأخير إضافي slow_seconds قبل الرد (ذيل الزمن - لاختبار hedging)
+- hang_rate        لا رد لمدة hang_seconds (لاختبار الـ deadline)
+- drop_rate        يقطع الاتصال في منتصف الجسم (RemoteProtocolError عند العميل)
+
+Usage:
+    python -m backend.benchmarks.mock_ai_server --port 9100 --vlm-latency lognormal:4:0.35 --error-rate 0.02
+
+    FRIENDLI_URL=http://127.0.0.1:9100/v1/chat/completions FRIENDLI_TOKEN=mock \\
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=mock \\
+    uvicorn backend.main:app
+
+    curl -X POST localhost:9100/_faults -H 'Content-Type: application/json' -d '{"error_rate": 1}'
+    curl localhost:9100/_stats
+
+backend/benchmarks/load_test.py يشغّل هذا الخادم تلقائياً مع --spawn.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import struct
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+app = FastAPI(title="Mock AI provider")
+
+FAULTS = {
+    "error_rate": 0.0,
+    "rate_limit_rate": 0.0,
+    "retry_after_seconds": 1.0,
+    "slow_rate": 0.0,
+    "slow_seconds": 5.0,
+    "hang_rate": 0.0,
+    "hang_seconds": 600.0,
+    "drop_rate": 0.0,
+}
+LATENCY = {
+    "vlm": "lognormal:3.0:0.35",
+    "chat": "lognormal:0.6:0.4",
+    "embeddings": "lognormal:0.08:0.3",
+}
+# /chat/ask router decision: one mode, or "mixed" to rotate through all of them
+CHAT_MODE = {"mode": "rag"}
+STATS: Counter = Counter()
+EMBEDDING_DIM = 1536
+_STREAM_CHUNK_CHARS = 16
+_ROUTER_MODES = ["deep_sql", "rag", "hybrid", "none"]
+
+
+# ================================================================
+# ⏱️ Latency distributions
+# ================================================================
+def parse_latency(spec: str):
+    """'lognormal:3:0.35' → sampler() in seconds. Raises ValueError on an unknown distribution."""
+    kind, *params = spec.split(":")
+    p = [float(x) for x in params]
+    samplers = {
+        "fixed": lambda: p[0],
+        "uniform": lambda: random.uniform(p[0], p[1]),
+        "normal": lambda: random.gauss(p[0], p[1]),
+        "lognormal": lambda: random.lognormvariate(math.log(p[0]), p[1]),
+        "pareto": lambda: p[0] * random.paretovariate(p[1]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"unknown latency distribution '{kind}' (use one of {sorted(samplers)})")
+    sampler = samplers[kind]
+    sampler()  # fail fast on missing parameters
+    return lambda: max(0.0, sampler())
+
+
+_samplers = {kind: parse_latency(spec) for kind, spec in LATENCY.items()}
+
+
+def set_latency(kind: str, spec: str):
+    _samplers[kind] = parse_latency(spec)
+    LATENCY[kind] = spec
+
+
+# ================================================================
+# 🧾 Canned content
+# ================================================================
+_VENDORS = [
+    ("كافيه الشرفة", "Cafe", ["لاتيه", "كرواسون", "موكا", "كوكيز"]),
+    ("مطعم البيك", "Restaurant", ["وجبة دجاج", "بطاطس", "بيبسي", "صوص ثوم"]),
+    ("بنده", "Supermarket", ["حليب المراعي", "خبز", "أرز بسمتي", "بيض 30", "تمر سكري", "ماء نوفا"]),
+    ("صيدلية النهدي", "Pharmacy", ["بنادول", "فيتامين د", "معقم يدين"]),
+    ("إكسترا", "Electronics", ["سماعة بلوتوث", "شاحن USB-C"]),
+]
+_INVOICE_TYPES = ["فاتورة شراء", "فاتورة ضريبية"]
+
+
+def canned_invoice(seed: str) -> dict:
+    """A plausible invoice, fixed per seed (image URL) so repeated analyses agree."""
+    rng = random.Random(hashlib.sha256(seed.encode()).digest())
+    vendor, category, catalogue = rng.choice(_VENDORS)
+    items = []
+    for _ in range(rng.randint(1, 3 * len(catalogue))):
+        qty = rng.randint(1, 4)
+        price = round(rng.uniform(2, 120), 2)
+        items.append({"description": rng.choice(catalogue), "quantity": qty,
+                      "unit_price": price, "total": round(qty * price, 2)})
+    subtotal = round(sum(i["total"] for i in items), 2)
+    tax = round(subtotal * 0.15, 2)
+    total = round(subtotal + tax, 2)
+    return {
+        "Vendor": vendor,
+        "Date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "Total Amount": f"{total:.2f}",
+        "Invoice Number": f"INV-{rng.randint(10000, 99999)}",
+        "Tax Number": f"3{rng.randint(10**13, 10**14 - 1)}",
+        "Cashier": rng.choice(["أحمد", "سارة", "Not Mentioned"]),
+        "Branch": rng.choice(["الرياض - العليا", "جدة - التحلية", "الدمام"]),
+        "Phone": f"05{rng.randint(10**7, 10**8 - 1)}",
+        "Subtotal": f"{subtotal:.2f}",
+        "Tax": f"{tax:.2f}",
+        "Grand Total (before tax)": f"{subtotal:.2f}",
+        "Discounts": "0.00",
+        "Payment Method": rng.choice(["مدى", "Visa", "نقداً"]),
+        "Amount Paid": f"{total:.2f}",
+        "Ticket Number": "Not Mentioned",
+        "Category": category,
+        "Invoice_Type": rng.choice(_INVOICE_TYPES),
+        "AI_Insight": f"فاتورة من {vendor} بقيمة {total:.2f} ريال تشمل {len(items)} صنف.",
+        "Items": items,
+    }
+
+
+def _image_url(payload: dict):
+    for message in payload.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "image_url":
+                    return (part.get("image_url") or {}).get("url") or ""
+    return None
+
+
+def _system_text(payload: dict) -> str:
+    return " ".join(m.get("content") or "" for m in payload.get("messages") or []
+                    if m.get("role") == "system" and isinstance(m.get("content"), str))
+
+
+def chat_reply(payload: dict):
+    """(kind, content) for a chat-completions payload: the VLM call or one of the /chat/ask stages."""
+    image_url = _image_url(payload)
+    if image_url is not None:
+        return "vlm", json.dumps(canned_invoice(image_url[:512]), ensure_ascii=False)
+    system = _system_text(payload)
+    if "تحسين الأسئلة" in system:
+        return "chat", "ما هي فواتيري من المطاعم هذا الشهر؟"
+    if "تصنيف" in system:
+        mode = CHAT_MODE["mode"]
+        if mode == "mixed":
+            mode = _ROUTER_MODES[STATS["router_requests"] % len(_ROUTER_MODES)]
+        STATS["router_requests"] += 1
+        return "chat", json.dumps({"mode": mode, "reason": "mock router", "show_images": True,
+                                   "requested_vendor": None}, ensure_ascii=False)
+    if "SQL" in system:
+        return "chat", "SELECT id, vendor, total_amount, invoice_date FROM invoices ORDER BY total_amount DESC LIMIT 5"
+    return "chat", "عندك عدة فواتير من المطاعم، أعلاها من مطعم البيك. تبي أعرض لك التفاصيل؟"
+
+
+def _png(width: int, height: int, rows) -> bytes:
+    """Minimal grayscale PNG encoder (no Pillow needed)."""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    raw = b"".join(b"\x00" + row for row in rows)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+@lru_cache(maxsize=256)
+def synthetic_receipt(n: int, width: int = 900, height: int = 1600) -> bytes:
+    """A white receipt with text-like dark bars on a grey background; the bar layout differs per n."""
+    rng = random.Random(n)
+    margin_x, margin_y = width // 10, height // 16
+    background, paper, ink = b"\x50", b"\xf5", b"\x20"
+    blank = background * margin_x + paper * (width - 2 * margin_x) + background * margin_x
+    rows = [background * width] * margin_y
+    y = margin_y
+    while y < height - margin_y:
+        line_h = rng.randint(14, 22)
+        bar_w = rng.randint(width // 5, width - 3 * margin_x)
+        indent = margin_x // 2
+        text_row = (background * margin_x + paper * indent + ink * bar_w
+                    + paper * (width - 2 * margin_x - indent - bar_w) + background * margin_x)
+        for i in range(min(line_h, height - margin_y - y)):
+            rows.append(text_row if 3 <= i < line_h - 4 else blank)
+        y += line_h
+    rows += [background * width] * (height - len(rows))
+    return _png(width, height, rows)
+
+
+def _fake_embedding(text: str):
+    """Deterministic unit vector per input, so repeated queries rank the same way."""
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vec = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIM)]
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+# ================================================================
+# 💥 Faults
+# ================================================================
+def _roll(name: str) -> bool:
+    return random.random() < FAULTS[name]
+
+
+async def _inject_faults(kind: str):
+    """Hang/slow faults, then an error response (or the marker "drop") when one is rolled."""
+    STATS[f"{kind}_requests"] += 1
+    if _roll("hang_rate"):
+        STATS["hangs"] += 1
+        await asyncio.sleep(FAULTS["hang_seconds"])
+    if _roll("slow_rate"):
+        STATS["slow"] += 1
+        await asyncio.sleep(FAULTS["slow_seconds"])
+    if _roll("error_rate"):
+        STATS["errors"] += 1
+        status = random.choice([500, 503])
+        return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=status)
+    if _roll("rate_limit_rate"):
+        STATS["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "injected rate limit", "type": "rate_limit"}}, status_code=429,
+                            headers={"Retry-After": str(FAULTS["retry_after_seconds"])})
+    if _roll("drop_rate"):
+        STATS["dropped"] += 1
+        return "drop"
+    return None
+
+
+def _dropped_body(body: str) -> StreamingResponse:
+    """Send half the body, then kill the connection."""
+    async def chunks():
+        yield body[: len(body) // 2].encode()
+        raise ConnectionResetError("injected connection drop")
+    return StreamingResponse(chunks(), media_type="application/json")
+
+
+# ================================================================
+# 🌐 Endpoints
+# ================================================================
+def _sse_chunks(content: str, model: str, seconds: float):
+    """Stream `content` in small deltas spread over `seconds` (first delta after ~10% of it, like prefill)."""
+    pieces = [content[i:i + _STREAM_CHUNK_CHARS] for i in range(0, len(content), _STREAM_CHUNK_CHARS)] or [""]
+
+    async def events():
+        await asyncio.sleep(seconds * 0.1)
+        step = seconds * 0.9 / len(pieces)
+        for piece in pieces:
+            chunk = {"object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(step)
+        done = {"object": "chat.completion.chunk", "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": {"completion_tokens": math.ceil(len(content) / 2)}}
+        yield f"data: {json.dumps(done)}\n\n"
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/{prefix:path}chat/completions")
+async def chat_completions(prefix: str, request: Request):
+    payload = await request.json()
+    kind, content = chat_reply(payload)
+    fault = await _inject_faults(kind)
+    if isinstance(fault, JSONResponse):
+        return fault
+    seconds = _samplers[kind]()
+    model = payload.get("model", "mock")
+    if payload.get("stream"):
+        return _sse_chunks(content, model, seconds)
+    await asyncio.sleep(seconds)
+    completion_tokens = math.ceil(len(content) / 2)
+    body = {
+        "id": f"mock-{STATS[kind + '_requests']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1000 if kind == "vlm" else 200, "completion_tokens": completion_tokens,
+                  "total_tokens": (1000 if kind == "vlm" else 200) + completion_tokens},
+    }
+    if fault == "drop":
+        return _dropped_body(json.dumps(body, ensure_ascii=False))
+    return JSONResponse(body)
+
+
+@app.post("/{prefix:path}embeddings")
+async def embeddings(prefix: str, request: Request):
+    payload = await request.json()
+    fault = await _inject_faults("embeddings")
+    if isinstance(fault, JSONResponse):
+        return fault
+    await asyncio.sleep(_samplers["embeddings"]())
+    inputs = payload.get("input")
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    body = {
+        "object": "list",
+        "model": payload.get("model", "mock-embedding"),
+        "data": [{"object": "embedding", "index": i, "embedding": _fake_embedding(str(text))}
+                 for i, text in enumerate(inputs)],
+        "usage": {"prompt_tokens": 8 * len(inputs), "total_tokens": 8 * len(inputs)},
+    }
+    if fault == "drop":
+        return _dropped_body(json.dumps(body))
+    return JSONResponse(body)
+
+
+@app.get("/_images/{n}.png")
+def receipt_image(n: int):
+    return Response(synthetic_receipt(n), media_type="image/png",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+@app.get("/_invoices/{seed}")
+def invoice_fixture(seed: str):
+    """The canned invoice the VLM would return for `seed` (used by the load test for /invoices/save-analyzed)."""
+    return canned_invoice(seed)
+
+
+@app.get("/_faults")
+def get_faults():
+    return {**FAULTS, "latency": LATENCY, "chat_mode": CHAT_MODE["mode"]}
+
+
+@app.post("/_faults")
+async def set_faults(request: Request):
+    """
+    Change settings at runtime, e.g. {"error_rate": 1.0} to trip the breaker,
+    {"latency": {"vlm": "pareto:2:1.5"}} or {"chat_mode": "mixed"}.
+    """
+    updates = await request.json()
+    latency = updates.pop("latency", None) or {}
+    chat_mode = updates.pop("chat_mode", None)
+    unknown = (set(updates) - set(FAULTS)) | (set(latency) - set(LATENCY))
+    if unknown:
+        return JSONResponse({"detail": f"unknown settings: {sorted(unknown)}"}, status_code=400)
+    try:
+        for kind, spec in latency.items():
+            set_latency(kind, spec)
+    except (ValueError, IndexError) as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    if chat_mode is not None:
+        CHAT_MODE["mode"] = chat_mode
+    FAULTS.update({k: float(v) for k, v in updates.items()})
+    return get_faults()
+
+
+@app.get("/_stats")
+def get_stats():
+    return dict(STATS)
+
+
+@app.get("/healthz")
+def health_check():
+    return {"ok": True}
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Offline Friendli/OpenAI stand-in with latency and fault injection")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for kind in LATENCY:
+        parser.add_argument(f"--{kind}-latency", default=LATENCY[kind], help="e.g. lognormal:<median>:<sigma>")
+    parser.add_argument("--chat-mode", default=CHAT_MODE["mode"], choices=_ROUTER_MODES + ["mixed"],
+                        help="router decision returned to /chat/ask")
+    for name in FAULTS:
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=FAULTS[name])
+    args = parser.parse_args()
+
+    for kind in LATENCY:
+        set_latency(kind, getattr(args, f"{kind}_latency"))
+    CHAT_MODE["mode"] = args.chat_mode
+    for name in FAULTS:
+        FAULTS[name] = getattr(args, name)
+    print(f"🧪 Mock AI provider on http://{args.host}:{args.port} latency={LATENCY} faults={FAULTS}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,8 @@ if raw_url.startswith("DATABASE_URL="):
     raw_url = raw_url.split("=", 1)[1].strip()
 
 # ✅ نضيف إعدادات الاتصال الآمنة والترميز
-connect_args = {"sslmode": "require", "client_encoding": "utf8"}
+# (DATABASE_SSLMODE=disable لقاعدة Postgres محلية، مثل اختبارات الحمل بدون إنترنت)
+connect_args = {"sslmode": os.getenv("DATABASE_SSLMODE", "require"), "client_encoding": "utf8"}
 
 for attempt in range(3):
     try:
@@ -0,0 +1,86 @@
+"""
+🖼️ Image Derivatives
+====================
+نسخ WebP مصغّرة من صورة الفاتورة للعرض في لوحة التحكم والمحادثة،
+بدلاً من تحميل الصورة الأصلية بدقتها الكاملة لكل بطاقة.
+
+- small  → بطاقات المحادثة وقوائم الفواتير (thumbnail_url)
+- medium → بطاقات لوحة التحكم على شاشات عالية الكثافة والمعاينة
+
+تُولَّد داخل عامل التصحيح (autofix_pool) من المصفوفة المصححة نفسها، فلا تُفك الصورة مرة ثانية،
+وتُخزَّن بجانب الأصل: ab/<sha>.jpg → ab/<sha>_small.webp, ab/<sha>_medium.webp
+
+Configuration:
+- DERIVATIVE_SMALL_SIDE     (default 400)  أطول ضلع للنسخة الصغيرة
+- DERIVATIVE_MEDIUM_SIDE    (default 1200) أطول ضلع للنسخة المتوسطة
+- DERIVATIVE_WEBP_QUALITY   (default 80)
+"""
+
+import logging
+import os
+import posixpath
+import time
+from typing import Dict
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("backend.derivatives")
+
+DERIVATIVE_SMALL_SIDE = int(os.getenv("DERIVATIVE_SMALL_SIDE", "400"))
+DERIVATIVE_MEDIUM_SIDE = int(os.getenv("DERIVATIVE_MEDIUM_SIDE", "1200"))
+DERIVATIVE_WEBP_QUALITY = int(os.getenv("DERIVATIVE_WEBP_QUALITY", "80"))
+
+# Largest first: each rendition is resized from the previous one (fewer source pixels to read)
+RENDITIONS = {"medium": DERIVATIVE_MEDIUM_SIDE, "small": DERIVATIVE_SMALL_SIDE}
+DERIVATIVE_CONTENT_TYPE = "image/webp"
+
+
+def derivative_path(storage_path: str, name: str) -> str:
+    """Storage key of a rendition next to its original: ab/<sha>.jpg → ab/<sha>_small.webp"""
+    stem, _ = posixpath.splitext(storage_path)
+    return f"{stem}_{name}.webp"
+
+
+def make_derivatives(img: np.ndarray, timings: dict | None = None, rgb: bool = False) -> Dict[str, bytes]:
+    """
+    Encode the WebP renditions of an image already in memory.
+
+    Args:
+        img: BGR array (or RGB with rgb=True - e.g. a PDF pixmap)
+        timings (dict): اختياري - derivatives
+
+    Returns:
+        {"medium": webp bytes, "small": webp bytes} (renditions that fail to encode are left out)
+    """
+    t0 = time.perf_counter()
+    renditions: Dict[str, bytes] = {}
+    current = img
+    for name, max_side in RENDITIONS.items():
+        h, w = current.shape[:2]
+        scale = max_side / max(h, w)
+        if scale < 1.0:
+            current = cv2.resize(current, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                 interpolation=cv2.INTER_AREA)
+        out = cv2.cvtColor(current, cv2.COLOR_RGB2BGR) if rgb else current
+        success, encoded = cv2.imencode(".webp", out, [cv2.IMWRITE_WEBP_QUALITY, DERIVATIVE_WEBP_QUALITY])
+        if success:
+            renditions[name] = encoded.tobytes()
+        else:
+            logger.warning(f"⚠️ Failed to encode {name} rendition")
+    if timings is not None:
+        timings["derivatives"] = time.perf_counter() - t0
+    return renditions
+
+
+def make_derivatives_from_bytes(image_bytes: bytes, timings: dict | None = None) -> Dict[str, bytes]:
+    """Decode (at reduced resolution when the source is much larger than the renditions) and derive."""
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    # Halving in the JPEG decoder is far cheaper than decoding full size and resizing
+    img = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_COLOR_2)
+    if img is None or max(img.shape[:2]) < DERIVATIVE_MEDIUM_SIDE:
+        img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if img is None:
+        logger.error("❌ Failed to decode image for derivatives")
+        return {}
+    return make_derivatives(img, timings)
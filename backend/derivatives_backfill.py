@@ -0,0 +1,156 @@
+"""
+🖼️ Derivatives Backfill CLI
+===========================
+توليد النسخ المصغّرة (WebP) للفواتير المخزنة قبل إضافة الـ derivatives عند الرفع.
+
+Features:
+- يختار كل image_url بدون thumbnail_url (من invoices و uploaded_files)، مرة واحدة لكل رابط
+- يقرأ الصورة من الـ storage backend الحالي (أو عبر HTTP إذا كان الرابط خارجه)
+- فك الترميز والتصغير في ProcessPoolExecutor، والقراءة/الرفع في threads
+- آمن لإعادة التشغيل: الصفوف التي لها thumbnail_url تُتخطى
+
+Usage:
+    python -m backend.derivatives_backfill
+    python -m backend.derivatives_backfill --limit 100 --workers 8
+    python -m backend.derivatives_backfill --dry-run
+"""
+
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from backend.database import SessionLocal
+from backend.derivatives import DERIVATIVE_CONTENT_TYPE, derivative_path, make_derivatives_from_bytes
+from backend.models.invoice_model import Invoice
+from backend.models.upload_model import UploadedFile
+from backend.storage import StorageBackend, get_storage
+from backend.upload_index import set_derivatives
+
+logger = logging.getLogger("backend.derivatives_backfill")
+
+
+# ================================================================
+# 📥 What needs derivatives
+# ================================================================
+def pending_images(limit: Optional[int] = None) -> List[Tuple[str, Optional[str]]]:
+    """
+    Image URLs that have no thumbnail yet, with their storage key when it is known.
+
+    Returns:
+        [(image_url, storage_path or None)] - uploads first (their key is recorded), then older invoices
+    """
+    db = SessionLocal()
+    try:
+        pending: Dict[str, Optional[str]] = {}
+        for url, path in db.query(UploadedFile.url, UploadedFile.storage_path).filter(
+            UploadedFile.thumbnail_url.is_(None), UploadedFile.url.isnot(None)
+        ):
+            pending[url] = path
+        for (url,) in db.query(Invoice.image_url).filter(
+            Invoice.thumbnail_url.is_(None), Invoice.image_url.isnot(None), Invoice.image_url != ""
+        ).distinct():
+            pending.setdefault(url, None)
+    finally:
+        db.close()
+    items = list(pending.items())
+    return items[:limit] if limit else items
+
+
+def storage_key_for(storage: StorageBackend, image_url: str, storage_path: Optional[str]) -> Optional[str]:
+    """The key inside the current backend, or None when the URL points somewhere else."""
+    if storage_path:
+        return storage_path
+    return storage.key_for_url(image_url)
+
+
+# ================================================================
+# 👷 One image
+# ================================================================
+def _derive_worker(image_bytes: bytes) -> Dict[str, bytes]:
+    """Runs in a pool process."""
+    return make_derivatives_from_bytes(image_bytes)
+
+
+def _backfill_one(storage: StorageBackend, pool: ProcessPoolExecutor, http: httpx.Client,
+                  image_url: str, storage_path: Optional[str], dry_run: bool) -> str:
+    key = storage_key_for(storage, image_url, storage_path)
+    if key is not None:
+        image_bytes = storage.get(key)
+    else:
+        response = http.get(image_url)
+        response.raise_for_status()
+        image_bytes = response.content
+        # Outside our storage: park the renditions under a key derived from the URL
+        url_hash = hashlib.sha256(image_url.encode()).hexdigest()
+        key = f"backfill/{url_hash[:2]}/{url_hash}.jpg"
+
+    renditions = pool.submit(_derive_worker, image_bytes).result()
+    if "small" not in renditions:
+        raise ValueError("could not decode/encode image")
+    if dry_run:
+        return "dry-run"
+
+    urls = {
+        name: storage.put(derivative_path(key, name), data, DERIVATIVE_CONTENT_TYPE)
+        for name, data in renditions.items()
+    }
+    db = SessionLocal()
+    try:
+        set_derivatives(db, image_url, urls["small"], urls.get("medium"))
+    finally:
+        db.close()
+    return "done"
+
+
+def run_backfill(items: List[Tuple[str, Optional[str]]], workers: int, dry_run: bool) -> Dict[str, int]:
+    storage = get_storage()
+    counts = {"done": 0, "dry-run": 0, "failed": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+            ThreadPoolExecutor(max_workers=workers * 2) as io_pool, \
+            httpx.Client(timeout=30.0, follow_redirects=True) as http:
+        futures = {
+            io_pool.submit(_backfill_one, storage, pool, http, url, path, dry_run): url
+            for url, path in items
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            url = futures[future]
+            try:
+                counts[future.result()] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                logger.error(f"❌ {url}: {e}")
+            if i % 50 == 0 or i == len(items):
+                elapsed = time.perf_counter() - start
+                print(f"   {i}/{len(items)} ({i / elapsed:.1f} images/s)")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate WebP thumbnails for invoices stored before derivatives existed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--limit", type=int, default=None, help="process at most N images")
+    parser.add_argument("--dry-run", action="store_true", help="fetch and encode, but don't store or update rows")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    items = pending_images(args.limit)
+    if not items:
+        print("✅ Every image already has a thumbnail")
+        return
+    print(f"🖼️ Generating derivatives for {len(items)} images with {args.workers} workers...")
+    counts = run_backfill(items, args.workers, args.dry_run)
+    print(f"✅ done={counts['done']} dry_run={counts['dry-run']} failed={counts['failed']}")
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
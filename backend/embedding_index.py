@@ -0,0 +1,287 @@
+"""
+🧮 In-Memory Embedding Index
+============================
+محرك بحث دلالي داخل العملية (بدون pgvector) للبيئات البسيطة والاختبارات.
+
+Features:
+- مصفوفة float32 متصلة (contiguous) لكل صفوف invoice_embeddings، مُطبَّعة (L2-normalized)
+- استعلام top-k بعملية ضرب مصفوفات واحدة + argpartition
+- إضافة الـ embeddings الجديدة تدريجياً (من generate_embedding)
+- حفظ/تحميل اختياري من القرص عبر memory-map لمشاركة المصفوفة بين عمليات الـ workers
+- قبل البحث: مزامنة تدريجية من قاعدة البيانات (الصفوف بعد آخر id تمت مزامنته) كل
+  EMBEDDING_INDEX_SYNC_SECONDS، فما يضيفه worker آخر يظهر هنا أيضاً، ثم تُحدَّث النسخة على القرص
+
+Configuration:
+- RAG_ENGINE=memory          → execute_rag يستخدم هذا الفهرس بدل pgvector
+- EMBEDDING_INDEX_PATH=/dir  → حفظ المصفوفة في .npy وتحميلها بـ mmap_mode="r"
+- EMBEDDING_INDEX_SYNC_SECONDS (default 5) أقل فاصل بين مزامنتين من قاعدة البيانات (0 = قبل كل بحث)
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from backend.vector_index import EMBEDDING_DIM
+
+logger = logging.getLogger("backend.embedding_index")
+
+EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH")
+EMBEDDING_INDEX_SYNC_SECONDS = float(os.getenv("EMBEDDING_INDEX_SYNC_SECONDS", "5"))
+_INITIAL_CAPACITY = 1024
+
+
+def _parse_embedding(value) -> np.ndarray:
+    """pgvector may return a numpy array, a list, or the '[0.1,...]' text form"""
+    if isinstance(value, str):
+        return np.array(json.loads(value), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class InMemoryEmbeddingIndex:
+    """
+    Contiguous float32 matrix of L2-normalized embeddings + parallel id arrays.
+
+    Cosine similarity of all rows against a query is a single `matrix @ query`.
+    Capacity doubles on append (amortized O(1)) so new rows don't reallocate every time.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._row_ids = np.empty(0, dtype=np.int64)      # invoice_embeddings.id
+        self._invoice_ids = np.empty(0, dtype=np.int64)  # invoice_embeddings.invoice_id
+        self._size = 0
+        # Highest row id pulled from the DB: every row up to it is in the index. Rows this
+        # process added itself can be newer (ids from other workers may still be missing
+        # below them), so they are tracked apart and skipped by the next sync.
+        self.synced_row_id = 0
+        self._local_row_ids = set()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def max_row_id(self) -> int:
+        return int(self._row_ids[: self._size].max()) if self._size else 0
+
+    # ------------------------------------------------------------
+    # ➕ Append
+    # ------------------------------------------------------------
+    def _reserve(self, extra: int):
+        needed = self._size + extra
+        capacity = self._matrix.shape[0]
+        # mmap-loaded arrays are read-only: the first append copies them into RAM
+        if needed <= capacity and self._matrix.flags.writeable:
+            return
+        new_capacity = max(_INITIAL_CAPACITY, capacity * 2, needed)
+        matrix = np.empty((new_capacity, self.dim), dtype=np.float32)
+        row_ids = np.empty(new_capacity, dtype=np.int64)
+        invoice_ids = np.empty(new_capacity, dtype=np.int64)
+        matrix[: self._size] = self._matrix[: self._size]
+        row_ids[: self._size] = self._row_ids[: self._size]
+        invoice_ids[: self._size] = self._invoice_ids[: self._size]
+        self._matrix, self._row_ids, self._invoice_ids = matrix, row_ids, invoice_ids
+
+    def add_many(self, row_ids: Sequence[int], invoice_ids: Sequence[int], embeddings: np.ndarray):
+        """Append a batch of embeddings (shape: n × dim)"""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        n = embeddings.shape[0]
+        if n == 0:
+            return
+        with self._lock:
+            self._reserve(n)
+            self._matrix[self._size: self._size + n] = _normalize(embeddings)
+            self._row_ids[self._size: self._size + n] = row_ids
+            self._invoice_ids[self._size: self._size + n] = invoice_ids
+            self._size += n
+
+    def add(self, row_id: int, invoice_id: int, embedding: Sequence[float]):
+        """Append a single embedding (called after generate_embedding commits)"""
+        with self._lock:
+            if row_id <= self.synced_row_id or row_id in self._local_row_ids:
+                return
+            self.add_many([row_id], [invoice_id], _parse_embedding(embedding)[None, :])
+            self._local_row_ids.add(row_id)
+
+    # ------------------------------------------------------------
+    # 🔍 Search
+    # ------------------------------------------------------------
+    def search(self, query_embedding: Sequence[float], top_k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Return [(invoice_id, similarity), ...] sorted by similarity (best first).
+        One matrix-vector product + argpartition; best score kept per invoice.
+        """
+        with self._lock:
+            size = self._size
+            matrix = self._matrix[:size]
+            invoice_ids = self._invoice_ids[:size]
+        if size == 0 or top_k <= 0:
+            return []
+
+        query = _normalize(_parse_embedding(query_embedding))
+        scores = matrix @ query
+
+        k = min(top_k, size)
+        if k < size:
+            candidates = np.argpartition(scores, -k)[-k:]
+        else:
+            candidates = np.arange(size)
+        candidates = candidates[np.argsort(scores[candidates])[::-1]]
+
+        results, seen = [], set()
+        for idx in candidates:
+            invoice_id = int(invoice_ids[idx])
+            if invoice_id in seen:
+                continue  # more than one embedding for the same invoice
+            seen.add(invoice_id)
+            results.append((invoice_id, float(scores[idx])))
+        return results
+
+    # ------------------------------------------------------------
+    # 💾 Persistence (memory-mapped)
+    # ------------------------------------------------------------
+    def save(self, directory: str):
+        """Write matrix + ids as .npy files atomically (tmp file → os.replace)"""
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            arrays = {
+                "matrix": self._matrix[: self._size],
+                "row_ids": self._row_ids[: self._size],
+                "invoice_ids": self._invoice_ids[: self._size],
+            }
+            meta = {"synced_row_id": self.synced_row_id}
+        # Several workers may save at once: per-process tmp names, each file replaced atomically
+        for name, array in arrays.items():
+            tmp = path / f"{name}.npy.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp, path / f"{name}.npy")
+        tmp = path / f"meta.json.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, path / "meta.json")
+        logger.info(f"💾 Saved embedding index ({self._size:,} rows) to {path}")
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> Optional["InMemoryEmbeddingIndex"]:
+        """Load a saved index; with mmap=True the matrix pages are shared between processes"""
+        path = Path(directory)
+        if not (path / "matrix.npy").exists():
+            return None
+        mode = "r" if mmap else None
+        index = cls()
+        index._matrix = np.load(path / "matrix.npy", mmap_mode=mode)
+        index._row_ids = np.load(path / "row_ids.npy")
+        index._invoice_ids = np.load(path / "invoice_ids.npy")
+        index._size = index._matrix.shape[0]
+        index.dim = index._matrix.shape[1] if index._size else EMBEDDING_DIM
+        if index._size != len(index._row_ids):
+            logger.warning(f"⚠️ Embedding index files in {path} are out of step (concurrent save?), rebuilding")
+            return None
+        meta_path = path / "meta.json"
+        meta = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+        index.synced_row_id = int(meta.get("synced_row_id", index.max_row_id))
+        index._local_row_ids = {int(i) for i in index._row_ids[: index._size] if i > index.synced_row_id}
+        logger.info(f"📂 Loaded embedding index ({index._size:,} rows, mmap={mmap}) from {path}")
+        return index
+
+    # ------------------------------------------------------------
+    # 🔄 Sync from database
+    # ------------------------------------------------------------
+    def sync_from_db(self, db: Session, batch_size: int = 5000) -> int:
+        """Pull only rows newer than synced_row_id (full load when empty). Returns rows added."""
+        added = 0
+        last_id = self.synced_row_id
+        while True:
+            rows = db.execute(
+                text("""
+                    SELECT id, invoice_id, embedding
+                    FROM invoice_embeddings
+                    WHERE id > :last_id AND embedding IS NOT NULL
+                    ORDER BY id
+                    LIMIT :batch
+                """),
+                {"last_id": last_id, "batch": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            with self._lock:
+                new = [r for r in rows if r.id not in self._local_row_ids]
+                if new:
+                    self.add_many(
+                        [r.id for r in new],
+                        [r.invoice_id for r in new],
+                        np.stack([_parse_embedding(r.embedding) for r in new]),
+                    )
+                self.synced_row_id = last_id
+                self._local_row_ids = {i for i in self._local_row_ids if i > last_id}
+            added += len(new)
+        if added:
+            logger.info(f"🔄 Embedding index synced: +{added:,} rows (total {self._size:,})")
+        return added
+
+
+# ================================================================
+# 🌐 Process-wide instance
+# ================================================================
+_index: Optional[InMemoryEmbeddingIndex] = None
+_index_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_last_sync = 0.0
+
+
+def _sync(index: InMemoryEmbeddingIndex, db: Session) -> int:
+    """Incremental DB sync; the snapshot on disk is refreshed whenever rows were added."""
+    global _last_sync
+    added = index.sync_from_db(db)
+    _last_sync = time.monotonic()
+    if EMBEDDING_INDEX_PATH and added:
+        index.save(EMBEDDING_INDEX_PATH)
+    return added
+
+
+def get_embedding_index(db: Session) -> InMemoryEmbeddingIndex:
+    """
+    The process-wide index: mmap from EMBEDDING_INDEX_PATH if present on first use, then
+    pull rows added since (by this or any other worker) at most every EMBEDDING_INDEX_SYNC_SECONDS.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = InMemoryEmbeddingIndex.load(EMBEDDING_INDEX_PATH) if EMBEDDING_INDEX_PATH else None
+            index = index or InMemoryEmbeddingIndex()
+            _sync(index, db)
+            _index = index
+            return _index
+
+    # Another request already syncing → search with what we have instead of waiting
+    if time.monotonic() - _last_sync >= EMBEDDING_INDEX_SYNC_SECONDS and _sync_lock.acquire(blocking=False):
+        try:
+            _sync(_index, db)
+        except Exception as e:
+            logger.warning(f"⚠️ Embedding index sync failed: {e}")
+        finally:
+            _sync_lock.release()
+    return _index
+
+
+def add_to_embedding_index(row_id: int, invoice_id: int, embedding: Sequence[float]):
+    """Append a new embedding if the index is already loaded (no-op otherwise)"""
+    if _index is not None:
+        _index.add(row_id, invoice_id, embedding)
@@ -0,0 +1,199 @@
+"""
+🌐 Friendli Async HTTP Client
+=============================
+عميل HTTP غير متزامن ومشترك لاستدعاءات FriendliAI (VLM).
+
+Features:
+- اتصال واحد مشترك (keep-alive pooling) بدل فتح اتصال جديد لكل طلب
+- مهلات اتصال/قراءة قابلة للضبط (بدل الانتظار بلا حد)
+- حد أعلى لعدد الطلبات المتزامنة للنموذج (Semaphore)
+- لا يحجب الـ event loop أثناء الاستدلال (10–60 ثانية)
+- وضع البث (stream: true): النص يصل على دفعات، وإغلاق المولّد يقطع الاتصال بالنموذج
+- deadline + retry + circuit breaker (+ hedging اختياري) عبر backend/resilience.py (friendli_policy)
+
+Configuration:
+- FRIENDLI_CONNECT_TIMEOUT   (seconds, default 10)
+- FRIENDLI_READ_TIMEOUT      (seconds, default 120)
+- FRIENDLI_MAX_CONNECTIONS   (default 50)
+- FRIENDLI_MAX_KEEPALIVE     (default 20)
+- FRIENDLI_MAX_CONCURRENCY   (default 16)
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+from typing import AsyncIterator, Optional
+
+import httpx
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from backend.rate_limiter import parse_retry_after
+from backend.resilience import friendli_policy
+
+load_dotenv()
+logger = logging.getLogger("backend.friendli_client")
+
+FRIENDLI_TOKEN = os.getenv("FRIENDLI_TOKEN")
+FRIENDLI_URL = os.getenv("FRIENDLI_URL", "https://api.friendli.ai/dedicated/v1/chat/completions")
+FRIENDLI_MODEL_ID = os.getenv("FRIENDLI_MODEL_ID", "dep021qh0vlii5d")
+
+FRIENDLI_CONNECT_TIMEOUT = float(os.getenv("FRIENDLI_CONNECT_TIMEOUT", "10"))
+FRIENDLI_READ_TIMEOUT = float(os.getenv("FRIENDLI_READ_TIMEOUT", "120"))
+FRIENDLI_MAX_CONNECTIONS = int(os.getenv("FRIENDLI_MAX_CONNECTIONS", "50"))
+FRIENDLI_MAX_KEEPALIVE = int(os.getenv("FRIENDLI_MAX_KEEPALIVE", "20"))
+FRIENDLI_MAX_CONCURRENCY = int(os.getenv("FRIENDLI_MAX_CONCURRENCY", "16"))
+
+
+class FriendliRateLimitError(HTTPException):
+    """429 from Friendli; `retry_after` is in seconds (from the Retry-After header)"""
+
+    def __init__(self, retry_after: float, detail: str):
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": str(math.ceil(retry_after))})
+        self.retry_after = retry_after
+
+
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_friendli_client() -> httpx.AsyncClient:
+    """Return the shared AsyncClient (created lazily on first use)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {FRIENDLI_TOKEN}",
+                "Content-Type": "application/json",
+            },
+            timeout=httpx.Timeout(
+                connect=FRIENDLI_CONNECT_TIMEOUT,
+                read=FRIENDLI_READ_TIMEOUT,
+                write=FRIENDLI_CONNECT_TIMEOUT,
+                pool=FRIENDLI_READ_TIMEOUT,
+            ),
+            limits=httpx.Limits(
+                max_connections=FRIENDLI_MAX_CONNECTIONS,
+                max_keepalive_connections=FRIENDLI_MAX_KEEPALIVE,
+            ),
+        )
+        logger.info(
+            f"🌐 Friendli client ready (connect={FRIENDLI_CONNECT_TIMEOUT}s, read={FRIENDLI_READ_TIMEOUT}s, "
+            f"max_concurrency={FRIENDLI_MAX_CONCURRENCY})"
+        )
+    return _client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(FRIENDLI_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def close_friendli_client():
+    """Close pooled connections (called on app shutdown)"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logger.info("🔌 Friendli client closed")
+    _client = None
+
+
+class FriendliUpstreamError(HTTPException):
+    """Non-200/429 response from Friendli; `upstream_status` decides whether it is retried (5xx) or not (4xx)"""
+
+    def __init__(self, upstream_status: int, detail: str):
+        super().__init__(status_code=500, detail=detail)
+        self.upstream_status = upstream_status
+
+
+def _raise_for_status(response: httpx.Response, body: str):
+    if response.status_code == 429:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        logger.warning(f"🚦 Friendli rate limited, retry after {retry_after:.1f}s")
+        raise FriendliRateLimitError(retry_after, f"Friendli API rate limited: {body}")
+    if response.status_code != 200:
+        raise FriendliUpstreamError(response.status_code, f"Friendli API error ({response.status_code}): {body}")
+
+
+async def _post_once(payload: dict) -> dict:
+    client = get_friendli_client()
+    try:
+        response = await client.post(FRIENDLI_URL, json=payload)
+    except httpx.TimeoutException as e:
+        logger.error(f"⏱️ Friendli API timeout: {e!r}")
+        raise HTTPException(status_code=504, detail=f"Friendli API timeout: {e!r}")
+    _raise_for_status(response, response.text)
+    return response.json()
+
+
+async def post_chat_completion(payload: dict) -> dict:
+    """
+    POST a chat-completions payload to Friendli and return the JSON body.
+
+    Each attempt has a deadline (FRIENDLI_DEADLINE_SECONDS); timeouts, dropped connections and
+    5xx are retried with jittered backoff, and while the circuit is open the call fails fast.
+
+    Raises:
+        FriendliRateLimitError(429) when throttled (not retried here - the caller honours Retry-After),
+        HTTPException(504) on timeout, CircuitOpenError(503) while the provider is degraded,
+        FriendliUpstreamError(500) on any other non-200 response
+    """
+    async with _get_semaphore():
+        return await friendli_policy.acall(_post_once, payload)
+
+
+async def _stream_once(payload: dict, stats: dict) -> AsyncIterator[str]:
+    client = get_friendli_client()
+    try:
+        async with client.stream("POST", FRIENDLI_URL, json={**payload, "stream": True}) as response:
+            if response.status_code != 200:
+                _raise_for_status(response, (await response.aread()).decode("utf-8", "replace"))
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    stats["completion_tokens"] = chunk["usage"].get("completion_tokens")
+                stats["deltas"] = stats.get("deltas", 0) + 1
+                for choice in chunk.get("choices") or []:
+                    if choice.get("finish_reason"):
+                        stats["finish_reason"] = choice["finish_reason"]
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+    except httpx.TimeoutException as e:
+        logger.error(f"⏱️ Friendli API timeout: {e!r}")
+        raise HTTPException(status_code=504, detail=f"Friendli API timeout: {e!r}")
+
+
+async def stream_chat_completion(payload: dict, stats: Optional[dict] = None) -> AsyncIterator[str]:
+    """
+    POST with `stream: true` and yield the content deltas as they arrive (SSE `data:` lines).
+
+    Closing the generator early (e.g. the client disconnected and the task was cancelled)
+    exits the `client.stream` block, which closes the upstream connection and aborts inference.
+    Retries (and the deadline) only cover the time to the first delta - nothing is replayed
+    once text has reached the caller.
+
+    Args:
+        stats (dict): اختياري - يُملأ بـ finish_reason و completion_tokens (إن أرسلها المزود)
+
+    Raises:
+        the same errors as post_chat_completion, before the first delta
+    """
+    stats = stats if stats is not None else {}
+    async with _get_semaphore():
+        stream = friendli_policy.astream(_stream_once, payload, stats)
+        try:
+            async for content in stream:
+                yield content
+        finally:
+            await stream.aclose()
@@ -0,0 +1,308 @@
+"""
+📬 Analysis Job Queue
+=====================
+طابور مهام غير متزامن لتحليل الفواتير (VLM + حفظ + embedding).
+
+بدلاً من إبقاء طلب HTTP مفتوحاً طوال الاستدلال:
+- POST /vlm/jobs           → يُنشئ مهمة ويرجع job_id فوراً
+- GET  /vlm/jobs/{id}      → حالة المهمة ونتيجتها
+- GET  /vlm/jobs/{id}/events → SSE stream للتقدّم
+
+التخزين:
+- المهام محفوظة في جدول vlm_jobs (نفس قاعدة البيانات)، فلا تضيع عند إعادة التشغيل
+- الـ workers يحجزون المهام بـ SELECT ... FOR UPDATE SKIP LOCKED (آمن مع عدة عمليات)
+- المهمة الجارية تحدّث updated_at دورياً (heartbeat)؛ والمهام العالقة في running بدون تحديث
+  لأكثر من VLM_JOB_STALE_SECONDS (worker مات) تعود إلى queued - يُفحص دورياً من حلقة الـ workers،
+  والمقارنة بساعة قاعدة البيانات (now() - interval) وليس بساعة التطبيق
+
+Configuration:
+- VLM_JOB_WORKERS         (default 4)   عدد الـ workers في كل عملية
+- VLM_JOB_MAX_QUEUED      (default 1000) رفض مهام جديدة (503) عند الامتلاء
+- VLM_JOB_POLL_SECONDS    (default 2)
+- VLM_JOB_STALE_SECONDS   (default 600)
+- VLM_JOB_REQUEUE_SECONDS (default 60)  كل كم ثانية يُفحص عن المهام العالقة
+- VLM_JOB_MAX_ATTEMPTS    (default 3)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func
+
+from backend.database import SessionLocal
+from backend.models.job_model import AnalysisJob
+
+logger = logging.getLogger("backend.job_queue")
+
+VLM_JOB_WORKERS = int(os.getenv("VLM_JOB_WORKERS", "4"))
+VLM_JOB_MAX_QUEUED = int(os.getenv("VLM_JOB_MAX_QUEUED", "1000"))
+VLM_JOB_POLL_SECONDS = float(os.getenv("VLM_JOB_POLL_SECONDS", "2"))
+VLM_JOB_STALE_SECONDS = int(os.getenv("VLM_JOB_STALE_SECONDS", "600"))
+VLM_JOB_MAX_ATTEMPTS = int(os.getenv("VLM_JOB_MAX_ATTEMPTS", "3"))
+VLM_JOB_REQUEUE_SECONDS = float(os.getenv("VLM_JOB_REQUEUE_SECONDS", "60"))
+
+# handler(job, set_stage) -> result dict
+JobHandler = Callable[[Dict[str, Any], Callable[[str], Awaitable[None]]], Awaitable[Dict[str, Any]]]
+
+
+class QueueFullError(Exception):
+    """Raised when VLM_JOB_MAX_QUEUED jobs are already waiting"""
+
+
+class NonRetryableJobError(Exception):
+    """Raised by a handler when running the job again would not help (e.g. unparseable output)"""
+
+
+def job_to_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public view of a job row (result JSON decoded)"""
+    result = job.get("result")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": job.get("stage"),
+        "attempts": job.get("attempts", 0),
+        "result": json.loads(result) if result else None,
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "updated_at": job["updated_at"].isoformat() if job.get("updated_at") else None,
+    }
+
+
+class AnalysisJobQueue:
+    """Postgres-backed job table + a bounded pool of asyncio workers per process."""
+
+    def __init__(self, handler: JobHandler, workers: int = VLM_JOB_WORKERS):
+        self.handler = handler
+        self.worker_count = workers
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._listeners: Dict[str, List[asyncio.Event]] = {}
+        self._last_requeue = 0.0
+
+    # ------------------------------------------------------------
+    # 🗄️ DB helpers (blocking → run in threadpool)
+    # ------------------------------------------------------------
+    def _insert_job(self, image_url: str, prompt: Optional[str],
+                    page_urls: Optional[List[str]] = None) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            queued = db.query(AnalysisJob).filter(AnalysisJob.status == "queued").count()
+            if queued >= VLM_JOB_MAX_QUEUED:
+                raise QueueFullError(f"{queued} jobs already queued")
+            job = AnalysisJob(id=uuid.uuid4().hex, status="queued", stage="queued",
+                              image_url=image_url, prompt=prompt, attempts=0,
+                              page_urls=json.dumps(page_urls) if page_urls else None)
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+            return job.to_dict()
+        finally:
+            db.close()
+
+    def _get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+            return job.to_dict() if job else None
+        finally:
+            db.close()
+
+    def _claim_next_job(self) -> Optional[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            job = (
+                db.query(AnalysisJob)
+                .filter(AnalysisJob.status == "queued")
+                .order_by(AnalysisJob.created_at)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if job is None:
+                db.rollback()
+                return None
+            job.status = "running"
+            job.stage = "starting"
+            job.attempts = (job.attempts or 0) + 1
+            db.commit()
+            db.refresh(job)
+            return job.to_dict()
+        finally:
+            db.close()
+
+    def _update_job(self, job_id: str, **fields):
+        db = SessionLocal()
+        try:
+            db.query(AnalysisJob).filter(AnalysisJob.id == job_id).update(
+                {**fields, "updated_at": func.now()}  # DB clock, same one the stale check uses
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _touch_job(self, job_id: str):
+        """Heartbeat: a job that is still running is not stale"""
+        db = SessionLocal()
+        try:
+            db.query(AnalysisJob).filter(AnalysisJob.id == job_id, AnalysisJob.status == "running").update(
+                {"updated_at": func.now()}, synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def record_invoice(self, job_id: str, invoice_id: int):
+        """
+        Blocking: remember the invoice a job has committed, so a retry of the job
+        (after a later step failed, or its worker died) doesn't insert it again.
+        """
+        self._update_job(job_id, invoice_id=invoice_id)
+
+    def _requeue_stale_jobs(self) -> int:
+        """Jobs left 'running' by a crashed/restarted process go back to the queue"""
+        db = SessionLocal()
+        try:
+            # Compared in SQL: app and DB clocks / time zones may differ
+            cutoff = func.now() - timedelta(seconds=VLM_JOB_STALE_SECONDS)
+            count = (
+                db.query(AnalysisJob)
+                .filter(AnalysisJob.status == "running", AnalysisJob.updated_at < cutoff)
+                .update({"status": "queued", "stage": "queued"}, synchronize_session=False)
+            )
+            db.commit()
+            return count
+        finally:
+            db.close()
+
+    # ------------------------------------------------------------
+    # 📣 Progress notifications (in-process, for SSE)
+    # ------------------------------------------------------------
+    def _notify(self, job_id: str):
+        for event in self._listeners.get(job_id, []):
+            event.set()
+
+    async def wait_for_update(self, job_id: str, timeout: float):
+        """Wait until this process reports progress for job_id (or timeout → caller re-reads DB)"""
+        event = asyncio.Event()
+        self._listeners.setdefault(job_id, []).append(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._listeners[job_id].remove(event)
+            if not self._listeners[job_id]:
+                del self._listeners[job_id]
+
+    # ------------------------------------------------------------
+    # 🚀 Public API
+    # ------------------------------------------------------------
+    async def enqueue(self, image_url: str, prompt: Optional[str] = None,
+                      page_urls: Optional[List[str]] = None) -> Dict[str, Any]:
+        job = await run_in_threadpool(self._insert_job, image_url, prompt, page_urls)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logger.info(f"📬 Job {job['id']} queued for {image_url}")
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await run_in_threadpool(self._get_job, job_id)
+
+    async def start(self):
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        await self._maybe_requeue_stale_jobs(force=True)
+        self._workers = [
+            asyncio.create_task(self._worker_loop(i), name=f"vlm-job-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        logger.info(f"👷 Started {self.worker_count} VLM job workers")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    # ------------------------------------------------------------
+    # 👷 Worker
+    # ------------------------------------------------------------
+    async def _maybe_requeue_stale_jobs(self, force: bool = False):
+        """Jobs claimed by a worker that died go back to the queue (at most every VLM_JOB_REQUEUE_SECONDS)"""
+        now = time.monotonic()
+        if not force and now - self._last_requeue < VLM_JOB_REQUEUE_SECONDS:
+            return
+        self._last_requeue = now
+        try:
+            requeued = await run_in_threadpool(self._requeue_stale_jobs)
+        except Exception as e:
+            logger.error(f"❌ Could not recover stale jobs: {e}")
+            return
+        if requeued:
+            logger.info(f"♻️ Re-queued {requeued} stale jobs")
+            self._wakeup.set()
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(max(1.0, VLM_JOB_STALE_SECONDS / 3))
+            try:
+                await run_in_threadpool(self._touch_job, job_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeat for job {job_id} failed: {e}")
+
+    async def _worker_loop(self, worker_id: int):
+        while True:
+            await self._maybe_requeue_stale_jobs()
+            try:
+                job = await run_in_threadpool(self._claim_next_job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Worker {worker_id} could not claim a job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=VLM_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job(job)
+
+    async def _run_job(self, job: Dict[str, Any]):
+        job_id = job["id"]
+
+        async def set_stage(stage: str):
+            await run_in_threadpool(self._update_job, job_id, stage=stage)
+            self._notify(job_id)
+
+        logger.info(f"👷 Running job {job_id} (attempt {job['attempts']})")
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            result = await self.handler(job, set_stage)
+            await run_in_threadpool(
+                self._update_job, job_id, status="done", stage="done",
+                result=json.dumps(result, ensure_ascii=False, default=str), error=None,
+            )
+            logger.info(f"✅ Job {job_id} done")
+        except asyncio.CancelledError:
+            # Shutting down: leave it for the next process
+            await run_in_threadpool(self._update_job, job_id, status="queued", stage="queued")
+            raise
+        except Exception as e:
+            retry = job["attempts"] < VLM_JOB_MAX_ATTEMPTS and not isinstance(e, NonRetryableJobError)
+            status = "queued" if retry else "error"
+            logger.error(f"❌ Job {job_id} failed ({'will retry' if retry else 'giving up'}): {e}")
+            await run_in_threadpool(self._update_job, job_id, status=status, stage=status, error=str(e))
+        finally:
+            heartbeat.cancel()
+            self._notify(job_id)
@@ -0,0 +1,207 @@
+"""
+🩹 Tolerant Incremental JSON Parser
+===================================
+استخراج ما يمكن من مخرجات الـ VLM بدلاً من رمي التحليل كاملاً عند فشل json.loads.
+
+- يتجاهل أي نص قبل أول "{" أو بعد نهاية الكائن (شرح، ```json ...)
+- إذا انقطع الرد: يُرجع الحقول المكتملة فقط، والمصفوفة المفتوحة (Items) بالعناصر المكتملة منها
+- حقل واحد تالف لا يُسقط بقية الحقول (كل حقل يُفك على حدة)
+- يعمل على دفعات (stream): feed(chunk) يُرجع الحقول والعناصر فور اكتمالها،
+  فتصل حقول الرأس قبل انتهاء قائمة Items
+
+Usage:
+    data, complete = salvage_json(raw_output)
+
+    parser = IncrementalJSONParser()
+    for chunk in stream:
+        for event in parser.feed(chunk):
+            ...  # ("field", key, value) / ("item", key, index, value)
+    data = parser.result()
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+_WHITESPACE = " \t\r\n"
+
+
+class _Missing:
+    """Marker for a slice that isn't valid JSON (None is a valid value)."""
+
+
+_MISSING = _Missing()
+
+
+class IncrementalJSONParser:
+    """
+    Single-pass scanner over the outermost JSON object.
+
+    It only tracks nesting, strings and the boundaries of top-level values and of the
+    elements of top-level arrays; each finished slice is decoded with json.loads.
+
+    Events:
+        ("field", key, value)        - a top-level key/value pair is complete
+        ("item", key, index, value)  - an element of the top-level array `key` is complete
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.started = False
+        self.finished = False
+        self.fields: Dict[str, Any] = {}
+        self.partial_arrays: Dict[str, List[Any]] = {}
+        self.streamed_arrays = set()  # top-level arrays whose elements were emitted as `item` events
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+        self._element_start: Optional[int] = None
+        self._object_start = 0
+
+    # ------------------------------------------------------------
+    # 🔁 Feeding
+    # ------------------------------------------------------------
+    def feed(self, chunk: str) -> List[tuple]:
+        """Consume more text; returns the events completed by it (in order)."""
+        self.buffer += chunk
+        events: List[tuple] = []
+        buf = self.buffer
+        while self.pos < len(buf) and not self.finished:
+            ch = buf[self.pos]
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self._object_start = self.pos
+                    self._stack.append("{")
+                    self._expect_key = True
+                self.pos += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._expect_key:
+                        self._key = self._decode(buf[self._string_start:self.pos + 1])
+                self.pos += 1
+                continue
+
+            depth = len(self._stack)
+            if ch == '"':
+                self._in_string = True
+                self._string_start = self.pos
+                self._mark_value_start(depth)
+            elif ch in "{[":
+                self._mark_value_start(depth)
+                self._stack.append(ch)
+            elif ch in "}]":
+                if depth == 2 and self._stack[-1] == "[" and ch == "]":
+                    self._finish_element(buf, events)
+                if self._stack:
+                    self._stack.pop()
+                if depth == 1:
+                    self._finish_field(buf, events)
+                    self.finished = True
+            elif ch == ":" and depth == 1:
+                self._expect_key = False
+            elif ch == ",":
+                if depth == 1:
+                    self._finish_field(buf, events)
+                    self._expect_key = True
+                elif depth == 2 and self._stack[-1] == "[":
+                    self._finish_element(buf, events)
+            elif ch not in _WHITESPACE:
+                self._mark_value_start(depth)
+            self.pos += 1
+        return events
+
+    def _mark_value_start(self, depth: int):
+        if depth == 1 and not self._expect_key and self._value_start is None:
+            self._value_start = self.pos
+        elif depth == 2 and self._stack[-1] == "[" and self._element_start is None:
+            self._element_start = self.pos
+
+    @staticmethod
+    def _decode(text: str):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return _MISSING
+
+    def _finish_field(self, buf: str, events: List[tuple]):
+        key, start = self._key, self._value_start
+        self._key, self._value_start, self._element_start = None, None, None
+        if not isinstance(key, str) or start is None:
+            return
+        value = self._decode(buf[start:self.pos].strip())
+        if value is _MISSING:
+            # e.g. a bare word; keep what the array already delivered, if it was one
+            if key in self.partial_arrays:
+                value = self.partial_arrays[key]
+            else:
+                return
+        self.partial_arrays.pop(key, None)
+        self.fields[key] = value
+        events.append(("field", key, value))
+
+    def _finish_element(self, buf: str, events: List[tuple]):
+        start, self._element_start = self._element_start, None
+        if start is None or not isinstance(self._key, str):
+            return
+        value = self._decode(buf[start:self.pos].strip())
+        if value is _MISSING:
+            return
+        items = self.partial_arrays.setdefault(self._key, [])
+        items.append(value)
+        self.streamed_arrays.add(self._key)
+        events.append(("item", self._key, len(items) - 1, value))
+
+    # ------------------------------------------------------------
+    # 📦 Results
+    # ------------------------------------------------------------
+    def result(self) -> Dict[str, Any]:
+        """Complete fields, plus any top-level array still open with the elements finished so far."""
+        data = dict(self.fields)
+        for key, items in self.partial_arrays.items():
+            data.setdefault(key, items)
+        return data
+
+    def strict_result(self) -> Optional[Dict[str, Any]]:
+        """The whole object through json.loads, if it closed and is valid JSON."""
+        if not self.finished:
+            return None
+        value = self._decode(self.buffer[self._object_start:self.pos])
+        return value if isinstance(value, dict) else None
+
+
+def salvage_json(text: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Parse the outermost JSON object of `text`, tolerating stray text and truncation.
+
+    Returns:
+        (data or None if nothing usable, complete) - complete=False means fields were salvaged
+    """
+    if not text:
+        return None, False
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    strict = parser.strict_result()
+    if strict is not None:
+        return strict, True
+    data = parser.result()
+    return (data or None), False
+
+
+async def iter_json_events(chunks):
+    """Async variant for streamed responses: yields parser events as text chunks (tokens) arrive."""
+    parser = IncrementalJSONParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
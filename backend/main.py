@@ -1,9 +1,17 @@
 # backend/main.py
 import logging
+import threading
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from backend.database import Base, engine
-from backend.routers import vlm, upload, chat, dashboard, invoices, items
+from backend.routers import vlm, upload, chat, dashboard, invoices, items, files
+from backend.vector_index import ensure_vector_index
+from backend.schema_upgrades import ensure_columns
+from backend.friendli_client import close_friendli_client
+from backend.vlm_cache import close_image_client
+from backend.resilience import resilience_snapshot
+from backend.autofix_pool import shutdown_executor
+from backend.upload_stream import UPLOAD_BATCH_MAX_BYTES, UploadSizeLimitMiddleware
 
 # --------------------------
 # Logging setup
@@ -20,6 +28,12 @@ app = FastAPI(
     description="Backend for analyzing invoices using Supabase + HuggingFace VLM",
 )
 
+# Reject oversized uploads (413) before the multipart body is buffered
+# (added before CORS so the 413 still carries CORS headers)
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=UPLOAD_BATCH_MAX_BYTES,
+                   paths=("/vlm/batch/upload",), what="Batch upload")
+
 # --------------------------
 # CORS Middleware
 # --------------------------
@@ -51,6 +65,11 @@ def health_check():
     """Health check endpoint for Railway"""
     return {"ok": True}
 
+@app.get("/resilience/metrics")
+def resilience_metrics():
+    """Retries, hedges and circuit-breaker state of the Friendli / OpenAI clients"""
+    return resilience_snapshot()
+
 # --------------------------
 # Routers
 # --------------------------
@@ -60,6 +79,7 @@ app.include_router(chat.router)
 app.include_router(dashboard.router)
 app.include_router(invoices.router)
 app.include_router(items.router)
+app.include_router(files.router)  # local-disk storage backend (STORAGE_BACKEND=local)
 
 # --------------------------
 # Startup event
@@ -76,3 +96,32 @@ def startup_event():
         logger.error(f"   Make sure DATABASE_URL is correct and Supabase is accessible")
         # Don't crash the app - let it start for debugging
         logger.warning("⚠️  Continuing startup without tables...")
+
+    # 🧱 Columns added to existing tables after they were created (create_all doesn't alter)
+    try:
+        ensure_columns(engine)
+    except Exception as e:
+        logger.error(f"❌ Schema upgrade failed: {e}")
+
+    # 🗂️ Vector index: create/re-tune in the background (CONCURRENTLY - doesn't block startup)
+    def _ensure_index():
+        try:
+            ensure_vector_index(engine)
+        except Exception as e:
+            logger.error(f"❌ Vector index check failed: {e}")
+
+    threading.Thread(target=_ensure_index, name="vector-index-startup", daemon=True).start()
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    logger.info("👷 Starting VLM job workers...")
+    await vlm.job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await vlm.job_queue.stop()
+    await close_friendli_client()
+    await close_image_client()
+    shutdown_executor()
@@ -0,0 +1,14 @@
+-- إضافة أعمدة النسخ المصغّرة (WebP) للعرض في لوحة التحكم والمحادثة
+-- الفواتير القديمة تُملأ بعد ذلك بـ: python -m backend.derivatives_backfill
+-- (تُطبَّق تلقائياً عند بدء التشغيل عبر backend/schema_upgrades.py؛ الملف للتشغيل اليدوي)
+
+ALTER TABLE invoices
+ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+
+ALTER TABLE uploaded_files
+ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+
+ALTER TABLE uploaded_files
+ADD COLUMN IF NOT EXISTS medium_url TEXT;
+
+COMMENT ON COLUMN invoices.thumbnail_url IS 'نسخة WebP مصغّرة من image_url للعرض في القوائم';
@@ -26,6 +26,7 @@ class Invoice(Base):
     ai_insight = Column(String)  # 🧠 NEW: for AI-generated insight text
     invoice_type = Column(String)  # نوع الفاتورة (مقهى، مطعم، صيدلية، تأمين، شراء)
     image_url = Column(String)  # رابط الصورة من Supabase
+    thumbnail_url = Column(String)  # 🖼️ نسخة WebP مصغّرة للعرض في القوائم
     is_valid_invoice = Column(Boolean, default=True)  # 🔍 هل الصورة فاتورة حقيقية؟
     created_at = Column(DateTime, default=func.now())
 
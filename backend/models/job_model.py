@@ -0,0 +1,24 @@
+# backend/models/job_model.py
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy.sql import func
+from backend.database import Base
+
+
+class AnalysisJob(Base):
+    __tablename__ = "vlm_jobs"
+
+    id = Column(String, primary_key=True)  # uuid4 hex
+    status = Column(String, index=True, default="queued")  # queued | running | done | error
+    stage = Column(String)  # queued → analyzing → saving → done
+    image_url = Column(String)
+    page_urls = Column(Text)  # JSON list of page images for multi-page PDFs (NULL = just image_url)
+    prompt = Column(Text)
+    result = Column(Text)  # JSON response (same shape as /vlm/analyze)
+    error = Column(Text)
+    invoice_id = Column(Integer)  # set as soon as the invoice row is committed → retries don't save it twice
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now(), index=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
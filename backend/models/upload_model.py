@@ -0,0 +1,24 @@
+# backend/models/upload_model.py
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.sql import func
+from backend.database import Base
+
+
+class UploadedFile(Base):
+    """Content-addressed index of stored uploads: SHA-256 of the original bytes → public URL(s)"""
+
+    __tablename__ = "uploaded_files"
+
+    sha256 = Column(String(64), primary_key=True)
+    url = Column(String, index=True)  # public URL of the (first page) image
+    page_urls = Column(Text)  # JSON list, ordered (multi-page PDFs)
+    storage_path = Column(String)
+    thumbnail_url = Column(String)  # small WebP rendition (backend/derivatives.py)
+    medium_url = Column(String)  # medium WebP rendition
+    content_type = Column(String)
+    size_bytes = Column(Integer)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="SET NULL"), nullable=True, index=True)
+    created_at = Column(DateTime, default=func.now())
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -0,0 +1,71 @@
+"""
+🪣 Token Bucket Rate Limiter
+============================
+جدولة الطلبات لمزوّد الـ VLM ضمن حد أقصى للطلبات في الدقيقة.
+
+- acquire() ينتظر حتى يتوفر token (بدون busy-wait)
+- pause(seconds) يوقف جميع المنتظرين (عند 429 / Retry-After من المزوّد)
+"""
+
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate_per_minute` tokens refill continuously, up to `burst`.
+    Shared by all tasks of one batch so the provider sees a smooth request rate.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: Optional[int] = None):
+        self.rate_per_second = max(rate_per_minute, 0.001) / 60.0
+        self.capacity = float(burst if burst is not None else max(1, int(rate_per_minute // 10)))
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.total_wait_seconds = 0.0
+        self.pauses = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate_per_second)
+        self._last_refill = now
+
+    async def acquire(self):
+        """Wait until a token is available (and any Retry-After pause is over), then take it."""
+        start = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate_per_second)
+        self.total_wait_seconds += time.monotonic() - start
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (provider said 429 / Retry-After)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + max(0.0, seconds))
+        self._tokens = 0.0
+        self.pauses += 1
+
+
+def parse_retry_after(value: Optional[str], default: float = 5.0) -> float:
+    """Retry-After is either delay-seconds or an HTTP-date."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return default
@@ -0,0 +1,390 @@
+"""
+🛡️ Resilience for External AI Calls
+===================================
+طبقة مشتركة لاستدعاءات Friendli و OpenAI (embeddings + chat completions):
+
+- Deadline لكل استدعاء: لا ينتظر أي طلب أكثر من حد محدد
+- Retry بتأخير أُسّي مع jitter (full jitter) للأخطاء العابرة فقط:
+  timeout، انقطاع الاتصال، 5xx من المزوّد. 4xx لا تُعاد، و 429 تُترك للمستدعي (Retry-After / TokenBucket)
+- Circuit breaker: بعد عدد من الإخفاقات المتتالية تُرفض الطلبات فوراً (503) لفترة،
+  ثم يُسمح بطلب تجريبي واحد (half-open) قبل العودة للوضع الطبيعي
+- Hedged requests (اختياري): إذا تأخر الرد أكثر من hedge_after يُرسل طلب ثانٍ ويؤخذ أسرع رد
+
+نسخة sync (call) للـ OpenAI SDK داخل الـ threadpool، ونسخة async (acall) لـ httpx.
+المقاييس: GET /resilience/metrics
+
+Configuration:
+- AI_RETRY_MAX_ATTEMPTS         (default 3)   إجمالي المحاولات
+- AI_RETRY_BASE_DELAY           (default 0.5) ثانية
+- AI_RETRY_MAX_DELAY            (default 8)
+- AI_BREAKER_FAILURE_THRESHOLD  (default 5)   إخفاقات متتالية لفتح الدائرة
+- AI_BREAKER_RESET_SECONDS      (default 30)
+- FRIENDLI_DEADLINE_SECONDS     (default 150) لكل محاولة VLM
+- OPENAI_DEADLINE_SECONDS       (default 30)  لكل محاولة OpenAI
+- FRIENDLI_HEDGE_AFTER_SECONDS  (default 0 = معطّل)
+- OPENAI_HEDGE_AFTER_SECONDS    (default 0 = معطّل)
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger("backend.resilience")
+
+AI_RETRY_MAX_ATTEMPTS = int(os.getenv("AI_RETRY_MAX_ATTEMPTS", "3"))
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", "0.5"))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "8"))
+AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "5"))
+AI_BREAKER_RESET_SECONDS = float(os.getenv("AI_BREAKER_RESET_SECONDS", "30"))
+FRIENDLI_DEADLINE_SECONDS = float(os.getenv("FRIENDLI_DEADLINE_SECONDS", "150"))
+OPENAI_DEADLINE_SECONDS = float(os.getenv("OPENAI_DEADLINE_SECONDS", "30"))
+FRIENDLI_HEDGE_AFTER_SECONDS = float(os.getenv("FRIENDLI_HEDGE_AFTER_SECONDS", "0"))
+OPENAI_HEDGE_AFTER_SECONDS = float(os.getenv("OPENAI_HEDGE_AFTER_SECONDS", "0"))
+
+_RETRYABLE_STATUS = {408, 500, 502, 503, 504}
+_TRANSIENT_NAMES = ("Timeout", "ConnectError", "ConnectionError", "RemoteProtocolError",
+                    "ReadError", "WriteError", "APIConnectionError", "InternalServerError")
+
+
+class CircuitOpenError(HTTPException):
+    """The provider is failing; calls are rejected without reaching it until `retry_after`."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(status_code=503,
+                         detail=f"{name} temporarily unavailable (circuit open), retry in {retry_after:.0f}s",
+                         headers={"Retry-After": str(math.ceil(retry_after))})
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self, name: str, seconds: float):
+        super().__init__(status_code=504, detail=f"{name} call exceeded its {seconds:.0f}s deadline")
+
+
+def upstream_status(exc: BaseException) -> Optional[int]:
+    """HTTP status of a provider error (httpx / OpenAI SDK / our own HTTPException subclasses)."""
+    for attr in ("upstream_status", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Worth retrying: timeouts, dropped connections, 5xx. Not 4xx, and not 429 (caller honours Retry-After)."""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, (DeadlineExceeded, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = upstream_status(exc)
+    if status is not None:
+        return status in _RETRYABLE_STATUS
+    return any(name in type(exc).__name__ for name in _TRANSIENT_NAMES)
+
+
+def counts_as_failure(exc: BaseException) -> bool:
+    """Breaker health: transient errors mean the provider is degraded; 4xx/429 don't."""
+    return is_transient(exc)
+
+
+# ================================================================
+# 🔌 Circuit breaker
+# ================================================================
+class CircuitBreaker:
+    """closed → (N consecutive failures) → open → (reset_seconds) → half-open → one probe → closed/open"""
+
+    def __init__(self, name: str, failure_threshold: int = AI_BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = AI_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.short_circuited = 0
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError instead of calling a provider that is known to be down.
+        Returns True when this call is the half-open probe (it must end in a verdict or release_probe).
+        """
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True  # this call is the probe
+                return True
+            self.short_circuited += 1
+            remaining = self.reset_seconds - (time.monotonic() - self._opened_at) if state == "open" else 1.0
+        raise CircuitOpenError(self.name, max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"✅ Circuit '{self.name}' closed again")
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            probe_failed = self._probe_in_flight
+            self._probe_in_flight = False
+            if probe_failed or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opens += 1
+                logger.warning(f"🔌 Circuit '{self.name}' OPEN after {self._failures} failures "
+                               f"(fail fast for {self.reset_seconds:.0f}s)")
+
+    def release_probe(self):
+        """A probe that ended without a verdict (400/429, cancelled, interrupted) frees the slot."""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+# ================================================================
+# 🛡️ Policy: deadline + retry + breaker + hedging
+# ================================================================
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+class ResiliencePolicy:
+    def __init__(self, name: str, deadline: float, max_attempts: int = AI_RETRY_MAX_ATTEMPTS,
+                 base_delay: float = AI_RETRY_BASE_DELAY, max_delay: float = AI_RETRY_MAX_DELAY,
+                 hedge_after: float = 0.0, breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker(name)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform(0, min(max_delay, base × 2^attempt))"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _count(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _settle(self, exc: Optional[BaseException], probe: bool):
+        """Feed the outcome of one attempt to the breaker."""
+        if exc is None:
+            self.breaker.record_success()
+        elif counts_as_failure(exc):
+            self.breaker.record_failure()
+        elif probe:
+            self.breaker.release_probe()
+
+    def _retry_or_raise(self, exc: BaseException, attempt: int) -> float:
+        if not is_transient(exc) or attempt == self.max_attempts - 1:
+            self._count("failures")
+            raise exc
+        delay = self.backoff(attempt)
+        self._count("retries")
+        logger.warning(f"🔁 {self.name} attempt {attempt + 1}/{self.max_attempts} failed ({exc!r}), "
+                       f"retrying in {delay:.2f}s")
+        return delay
+
+    # ------------------------------------------------------------
+    # sync (OpenAI SDK, runs in the threadpool)
+    # ------------------------------------------------------------
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        fn(*args, **kwargs) with breaker, retries and optional hedging.
+        fn must honour its own deadline (pass timeout=policy.deadline to the SDK call).
+        """
+        self._count("calls")
+        for attempt in range(self.max_attempts):
+            probe = self.breaker.before_call()
+            try:
+                result = self._hedged_sync(fn, *args, **kwargs) if self.hedge_after > 0 else fn(*args, **kwargs)
+            except Exception as exc:
+                self._settle(exc, probe)
+                time.sleep(self._retry_or_raise(exc, attempt))
+                continue
+            except BaseException:
+                # KeyboardInterrupt / SystemExit: no verdict, but the probe slot must not leak
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            self._settle(None, probe)
+            self._count("successes")
+            return result
+
+    def _hedged_sync(self, fn, *args, **kwargs):
+        first = _hedge_executor.submit(fn, *args, **kwargs)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        self._count("hedges")
+        second = _hedge_executor.submit(fn, *args, **kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                    return future.result()  # the slower request finishes in the background
+                error = future.exception()
+        raise error
+
+    # ------------------------------------------------------------
+    # async (httpx)
+    # ------------------------------------------------------------
+    async def acall(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """await fn(*args, **kwargs) with a per-attempt deadline, breaker, retries and optional hedging."""
+        self._count("calls")
+        for attempt in range(self.max_attempts):
+            probe = self.breaker.before_call()
+            try:
+                if self.hedge_after > 0:
+                    result = await self._hedged_async(fn, *args, **kwargs)
+                else:
+                    result = await self._with_deadline(fn(*args, **kwargs))
+            except Exception as exc:
+                self._settle(exc, probe)
+                await asyncio.sleep(self._retry_or_raise(exc, attempt))
+                continue
+            except BaseException:
+                # CancelledError (client disconnect, batch cancel, shutdown): no verdict,
+                # but a cancelled probe must free the slot or the circuit never closes
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            self._settle(None, probe)
+            self._count("successes")
+            return result
+
+    async def astream(self, open_stream: Callable[..., Any], *args, **kwargs):
+        """
+        Async-generator variant: retries only until the first item arrives (nothing has been
+        yielded yet), and the deadline applies to time-to-first-item. Later errors propagate as-is.
+        """
+        self._count("calls")
+        for attempt in range(self.max_attempts):
+            probe = self.breaker.before_call()
+            stream = open_stream(*args, **kwargs)
+            try:
+                first = await self._with_deadline(stream.__anext__())
+            except StopAsyncIteration:
+                self._settle(None, probe)
+                self._count("successes")
+                return
+            except Exception as exc:
+                await stream.aclose()
+                self._settle(exc, probe)
+                await asyncio.sleep(self._retry_or_raise(exc, attempt))
+                continue
+            except BaseException:
+                if probe:
+                    self.breaker.release_probe()
+                await stream.aclose()
+                raise
+            break
+        self._settle(None, probe)  # the provider answered; mid-stream errors don't reopen the breaker
+        try:
+            yield first
+            async for item in stream:
+                yield item
+        except Exception:
+            self._count("failures")
+            raise
+        finally:
+            await stream.aclose()
+        self._count("successes")
+
+    async def _with_deadline(self, coro):
+        try:
+            return await asyncio.wait_for(coro, timeout=self.deadline)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(self.name, self.deadline)
+
+    async def _hedged_async(self, fn, *args, **kwargs):
+        first = asyncio.ensure_future(self._with_deadline(fn(*args, **kwargs)))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        self._count("hedges")
+        second = asyncio.ensure_future(self._with_deadline(fn(*args, **kwargs)))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()  # the losing request is aborted (its connection is closed)
+
+    def snapshot(self) -> dict:
+        return {
+            "deadline_seconds": self.deadline,
+            "max_attempts": self.max_attempts,
+            "hedge_after_seconds": self.hedge_after or None,
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breaker": {
+                "state": self.breaker.state,
+                "opens": self.breaker.opens,
+                "short_circuited": self.breaker.short_circuited,
+            },
+        }
+
+
+friendli_policy = ResiliencePolicy("friendli", FRIENDLI_DEADLINE_SECONDS, hedge_after=FRIENDLI_HEDGE_AFTER_SECONDS)
+# Embeddings and chat completions share the OpenAI breaker: the same provider degrades for both
+_openai_breaker = CircuitBreaker("openai")
+openai_embeddings_policy = ResiliencePolicy("openai_embeddings", OPENAI_DEADLINE_SECONDS,
+                                            hedge_after=OPENAI_HEDGE_AFTER_SECONDS, breaker=_openai_breaker)
+openai_chat_policy = ResiliencePolicy("openai_chat", OPENAI_DEADLINE_SECONDS,
+                                      hedge_after=OPENAI_HEDGE_AFTER_SECONDS, breaker=_openai_breaker)
+
+
+def resilience_snapshot() -> dict:
+    return {p.name: p.snapshot() for p in (friendli_policy, openai_embeddings_policy, openai_chat_policy)}
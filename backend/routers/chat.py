@@ -31,18 +31,20 @@ import os
 import json
 import re
 import logging
-import numpy as np
 from datetime import datetime, date
 from decimal import Decimal
 from typing import Optional, List, Dict, Any, Literal
 from backend.database import get_db
+from backend.resilience import openai_chat_policy, openai_embeddings_policy
+from backend.vector_search import RAG_ENGINE, search_similar_invoices, search_similar_invoices_in_memory
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 🔧 Configuration & Setup
 # ═══════════════════════════════════════════════════════════════════════════════
 
 router = APIRouter(prefix="/chat", tags=["Chat"])
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are done by backend/resilience.py (with a breaker), not by the SDK
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 # Models Configuration
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
@@ -100,6 +102,16 @@ context = ChatContext()
 # 🛠️ Utility Functions
 # ═══════════════════════════════════════════════════════════════════════════════
 
+def _chat_completion(**kwargs):
+    """client.chat.completions.create with a deadline, retries and the OpenAI circuit breaker"""
+    return openai_chat_policy.call(client.chat.completions.create, timeout=openai_chat_policy.deadline, **kwargs)
+
+
+def _create_embedding(**kwargs):
+    """client.embeddings.create with a deadline, retries and the OpenAI circuit breaker"""
+    return openai_embeddings_policy.call(client.embeddings.create, timeout=openai_embeddings_policy.deadline, **kwargs)
+
+
 def serialize_for_json(obj: Any) -> Any:
     """Convert datetime, Decimal, and other types to JSON-serializable format"""
     if isinstance(obj, (datetime, date)):
@@ -131,6 +143,7 @@ def format_invoice_for_frontend(invoice_data: dict) -> dict:
         "tax": str(invoice_data.get("tax") or "0"),
         "payment_method": invoice_data.get("payment_method"),
         "image_url": raw_image_url if raw_image_url else "",
+        "thumbnail_url": invoice_data.get("thumbnail_url"),  # small WebP for the result cards
         "category": invoice_data.get("category"),
         "ai_insight": invoice_data.get("ai_insight"),
     }
@@ -171,17 +184,6 @@ def is_safe_sql(sql_query: str) -> bool:
     return True
 
 
-def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
-    """Calculate cosine similarity between two vectors"""
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
-    
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-    
-    return dot_product / (norm1 * norm2)
-
 # ═══════════════════════════════════════════════════════════════════════════════
 # 🧩 STAGE 1: Refiner
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -229,7 +231,7 @@ def refine_user_query(user_query: str) -> str:
 **السؤال المحسّن:**
 """
         
-        response = client.chat.completions.create(
+        response = _chat_completion(
             model=LLM_MODEL,
             messages=[
                 {"role": "system", "content": "أنت خبير في تحسين الأسئلة العربية. تحوّل اللهجة العامية إلى فصحى بدون تغيير المعنى."},
@@ -340,7 +342,7 @@ def route_query(refined_query: str) -> RouterDecision:
 }}
 """
         
-        response = client.chat.completions.create(
+        response = _chat_completion(
             model=LLM_MODEL,
             messages=[
                 {"role": "system", "content": "أنت خبير في تصنيف الأسئلة. أخرج JSON فقط."},
@@ -445,7 +447,7 @@ SQL: SELECT * FROM invoices WHERE is_valid_invoice = true ORDER BY CAST(total_am
 **SQL Query:**
 """
         
-        response = client.chat.completions.create(
+        response = _chat_completion(
             model=LLM_MODEL,
                 messages=[
                 {"role": "system", "content": "أنت خبير SQL. أخرج SQL فقط."},
@@ -479,7 +481,13 @@ SQL: SELECT * FROM invoices WHERE is_valid_invoice = true ORDER BY CAST(total_am
         return []
 
 
-def execute_rag(refined_query: str, db: Session, top_k: int = 5) -> List[Dict]:
+def execute_rag(
+    refined_query: str,
+    db: Session,
+    top_k: int = 5,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> List[Dict]:
     """
     🔍 Execute RAG (Retrieval-Augmented Generation) using embeddings
     
@@ -487,6 +495,8 @@ def execute_rag(refined_query: str, db: Session, top_k: int = 5) -> List[Dict]:
         refined_query: السؤال المحسّن
         db: Database session
         top_k: Number of top results to return
+        ef_search: HNSW ef_search for this query (None = derived from the index)
+        probes: IVFFlat probes for this query (None = derived from the index)
     
     Returns:
         List of semantically similar invoices
@@ -495,69 +505,32 @@ def execute_rag(refined_query: str, db: Session, top_k: int = 5) -> List[Dict]:
     
     try:
         # Generate embedding for user query
-        embedding_response = client.embeddings.create(
+        embedding_response = _create_embedding(
             model=EMBEDDING_MODEL,
             input=refined_query
         )
         
-        query_embedding = np.array(embedding_response.data[0].embedding)
+        query_embedding = embedding_response.data[0].embedding
         logger.info(f"✅ Generated query embedding (dim: {len(query_embedding)})")
         
-        # Get all invoices with embeddings - CORRECT TABLE NAME!
-        sql = text("""
-            SELECT i.*, e.embedding
-            FROM invoices i
-            LEFT JOIN invoice_embeddings e ON i.id = e.invoice_id
-            WHERE i.is_valid_invoice = true
-            AND e.embedding IS NOT NULL
-            AND i.image_url IS NOT NULL
-        """)
-        
-        rows = db.execute(sql).fetchall()
-        logger.info(f"📊 Found {len(rows)} invoices with embeddings")
+        if RAG_ENGINE == "memory":
+            # Rank with the in-process NumPy index (no pgvector needed)
+            top_results = search_similar_invoices_in_memory(db, query_embedding, top_k=top_k)
+        else:
+            # Rank inside Postgres with pgvector (ORDER BY <=> LIMIT k) - only top_k rows come back
+            top_results = search_similar_invoices(
+                db, query_embedding, top_k=top_k, ef_search=ef_search, probes=probes
+            )
         
-        if not rows:
+        if not top_results:
             logger.warning("⚠️ No invoices with embeddings found")
             return []
         
-        # Calculate similarities using pgvector
-        similarities = []
-        for row in rows:
-            row_dict = dict(row._mapping)
-            
-            # Parse embedding (pgvector returns it as a list)
-            embedding_data = row_dict.get('embedding')
-            if not embedding_data:
-                continue
-            
-            try:
-                # Convert to numpy array if it's a list
-                if isinstance(embedding_data, list):
-                    invoice_embedding = np.array(embedding_data)
-                elif isinstance(embedding_data, str):
-                    invoice_embedding = np.array(json.loads(embedding_data))
-                else:
-                    invoice_embedding = np.array(embedding_data)
-                
-                similarity = cosine_similarity(query_embedding, invoice_embedding)
-                
-                similarities.append({
-                    'invoice': row_dict,
-                    'similarity': float(similarity)
-                })
-            except Exception as e:
-                logger.debug(f"Failed to process embedding for invoice {row_dict.get('id')}: {e}")
-                continue
-        
-        # Sort by similarity and get top_k
-        similarities.sort(key=lambda x: x['similarity'], reverse=True)
-        top_results = similarities[:top_k]
-        
-        results = [item['invoice'] for item in top_results]
+        results = [serialize_for_json(item) for item in top_results]
         
         logger.info(f"✅ RAG returned {len(results)} results")
-        for i, item in enumerate(top_results[:3], 1):
-            logger.info(f"   {i}. {item['invoice'].get('vendor', 'Unknown')} (similarity: {item['similarity']:.3f})")
+        for i, item in enumerate(results[:3], 1):
+            logger.info(f"   {i}. {item.get('vendor', 'Unknown')} (similarity: {item['similarity']:.3f})")
         
         return results
     
@@ -808,7 +781,7 @@ def generate_reply(refined_query: str, results: List[Dict], decision: RouterDeci
 **الرد:**
 """
         
-        response = client.chat.completions.create(
+        response = _chat_completion(
             model=LLM_MODEL,
                 messages=[
                 {
@@ -842,7 +815,7 @@ class ChatRequest(BaseModel):
 
 
 @router.post("/ask")
-async def chat_ask(request: ChatRequest, db: Session = Depends(get_db)):
+def chat_ask(request: ChatRequest, db: Session = Depends(get_db)):
     """
     🎯 Main Chat Endpoint
     
@@ -859,6 +832,9 @@ async def chat_ask(request: ChatRequest, db: Session = Depends(get_db)):
     
     Returns:
         JSON response with reply and data
+
+    Note: plain `def` (not async) - every stage is a blocking OpenAI/DB call, so FastAPI runs it
+    in the threadpool; a slow provider then ties up a worker thread instead of the event loop.
     """
     logger.info("="*80)
     logger.info("🎯 NEW CHAT REQUEST")
@@ -87,6 +87,8 @@ def filter_invoices(
                 "category": inv.category,
                 "created_at": inv.created_at.isoformat() if inv.created_at else None,
                 "ai_insight": inv.ai_insight,
+                "image_url": inv.image_url,
+                "thumbnail_url": inv.thumbnail_url,  # small WebP for list/card display
             })
         
         return result
@@ -0,0 +1,130 @@
+import os
+import logging
+import mimetypes
+from email.utils import formatdate
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from backend.storage import LocalDiskStorage, get_storage
+
+router = APIRouter(prefix="/files", tags=["Files"])
+logger = logging.getLogger("backend.files")
+
+_CHUNK_SIZE = 256 * 1024
+
+
+def parse_range(range_header: str | None, size: int):
+    """
+    Parse a single `bytes=` range.
+
+    Returns:
+        None → serve the whole file, (start, end) inclusive, or "invalid" → 416
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        return None  # multiple ranges: allowed to answer with the full body
+    start_s, _, end_s = spec.partition("-")
+    try:
+        if start_s == "":
+            # suffix range: the last N bytes
+            length = int(end_s)
+            if length <= 0:
+                return "invalid"
+            return max(0, size - length), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return "invalid"
+    return start, min(end, size - 1)
+
+
+def _read_at(f, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), size, offset)
+    f.seek(offset)  # the file object is only read by this response, one chunk at a time
+    return f.read(size)
+
+
+class RangeFileResponse(Response):
+    """
+    Serve a file (or one byte range of it) without loading it into memory.
+
+    Uses the ASGI `http.response.zerocopysend` extension (kernel sendfile) when the server
+    offers it; otherwise streams chunks read in a threadpool (os.pread, or seek + read
+    where os.pread doesn't exist, e.g. Windows / run.bat).
+    """
+
+    def __init__(self, path: str, range_header: str | None, method: str = "GET"):
+        self.path = path
+        self.send_body = method != "HEAD"
+        stat = os.stat(path)
+        size = stat.st_size
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        headers = {
+            "accept-ranges": "bytes",
+            "last-modified": formatdate(stat.st_mtime, usegmt=True),
+            "etag": f'"{stat.st_mtime_ns:x}-{size:x}"',
+            # Storage keys are content-addressed → the bytes behind a URL never change
+            "cache-control": "public, max-age=31536000, immutable",
+        }
+        byte_range = parse_range(range_header, size)
+        if byte_range == "invalid":
+            self.offset, self.count = 0, 0
+            headers["content-range"] = f"bytes */{size}"
+            status_code = 416
+        elif byte_range is None:
+            self.offset, self.count = 0, size
+            status_code = 200
+        else:
+            start, end = byte_range
+            self.offset, self.count = start, end - start + 1
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            status_code = 206
+        headers["content-length"] = str(self.count)
+
+        super().__init__(content=None, status_code=status_code, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.count == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f,
+                            "offset": self.offset, "count": self.count})
+                return
+
+            offset, remaining = self.offset, self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(_read_at, f, min(_CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+
+@router.api_route("/{path:path}", methods=["GET", "HEAD"])
+def get_file(path: str, request: Request):
+    """Serve a file from the local-disk storage backend (supports Range requests)."""
+    storage = get_storage()
+    if not isinstance(storage, LocalDiskStorage):
+        raise HTTPException(status_code=404, detail="Local file serving is disabled (STORAGE_BACKEND != local)")
+    try:
+        full_path = storage.local_path(path)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not full_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return RangeFileResponse(str(full_path), request.headers.get("range"), request.method)
@@ -1,5 +1,4 @@
 import logging
-import os
 import json
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
@@ -10,6 +9,8 @@ from backend.models.invoice_model import Invoice
 from backend.models.item_model import Item
 from backend.schemas.invoice_schema import InvoiceCreate
 from backend.utils import generate_embedding
+from backend.upload_index import link_invoice
+from backend.storage import get_storage
 
 router = APIRouter(prefix="/invoices", tags=["Invoices"])
 logger = logging.getLogger(__name__)
@@ -141,6 +142,7 @@ def save_analyzed_invoice(data: EditedInvoiceData, db: Session = Depends(get_db)
         db.add(invoice)
         db.commit()
         db.refresh(invoice)
+        link_invoice(db, data.image_url, invoice.id)
         
         # ✅ Save Items if provided
         if data.items and len(data.items) > 0:
@@ -262,8 +264,8 @@ def get_all_invoices(db: Session = Depends(get_db)):
         invoices = db.query(Invoice).all()
         result = []
         
-        # Get SUPABASE_URL from env for building image URLs
-        supabase_url = os.getenv("SUPABASE_URL", "https://pcktfzshbxaljkbedrar.supabase.co")
+        # Configured storage backend (Supabase or local disk) builds the image URLs
+        storage = get_storage()
         
         for inv in invoices:
             inv_dict = inv.to_dict()
@@ -273,7 +275,7 @@ def get_all_invoices(db: Session = Depends(get_db)):
                 # Try to build image URL from invoice number or ID
                 # Check if invoice_2.jpg or invoice_3.jpg exists
                 potential_filename = f"invoice_{inv.id}.jpg"
-                inv_dict["image_url"] = f"{supabase_url}/storage/v1/object/public/invoices/{potential_filename}"
+                inv_dict["image_url"] = storage.url(potential_filename)
                 logger.info(f"🔧 Built fallback image URL for invoice {inv.id}: {inv_dict['image_url']}")
             
             result.append(inv_dict)
@@ -2,166 +2,234 @@ import os
 import logging
 import io
 import requests
-import tempfile
 from pathlib import Path
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from supabase import create_client, Client
 from dotenv import load_dotenv
 from PIL import Image
-import fitz  # PyMuPDF
-from backend.utils_image_autofix import auto_fix_invoice_image
+from fastapi.concurrency import run_in_threadpool
+from backend.autofix_pool import (
+    run_autofix_with_derivatives, run_derivatives, run_pdf_pages_autofix, metrics as autofix_metrics,
+)
+from backend.derivatives import DERIVATIVE_CONTENT_TYPE, derivative_path
+from backend.utils_pdf import plan_pdf_pages, render_pdf_page_jpeg, stitch_pages_jpeg
+from backend.upload_stream import RequestMemoryTracker, spool_upload, upload_memory_metrics
+from backend.upload_index import content_path, find_upload, record_upload
+from backend.storage import get_storage
 
 # Load env vars
 load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_KEY")
-BUCKET_NAME = "invoices"
-
-# Use service role key for admin operations (upload/delete)
-SUPABASE_KEY = SUPABASE_SERVICE_KEY or SUPABASE_ANON_KEY
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("❌ Missing Supabase credentials in .env")
+# Multi-page PDFs: "pages" → one image per page (ordered set), "stitch" → one tall image
+PDF_MULTIPAGE_MODE = os.getenv("PDF_MULTIPAGE_MODE", "pages").lower()
 
 router = APIRouter(prefix="/upload", tags=["Upload"])
 logger = logging.getLogger("backend.upload")
 
-# Log which key is being used (masked for security)
-if SUPABASE_SERVICE_KEY:
-    logger.info(f"🔑 Using SERVICE ROLE KEY: ...{SUPABASE_SERVICE_KEY[-10:]}")
-else:
-    logger.warning(f"⚠️ Using ANON KEY (may have limited permissions): ...{SUPABASE_ANON_KEY[-10:] if SUPABASE_ANON_KEY else 'NOT SET'}")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def pdf_to_image(pdf_bytes: bytes) -> bytes:
+def pdf_to_image(pdf_bytes: bytes, page_index: int = 0) -> bytes:
     """
-    Convert the first page of a PDF to a JPEG image.
-    Returns image bytes.
+    Convert one PDF page (the first by default) to a JPEG image (no auto-fix).
+    Used when the auto-fix pool can't take the page. Returns image bytes.
     """
     try:
-        # Open PDF from bytes
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        
-        # Get first page
-        first_page = pdf_document[0]
-        
-        # Render page to image at 300 DPI for good quality
-        zoom = 2  # Higher zoom = higher resolution
-        mat = fitz.Matrix(zoom, zoom)
-        pix = first_page.get_pixmap(matrix=mat)
-        
-        # Convert pixmap to PIL Image
-        img_data = pix.tobytes("jpeg")
-        
-        pdf_document.close()
-        
-        logger.info(f"✅ Successfully converted PDF to image")
+        img_data = render_pdf_page_jpeg(pdf_bytes, page_index=page_index, autofix=False)
+        logger.info(f"✅ Successfully converted PDF page {page_index + 1} to image")
         return img_data
     
     except Exception as e:
         logger.error(f"❌ PDF conversion error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Failed to convert PDF: {str(e)}")
 
+
+async def pdf_to_images(pdf_bytes: bytes) -> tuple[list[bytes], int]:
+    """
+    Render + auto-fix the PDF pages (capped by PDF_MAX_PAGES / PDF_MAX_RENDER_MB) in parallel
+    pool workers. Pages the pool couldn't take are rendered without auto-fix.
+
+    Returns:
+        (JPEG bytes per processed page in order, total page count)
+    """
+    try:
+        page_indexes, total_pages = await run_in_threadpool(plan_pdf_pages, pdf_bytes)
+    except Exception as e:
+        logger.error(f"❌ PDF conversion error: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Failed to convert PDF: {str(e)}")
+    if not page_indexes:
+        raise HTTPException(status_code=400, detail="Failed to convert PDF: no pages")
+
+    rendered = await run_pdf_pages_autofix(pdf_bytes, page_indexes)
+    images = []
+    for page_index, image in zip(page_indexes, rendered):
+        if image is None:
+            logger.warning(f"⚠️ Auto-fix skipped or failed for page {page_index + 1}, rendering without it")
+            image = await run_in_threadpool(pdf_to_image, pdf_bytes, page_index)
+        images.append(image)
+    return images, total_pages
+
+
+def store_file(file_path: str, file_bytes: bytes, content_type: str) -> str:
+    """
+    Store one file in the configured storage backend (Supabase or local disk) and return its URL.
+    Paths are content-addressed (see content_path), so there is nothing to remove first;
+    overwriting only matters when retrying a half-finished upload of the same content.
+    """
+    storage = get_storage()
+    try:
+        public_url = storage.put(file_path, file_bytes, content_type)
+    except Exception as upload_error:
+        error_msg = str(upload_error)
+        logger.error(f"❌ Storage upload error ({storage.name}): {error_msg}")
+        raise HTTPException(status_code=400, detail=f"Upload failed: {error_msg}")
+
+    logger.info(f"✅ File available at: {public_url}")
+    return public_url
+
+
 @router.post("/")
 async def upload_invoice(file: UploadFile = File(...)):
-    temp_file_path = None
-    
+    # Explicit accounting of the big buffers this request holds at the same time
+    memory = RequestMemoryTracker()
     try:
-        logger.info(f"⬆️ Uploading {file.filename} to Supabase...")
+        logger.info(f"⬆️ Uploading {file.filename}...")
 
-        file_bytes = await file.read()
+        # Chunked read: size limit (413) + SHA-256 before anything is materialized
+        spooled = await spool_upload(file)
         original_filename = file.filename or "invoice"
+        page_images = []
+        renditions = {}  # WebP derivatives {"medium": ..., "small": ...}
+        total_pages = pages_processed = 1
         
         # Check if file is a PDF
         is_pdf = file.content_type == "application/pdf" or original_filename.lower().endswith('.pdf')
         
+        # ============================================================
+        # ♻️ Same content uploaded before → reuse it (no auto-fix, no storage calls)
+        # ============================================================
+        existing = await run_in_threadpool(find_upload, spooled.sha256)
+        if existing is not None:
+            logger.info(f"♻️ Duplicate upload ({spooled.sha256[:12]}...), reusing {existing['url']}")
+            return {
+                **existing,
+                "converted_from_pdf": is_pdf,
+                "page_count": len(existing["page_urls"]),
+                "pages_processed": len(existing["page_urls"]),
+                "pages_truncated": False,
+                "deduplicated": True,
+            }
+        
+        file_bytes = await spooled.read_bytes()
+        memory.hold("original", len(file_bytes))
+        
         if is_pdf:
             logger.info(f"📄 Detected PDF file, converting to image...")
-            # Convert PDF to image
-            file_bytes = pdf_to_image(file_bytes)
-            # Change filename extension to .jpg
-            file_path = original_filename.rsplit('.', 1)[0] + ".jpg"
+            # Render + auto-fix + encode each page in its own pool worker
+            # (pixels never go through a temp JPEG)
+            page_images, total_pages = await pdf_to_images(file_bytes)
+            pages_processed = len(page_images)
+            memory.hold("pages", sum(len(p) for p in page_images))
+            memory.release("original")  # the PDF itself is no longer needed
+            
+            if len(page_images) > 1 and PDF_MULTIPAGE_MODE == "stitch":
+                logger.info(f"🧵 Stitching {len(page_images)} pages into one image")
+                stitched = await run_in_threadpool(stitch_pages_jpeg, page_images)
+                memory.hold("stitched", len(stitched))
+                page_images = [stitched]
+                memory.release("pages")
+            
+            file_bytes = page_images[0]
+            # Rendered pages are JPEG
+            extension = ".jpg"
             content_type = "image/jpeg"
         else:
-            file_path = original_filename
+            extension = Path(original_filename).suffix.lower() or ".jpg"
             content_type = file.content_type or "image/jpeg"
+        file_path = content_path(spooled.sha256, extension)
         
         # ============================================================
-        # 🔧 تصحيح الصورة تلقائياً (Auto-Fix)
+        # 🔧 تصحيح الصورة تلقائياً (Auto-Fix) - في process pool خارج الـ event loop
         # ============================================================
-        try:
-            # حفظ الصورة مؤقتاً
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-                temp_file.write(file_bytes)
-                temp_file_path = temp_file.name
-            
-            logger.info(f"🔧 Applying auto-fix to image: {temp_file_path}")
-            
-            # تطبيق التصحيح التلقائي
-            auto_fix_success = auto_fix_invoice_image(temp_file_path)
+        if not is_pdf:
+            try:
+                logger.info(f"🔧 Applying auto-fix to image ({len(file_bytes)} bytes)")
+                
+                # Renditions come from the corrected pixels in the same pool task
+                fixed = await run_autofix_with_derivatives(file_bytes)
+                
+                if fixed is not None:
+                    fixed_bytes, renditions = fixed
+                    memory.hold("fixed", len(fixed_bytes))
+                    file_bytes = fixed_bytes
+                    memory.release("original")
+                    logger.info(f"✅ Image auto-fix completed successfully")
+                else:
+                    logger.warning(f"⚠️ Auto-fix skipped or failed, using original image")
             
-            if auto_fix_success:
-                # قراءة الصورة المصححة
-                with open(temp_file_path, 'rb') as f:
-                    file_bytes = f.read()
-                logger.info(f"✅ Image auto-fix completed successfully")
-            else:
-                logger.warning(f"⚠️ Auto-fix failed, using original image")
+            except Exception as autofix_error:
+                logger.warning(f"⚠️ Auto-fix error: {autofix_error}. Using original image.")
         
-        except Exception as autofix_error:
-            logger.warning(f"⚠️ Auto-fix error: {autofix_error}. Using original image.")
+        # ============================================================
+        # Upload to storage (Supabase or local disk, see backend/storage.py)
+        # ============================================================
+        public_url = await run_in_threadpool(store_file, file_path, file_bytes, content_type)
+        page_urls = [public_url]
         
-        finally:
-            # حذف الملف المؤقت
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    logger.info(f"🗑️ Cleaned up temp file: {temp_file_path}")
-                except Exception as cleanup_error:
-                    logger.warning(f"⚠️ Failed to cleanup temp file: {cleanup_error}")
+        # Extra pages of a multi-page PDF: <sha>_p2.jpg, <sha>_p3.jpg, ...
+        for page_number, page_bytes in enumerate(page_images[1:], start=2):
+            page_urls.append(await run_in_threadpool(
+                store_file, content_path(spooled.sha256, extension, page_number), page_bytes, content_type
+            ))
         
         # ============================================================
-        # Upload to Supabase Storage using library (with upsert)
+        # 🖼️ WebP renditions next to the original (dashboard / chat display)
         # ============================================================
-        try:
-            # First, try to delete if exists
+        if not renditions:
+            # PDF pages, or auto-fix skipped: derive from the image we just stored
+            renditions = await run_derivatives(file_bytes)
+        derivative_urls = {}
+        for name, data in renditions.items():
             try:
-                supabase.storage.from_(BUCKET_NAME).remove([file_path])
-                logger.info(f"🗑️ Removed existing file: {file_path}")
-            except:
-                pass  # File doesn't exist, continue
-            
-            # Now upload
-            logger.info(f"📤 Uploading {file_path} to bucket {BUCKET_NAME}")
-            logger.info(f"🔑 Using key ending with: ...{SUPABASE_KEY[-10:]}")
-            
-            res = supabase.storage.from_(BUCKET_NAME).upload(
-                path=file_path,
-                file=file_bytes,
-                file_options={
-                    "content-type": content_type,
-                    "cache-control": "3600",
-                    "upsert": "true"
-                }
-            )
-            
-            logger.info(f"✅ Upload response: {res}")
-            
-        except Exception as upload_error:
-            error_msg = str(upload_error)
-            logger.error(f"❌ Supabase upload error: {error_msg}")
-            raise HTTPException(status_code=400, detail=f"Upload failed: {error_msg}")
-
-        # Build proper public URL
-        public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{file_path}"
-        logger.info(f"✅ File available at: {public_url}")
+                derivative_urls[name] = await run_in_threadpool(
+                    store_file, derivative_path(file_path, name), data, DERIVATIVE_CONTENT_TYPE
+                )
+            except HTTPException as e:
+                logger.warning(f"⚠️ Could not store {name} rendition: {e.detail}")
+        
+        await run_in_threadpool(
+            record_upload, spooled.sha256, public_url, page_urls, file_path, content_type, spooled.size,
+            derivative_urls.get("small"), derivative_urls.get("medium"),
+        )
 
-        return {"url": public_url, "converted_from_pdf": is_pdf}
+        return {
+            "url": public_url,
+            "converted_from_pdf": is_pdf,
+            "page_urls": page_urls,  # ordered image set for /vlm/analyze (one entry unless multi-page)
+            "page_count": total_pages,
+            "pages_processed": pages_processed,
+            "pages_truncated": pages_processed < total_pages,
+            "size_bytes": spooled.size,
+            "sha256": spooled.sha256,
+            "thumbnail_url": derivative_urls.get("small"),
+            "medium_url": derivative_urls.get("medium"),
+            "invoice_id": None,
+            "deduplicated": False,
+        }
 
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"❌ Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if memory.peak:
+            upload_memory_metrics.record(memory)
+
+
+@router.get("/autofix/metrics")
+def get_autofix_metrics():
+    """Auto-fix pool queue depth, outcomes and per-stage timings (ms)."""
+    return autofix_metrics.snapshot()
+
+
+@router.get("/memory/metrics")
+def get_upload_memory_metrics():
+    """Peak bytes held per upload request (p50/p95/max) and early 413 rejections."""
+    return upload_memory_metrics.snapshot()
@@ -1,31 +1,58 @@
 import os
 import json
+import base64
+import asyncio
 import logging
 import time
-import requests
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
+from typing import Callable
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 
-from backend.database import get_db
+from backend.database import get_db, SessionLocal
 from backend.models.invoice_model import Invoice
 from backend.models.item_model import Item
 from backend.utils import generate_embedding
+from backend.friendli_client import FRIENDLI_MODEL_ID, FriendliRateLimitError, post_chat_completion, stream_chat_completion
+from backend.rate_limiter import TokenBucket
+from backend.json_salvage import IncrementalJSONParser, salvage_json
+from backend.vlm_cache import vlm_cache, fetch_image_bytes, hash_bytes, make_cache_key, storage_image_sha256
+from backend.vlm_image_prep import VLM_IMAGE_INLINE, VLM_IMAGE_MAX_LONG_EDGE, VLM_PREP_ENABLED, prep_signature, vlm_prep_metrics
+from backend.autofix_pool import run_vlm_prep
+from backend.vlm_extraction import (
+    VLM_EXPECTED_ITEMS, VLM_MAX_ITEMS, VLM_STRUCTURED_OUTPUT, VLM_TEMPERATURE,
+    extraction_metrics, extraction_signature, response_format, size_max_tokens,
+)
+from backend.storage import get_storage
+from backend.job_queue import AnalysisJobQueue, NonRetryableJobError, QueueFullError, job_to_response
+from backend.upload_stream import detach_upload
+from backend.upload_index import link_invoice
 
 load_dotenv()
 router = APIRouter(prefix="/vlm", tags=["VLM"])
 logger = logging.getLogger("backend.vlm")
 
-FRIENDLI_TOKEN = os.getenv("FRIENDLI_TOKEN")
-FRIENDLI_URL = os.getenv("FRIENDLI_URL", "https://api.friendli.ai/dedicated/v1/chat/completions")
-FRIENDLI_MODEL_ID = os.getenv("FRIENDLI_MODEL_ID", "dep021qh0vlii5d")
+VLM_JOB_SSE_POLL_SECONDS = float(os.getenv("VLM_JOB_SSE_POLL_SECONDS", "2"))
+
+# Batch scheduling defaults (per batch request; clients may ask for less, never more)
+VLM_BATCH_REQUESTS_PER_MINUTE = float(os.getenv("VLM_BATCH_REQUESTS_PER_MINUTE", "60"))
+VLM_BATCH_MAX_CONCURRENCY = int(os.getenv("VLM_BATCH_MAX_CONCURRENCY", "8"))
+VLM_BATCH_MAX_RETRIES = int(os.getenv("VLM_BATCH_MAX_RETRIES", "3"))
+VLM_BATCH_MAX_ITEMS = int(os.getenv("VLM_BATCH_MAX_ITEMS", "5000"))
 
 
 class VLMRequest(BaseModel):
     image_url: str
     prompt: str | None = None
+    # Multi-page PDFs: ordered page images from /upload (page_urls[0] == image_url)
+    page_urls: list[str] | None = None
+
+    def all_page_urls(self) -> list[str]:
+        return self.page_urls or [self.image_url]
 
 
 def safe_get(parsed: dict, *keys, default=None):
@@ -130,21 +157,9 @@ def normalize_category(cat):
 
 
 # ================================================================
-# 🔍 Endpoint: Analyze Invoice Only (No DB Save)
+# 🧠 Smart Prompt (Arabic + English + Insight-rich)
 # ================================================================
-@router.post("/analyze-only")
-async def analyze_vlm_only(request: VLMRequest):
-    """
-    Analyze an invoice image using VLM but DON'T save to database.
-    Returns extracted data for user review and editing.
-    """
-    try:
-        start_time = time.time()
-        logger.info(f"🔍 Analyzing image (no save): {request.image_url}")
-
-        # Same prompt as /analyze endpoint
-        if not request.prompt:
-            request.prompt = """
+INVOICE_ANALYSIS_PROMPT = """
 أنت نموذج رؤية ولغة (Vision-Language Model) متقدم متخصص في تحليل الفواتير الذكية.
 الفواتير قد تكون بالعربية أو بالإنجليزية أو تحتوي على اللغتين، ويجب تحليل النصوص والصور بدقة.
 
@@ -238,290 +253,510 @@ async def analyze_vlm_only(request: VLMRequest):
 - AI_Insight بالعربية دائمًا
 """
 
-        # Send to FriendliAI
-        headers = {
-            "Authorization": f"Bearer {FRIENDLI_TOKEN}",
-            "Content-Type": "application/json",
-        }
 
-        payload = {
-            "model": FRIENDLI_MODEL_ID,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": request.prompt},
-                        {"type": "image_url", "image_url": {"url": request.image_url}},
-                    ],
-                }
-            ],
-            "max_tokens": 16384,
-            "temperature": 0.6,
-            "top_p": 0.9,
-        }
-
-        response = requests.post(FRIENDLI_URL, headers=headers, json=payload)
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"Friendli API error: {response.text}")
-
-        data = response.json()
-        raw_output = data["choices"][0]["message"]["content"].strip()
+def build_vlm_payload(image_url: str, prompt: str, max_tokens: int = 16384, structured: bool = False) -> dict:
+    """
+    Build the Friendli chat-completions payload for one invoice image.
+    structured=True → JSON-schema output (backend/vlm_extraction.py) at VLM_TEMPERATURE.
+    """
+    payload = {
+        "model": FRIENDLI_MODEL_ID,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": VLM_TEMPERATURE if structured else 0.6,
+        "top_p": 0.9,
+    }
+    if structured:
+        payload["response_format"] = response_format()
+    return payload
+
+
+def uses_structured_output(prompt: str) -> bool:
+    """The schema describes the default invoice prompt; custom prompts keep free-form output."""
+    return VLM_STRUCTURED_OUTPUT and prompt == INVOICE_ANALYSIS_PROMPT
+
+
+async def run_vlm(image_url: str, prompt: str) -> str:
+    """
+    Send the image to FriendliAI through the shared async client and return the raw text.
+    Awaiting here frees the event loop for other requests during inference.
 
-        if raw_output.startswith("```"):
-            raw_output = raw_output.strip("`").replace("json", "", 1).strip()
+    With structured output, max_tokens is sized for VLM_EXPECTED_ITEMS; a reply cut off by
+    that budget is retried once with room for VLM_MAX_ITEMS.
+    """
+    structured = uses_structured_output(prompt)
+    budgets = [size_max_tokens(VLM_EXPECTED_ITEMS), size_max_tokens(VLM_MAX_ITEMS)] if structured else [16384]
+    for attempt, max_tokens in enumerate(budgets):
+        start = time.perf_counter()
+        data = await post_chat_completion(build_vlm_payload(image_url, prompt, max_tokens, structured))
+        choice = data["choices"][0]
+        finish_reason = choice.get("finish_reason")
+        output_tokens = (data.get("usage") or {}).get("completion_tokens")
+        elapsed = time.perf_counter() - start
+        extraction_metrics.record_call(elapsed, output_tokens, finish_reason, max_tokens, structured)
+        logger.info(f"🧾 VLM call: {elapsed:.2f}s, {output_tokens} output tokens "
+                    f"(max_tokens={max_tokens}, finish={finish_reason}, structured={structured})")
+        if finish_reason != "length" or attempt == len(budgets) - 1:
+            break
+        logger.warning(f"✂️ VLM output truncated at {max_tokens} tokens, retrying with {budgets[attempt + 1]}")
+        extraction_metrics.record_truncation_retry()
+
+    # Markdown fences / stray text are left to salvage_json
+    return (choice["message"]["content"] or "").strip()
+
+
+async def prepare_vlm_image(image_url: str, image_bytes: bytes | None, image_sha256: str | None = None) -> str:
+    """
+    🎯 Crop to the invoice + downscale before inference (backend/vlm_image_prep.py).
 
+    Returns:
+        the URL to send to the model: a data URL (VLM_IMAGE_INLINE), the stored prepared image,
+        or the original URL when preparation is off, fails, or wouldn't change anything
+    """
+    if not VLM_PREP_ENABLED or image_url.startswith("data:"):
+        return image_url
+    if image_bytes is None:
+        # Not in storage / allowlist, too large, or unreachable → the model gets the original URL
+        vlm_prep_metrics.record_skipped()
+        return image_url
+    prepared = await run_vlm_prep(image_bytes)
+    if prepared is None:
+        vlm_prep_metrics.record_skipped()
+        return image_url
+    if prepared.data is None:
+        vlm_prep_metrics.record(prepared, inlined=False)
+        return image_url
+
+    if VLM_IMAGE_INLINE:
+        vlm_url = "data:image/jpeg;base64," + base64.b64encode(prepared.data).decode("ascii")
+    else:
+        # Content-addressed, so re-analyzing the same image reuses the same object
+        sha = image_sha256 or hash_bytes(image_bytes)
+        key = f"vlm/{sha[:2]}/{sha}_{VLM_IMAGE_MAX_LONG_EDGE}.jpg"
         try:
-            parsed = json.loads(raw_output)
+            vlm_url = await run_in_threadpool(get_storage().put, key, prepared.data, "image/jpeg")
         except Exception as e:
-            logger.error(f"⚠️ JSON parse failed: {e}")
-            return {"status": "error", "raw_output": raw_output}
+            logger.warning(f"⚠️ Could not store prepared VLM image ({e}), sending the original")
+            vlm_prep_metrics.record_skipped()
+            return image_url
 
-        # Normalize data
-        category_raw = safe_get(parsed, "Category", "category")
-        normalized_category = normalize_category(category_raw)
-        ai_insight = safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned")
-        invoice_type_from_vlm = safe_get(parsed, "Invoice_Type", "invoice_type", default="فاتورة شراء")
-        
-        elapsed = round(time.time() - start_time, 2)
-        logger.info(f"✅ Analysis completed in {elapsed}s (no save)")
+    vlm_prep_metrics.record(prepared, inlined=VLM_IMAGE_INLINE)
+    logger.info(
+        f"🎯 VLM image {prepared.original_size} → {prepared.prepared_size}"
+        f"{' (cropped)' if prepared.cropped else ''}: ~{prepared.tokens_before} → ~{prepared.tokens_after} vision tokens, "
+        f"~{prepared.estimated_seconds_saved * 1000:.0f}ms saved"
+    )
+    return vlm_url
 
-        # Return data for frontend to display for editing
-        return {
-            "status": "success",
-            "category": normalized_category,
-            "invoice_type": invoice_type_from_vlm,
-            "ai_insight": ai_insight,
-            "output": parsed,
-            "time_taken_seconds": elapsed,
-        }
 
-    except Exception as e:
-        logger.error(f"❌ VLM analysis failed: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+async def lookup_analysis(image_url: str, prompt: str):
+    """
+    Cache lookup, downloading the image only when needed.
 
+    /upload results are keyed by the content hash in their storage path, so a hit costs no
+    download at all; other storage URLs are fetched once (allowlisted + size-capped) and the
+    same bytes are reused for the pre-VLM preparation on a miss.
 
-# ================================================================
-# 🚀 Endpoint: Analyze Invoice (Original - Saves to DB)
-# ================================================================
-@router.post("/analyze")
-async def analyze_vlm(request: VLMRequest, db: Session = Depends(get_db)):
+    Returns:
+        (cache_key or None, cached result or None, image_bytes or None, image_sha256 or None)
     """
-    Analyze an invoice image using FriendliAI Qwen2.5-VL-32B-Instruct.
-    Handles Arabic + English invoices and generates richer insights.
+    image_bytes = None
+    image_sha256 = None
+    # Prep and output-shaping settings change the result → they are part of the key
+    model_signature = f"{FRIENDLI_MODEL_ID}|{prep_signature()}|{extraction_signature()}"
+
+    if image_url.startswith("data:"):
+        if vlm_cache.enabled:
+            image_sha256 = hash_bytes(image_url.encode("utf-8"))  # inline image: the URL *is* the content
+    elif vlm_cache.enabled:
+        image_sha256 = storage_image_sha256(image_url)
+
+    cache_key = make_cache_key(image_sha256, prompt, model_signature) if image_sha256 else None
+    cached = await vlm_cache.get(cache_key)
+    if cached is not None or image_url.startswith("data:"):
+        return cache_key, cached, image_bytes, image_sha256
+
+    if VLM_PREP_ENABLED or (vlm_cache.enabled and image_sha256 is None):
+        image_bytes = await fetch_image_bytes(image_url)
+        if image_bytes is not None and vlm_cache.enabled and image_sha256 is None:
+            image_sha256 = hash_bytes(image_bytes)
+            cache_key = make_cache_key(image_sha256, prompt, model_signature)
+            cached = await vlm_cache.get(cache_key)
+    return cache_key, cached, image_bytes, image_sha256
+
+
+async def finish_analysis(raw_output: str, cache_key: str | None, complete_parse: dict | None = None):
     """
-    try:
-        start_time = time.time()
-        logger.info(f"🔍 Analyzing image: {request.image_url}")
+    Parse (salvaging partial output), record metrics and cache complete results.
+    `complete_parse` skips re-parsing when a streaming parser already produced the object.
 
-        # ------------------------------------------------------------
-        # 🧠 Smart Prompt (Arabic + English + Insight-rich)
-        # ------------------------------------------------------------
-        if not request.prompt:
-            request.prompt = """
-أنت نموذج رؤية ولغة (Vision-Language Model) متقدم متخصص في تحليل الفواتير الذكية.
-الفواتير قد تكون بالعربية أو بالإنجليزية أو تحتوي على اللغتين، ويجب تحليل النصوص والصور بدقة.
+    Returns:
+        parsed dict or None
+    """
+    if complete_parse is not None:
+        parsed, complete = complete_parse, True
+    else:
+        parsed, complete = salvage_json(raw_output)
+    if parsed is None:
+        extraction_metrics.record_parse(False)
+        logger.error(f"⚠️ JSON parse failed: no usable object in {len(raw_output)} chars of output")
+        return None
+    extraction_metrics.record_parse(True, salvaged=not complete)
+    if not complete:
+        logger.warning(f"🩹 Salvaged {len(parsed)} complete fields from malformed/truncated VLM output")
+        return parsed
 
-🎯 مهمتك الأساسية:
-استخرج جميع بيانات الفاتورة بشكل منظم وواضح، وفق الهيكل المحدد أدناه، والتزم بالحقول كما هي.
+    # Only complete parses are cached
+    await vlm_cache.set(cache_key, parsed)
+    return parsed
 
-إذا لم تجد معلومة بشكل مباشر:
-- حاول استنتاجها من الصورة أو النصوص المشابهة (مثل الشعار أو الكلمات القريبة).
-- إذا لم تتمكن نهائيًا من معرفتها، اكتب حرفيًا: "Not Mentioned".
-- لا تترك أي حقل فارغًا أو null أو undefined.
-- يجب ملء كل حقل في الـ JSON دون استثناء.
-- لا تكتب أي نص خارج كائن JSON.
 
-⚙️ هيكل النتيجة المطلوب (التزم به تمامًا):
+async def analyze_image(image_url: str, prompt: str, rate_limiter: TokenBucket | None = None):
+    """
+    Run the VLM with the content-addressed result cache in front of it.
+    If a rate_limiter is given, a token is taken only when a real inference is needed.
 
-{
-  "Invoice Number": "...",
-  "Date": "DD/MM/YYYY",  ← يجب أن يكون بصيغة 09/10/2025
-  "Vendor": "...",
-  "Tax Number": "...",
-  "Cashier": "...",
-  "Branch": "...",
-  "Phone": "...",
-  "Items": [
-    {"description": "...", "quantity": 1, "unit_price": 10.0, "total": 10.0}
-  ],
-  "Subtotal": "...",
-  "Tax": "...",
-  "Total Amount": "...",
-  "Grand Total (before tax)": "...",
-  "Discounts": "...",
-  "Payment Method": "...",
-  "Amount Paid": "...",
-  "Ticket Number": "...",
-  "Category": "...",
-  "Invoice_Type": "...",
-  "AI_Insight": "..." ← يجب أن يكون بالعربية فقط ويشرح سلوك الإنفاق
+    Returns:
+        (parsed dict or None, raw_output, from_cache)
+    """
+    cache_key, cached, image_bytes, image_sha256 = await lookup_analysis(image_url, prompt)
+    if cached is not None:
+        return cached, None, True
+
+    if rate_limiter is not None:
+        await rate_limiter.acquire()
+    vlm_url = await prepare_vlm_image(image_url, image_bytes, image_sha256)
+    raw_output = await run_vlm(vlm_url, prompt)
+    return await finish_analysis(raw_output, cache_key), raw_output, False
+
+
+# ================================================================
+# 📚 Multi-page invoices: analyze every page, then merge
+# ================================================================
+# Totals and payment details are printed at the end of the invoice → take them from the last page
+LAST_PAGE_FIELDS = {
+    "Subtotal", "Tax", "Total Amount", "Grand Total (before tax)", "Discounts",
+    "Payment Method", "Amount Paid",
 }
 
-🧠 القواعد الذكية للاستنتاج:
 
-**Category Detection (استخدم التفكير المنطقي):**
-- إذا ظهر اسم متجر يشير إلى مطعم أو مقهى (Starbucks, Dunkin, Restaurant) → Category = "Cafe" أو "Restaurant"
-- إذا كان يحتوي على كلمات مثل "Panadol" أو "صيدلية" أو "Pharmacy" → Category = "Pharmacy"
-- إذا رأيت شعارًا أو كلمات مثل "شركة الكهرباء" أو "المياه" أو "Utility" → Category = "Utility"
-- إذا ظهرت كلمات "Market" أو "تموينات" أو "سوبرماركت" → Category = "Supermarket"
-- إذا رأيت "Transport" أو "وقود" أو "تاكسي" → Category = "Transport"
-- إذا لم يظهر أي مؤشر واضح → Category = "Other"
+def _is_mentioned(value) -> bool:
+    return value not in (None, "", [], {}) and str(value).strip().lower() not in ("not mentioned", "none", "null")
 
-القائمة الكاملة للـ Categories المسموحة فقط:
-["Cafe", "Restaurant", "Supermarket", "Pharmacy", "Clothing", "Electronics", "Utility", "Education", "Health", "Transport", "Delivery", "Other"]
 
-**Invoice_Type Detection (استخدم الكلمات المفتاحية):**
-- إذا ظهر رقم ضريبي أو "VAT Invoice" أو "فاتورة ضريبية" → Invoice_Type = "فاتورة ضريبية"
-- إذا كان النص يحتوي على "ضمان" أو "Warranty" أو "Guarantee" → Invoice_Type = "فاتورة ضمان"
-- إذا ظهر "صيانة" أو "Maintenance" أو "Repair" → Invoice_Type = "فاتورة صيانة"
-- إذا ظهر "Purchase" أو "Receipt" أو "Bill" → Invoice_Type = "فاتورة شراء"
-- إذا لم يظهر أي مؤشر واضح → Invoice_Type = "فاتورة شراء" (الافتراضي)
+def merge_page_results(pages: list[dict]) -> dict:
+    """
+    Merge per-page VLM outputs into one invoice:
+    - Items from all pages, in page order (each tagged with its page number)
+    - totals/payment fields from the last page that mentions them
+    - every other field from the first page that mentions it
+    """
+    merged = {}
+    keys = []
+    for page in pages:
+        keys.extend(k for k in page if k not in keys and k not in ("Items", "items"))
+
+    for key in keys:
+        ordered = reversed(pages) if key in LAST_PAGE_FIELDS else pages
+        values = [page.get(key) for page in ordered if key in page]
+        merged[key] = next((v for v in values if _is_mentioned(v)), values[0] if values else "Not Mentioned")
+
+    items = []
+    for page_number, page in enumerate(pages, start=1):
+        page_items = safe_get(page, "Items", "items", default=[])
+        if isinstance(page_items, list):
+            items.extend({**it, "page": page_number} for it in page_items if isinstance(it, dict))
+    merged["Items"] = items
+    return merged
+
+
+async def analyze_invoice_pages(image_urls: list[str], prompt: str, rate_limiter: TokenBucket | None = None):
+    """
+    analyze_image for one image, or for every page of a multi-page invoice in parallel
+    (each page cached separately), merged with merge_page_results.
 
-✳️ النتيجة يجب أن تكون بالعربية فقط: "فاتورة شراء" أو "فاتورة ضمان" أو "فاتورة صيانة" أو "فاتورة ضريبية" أو "أخرى"
+    Returns:
+        (parsed dict or None, raw_output of the failing page, from_cache for all pages)
+    """
+    if len(image_urls) == 1:
+        return await analyze_image(image_urls[0], prompt, rate_limiter)
 
-**استنتاج الحقول المفقودة:**
-- إذا لم يظهر "Invoice Number" → حاول البحث عن أي رقم قريب من كلمة "Invoice" أو "رقم"
-- إذا لم يظهر "Date" → ابحث عن أي تاريخ في الصورة
-- إذا لم يظهر "Vendor" → استخدم أي اسم ظاهر بشكل بارز في أعلى الفاتورة
-- إذا لم تجد "Payment Method" → حاول الاستنتاج من سياق الفاتورة (بطاقة، نقدي، إلخ)
-- إذا لم تجد أي معلومة نهائيًا → اكتب "Not Mentioned"
+    results = await asyncio.gather(*(analyze_image(url, prompt, rate_limiter) for url in image_urls))
+    for page_number, (parsed, raw_output, _) in enumerate(results, start=1):
+        if parsed is None:
+            logger.error(f"⚠️ Page {page_number}/{len(image_urls)} could not be parsed")
+            return None, raw_output, False
 
-**AI_Insight (مهم جداً):**
-- يجب أن يكون بالعربية فقط
-- اكتب 2-3 جمل تصف الشراء وسلوك الإنفاق
-- مثال: "هذه عملية شراء من مطعم وجبات سريعة، المبلغ معتدل ويدل على استهلاك يومي. تم الدفع ببطاقة ائتمانية."
+    logger.info(f"📚 Merged {len(results)} pages")
+    return merge_page_results([r[0] for r in results]), None, all(r[2] for r in results)
 
-**Formatting Rules:**
-- استخدم نفس التاريخ كما هو في الفاتورة بصيغة DD/MM/YYYY (مثل: 09/10/2025)
-- إذا كان التاريخ بصيغة أخرى، حوّله إلى DD/MM/YYYY
-- أعد الأرقام كما تظهر بدون تنسيق جديد
-- ممنوع كتابة Markdown أو ```json``` أو أي رموز إضافية
-- أخرج كائن JSON واحد صحيح فقط، بدون أي نص قبله أو بعده
 
-❌ ممنوع تمامًا:
-- ترك حقول فارغة أو null
-- كتابة شرح أو تعليق خارج JSON
-- استخدام Markdown
-- ترك أي حقل بدون قيمة
+# ================================================================
+# 🔍 Endpoint: Analyze Invoice Only (No DB Save)
+# ================================================================
+@router.post("/analyze-only")
+async def analyze_vlm_only(request: VLMRequest):
+    """
+    Analyze an invoice image using VLM but DON'T save to database.
+    Returns extracted data for user review and editing.
+    """
+    try:
+        start_time = time.time()
+        logger.info(f"🔍 Analyzing image (no save): {request.image_url}")
 
-✅ مطلوب دائمًا:
-- JSON كامل بجميع الحقول
-- استخدام "Not Mentioned" للحقول غير الواضحة
-- استنتاج ذكي قبل وضع "Not Mentioned"
-- AI_Insight بالعربية دائمًا
-"""
+        # Same prompt as /analyze endpoint
+        if not request.prompt:
+            request.prompt = INVOICE_ANALYSIS_PROMPT
 
-        # ------------------------------------------------------------
-        # 🌐 Send to FriendliAI
-        # ------------------------------------------------------------
-        headers = {
-            "Authorization": f"Bearer {FRIENDLI_TOKEN}",
-            "Content-Type": "application/json",
-        }
+        # Send to FriendliAI (or reuse a cached result for the same image + prompt)
+        parsed, raw_output, from_cache = await analyze_invoice_pages(request.all_page_urls(), request.prompt)
+        if parsed is None:
+            return {"status": "error", "raw_output": raw_output}
 
-        payload = {
-            "model": FRIENDLI_MODEL_ID,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": request.prompt},
-                        {"type": "image_url", "image_url": {"url": request.image_url}},
-                    ],
-                }
-            ],
-            "max_tokens": 16384,
-            "temperature": 0.6,
-            "top_p": 0.9,
-        }
+        elapsed = round(time.time() - start_time, 2)
+        logger.info(f"✅ Analysis completed in {elapsed}s (no save)")
+        return analysis_only_response(parsed, elapsed, from_cache)
+
+    except HTTPException:
+        raise  # 429 / 503 (circuit open) / 504 keep their status and Retry-After
+    except Exception as e:
+        logger.error(f"❌ VLM analysis failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def analysis_only_response(parsed: dict, elapsed: float, from_cache: bool) -> dict:
+    """Normalized result of /analyze-only (also the `done` event of the streaming variant)."""
+    category_raw = safe_get(parsed, "Category", "category")
+    normalized_category = normalize_category(category_raw)
+    ai_insight = safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned")
+    invoice_type_from_vlm = safe_get(parsed, "Invoice_Type", "invoice_type", default="فاتورة شراء")
 
-        response = requests.post(FRIENDLI_URL, headers=headers, json=payload)
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"Friendli API error: {response.text}")
+    # Return data for frontend to display for editing
+    return {
+        "status": "success",
+        "category": normalized_category,
+        "invoice_type": invoice_type_from_vlm,
+        "ai_insight": ai_insight,
+        "output": parsed,
+        "time_taken_seconds": elapsed,
+        "cached": from_cache,
+    }
 
-        data = response.json()
-        raw_output = data["choices"][0]["message"]["content"].strip()
 
-        if raw_output.startswith("```"):
-            raw_output = raw_output.strip("`").replace("json", "", 1).strip()
+# ================================================================
+# 📡 Endpoint: Analyze Only, streamed (SSE: field / item / done)
+# ================================================================
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+async def stream_page_events(image_url: str, prompt: str, page: int, results: list):
+    """
+    One page: cached result replayed as events, or a streamed Friendli call parsed on the fly.
+    Appends (parsed or None, from_cache, raw model output or None) to `results`.
+    """
+    cache_key, cached, image_bytes, image_sha256 = await lookup_analysis(image_url, prompt)
+    if cached is not None:
+        for key, value in cached.items():
+            if isinstance(value, list):
+                for index, item in enumerate(value):
+                    yield _sse("item", {"page": page, "key": key, "index": index, "item": item})
+            else:
+                yield _sse("field", {"page": page, "key": key, "value": value})
+        results.append((cached, True, None))
+        return
+
+    vlm_url = await prepare_vlm_image(image_url, image_bytes, image_sha256)
+    structured = uses_structured_output(prompt)
+    # No truncation retry mid-stream → budget for the largest invoice up front
+    max_tokens = size_max_tokens(VLM_MAX_ITEMS) if structured else 16384
+    payload = build_vlm_payload(vlm_url, prompt, max_tokens, structured)
+    payload["stream_options"] = {"include_usage": True}
+
+    parser = IncrementalJSONParser()
+    stats: dict = {}
+    start = time.perf_counter()
+    async for delta in stream_chat_completion(payload, stats):
+        for event in parser.feed(delta):
+            if event[0] == "field":
+                _, key, value = event
+                if isinstance(value, list) and key in parser.streamed_arrays:
+                    continue  # elements were already sent as `item` events
+                yield _sse("field", {"page": page, "key": key, "value": value})
+            else:
+                _, key, index, item = event
+                yield _sse("item", {"page": page, "key": key, "index": index, "item": item})
+
+    elapsed = time.perf_counter() - start
+    output_tokens = stats.get("completion_tokens") or stats.get("deltas")
+    extraction_metrics.record_call(elapsed, output_tokens, stats.get("finish_reason"), max_tokens, structured)
+    parsed = await finish_analysis(parser.buffer, cache_key, parser.strict_result())
+    results.append((parsed, False, parser.buffer))
+
+
+@router.post("/analyze-only/stream")
+async def analyze_vlm_only_stream(request: VLMRequest):
+    """
+    Same as /analyze-only, streamed as Server-Sent Events while the model generates:
+    - `field` {page, key, value}         - a header field is complete (vendor, date, total... come first)
+    - `item`  {page, key, index, item}   - one line item is complete
+    - `done`  same body as /analyze-only (pages merged), or `error` {detail, raw_output}
 
+    Closing the connection cancels the generator, which closes the Friendli stream (inference aborted).
+    """
+    prompt = request.prompt or INVOICE_ANALYSIS_PROMPT
+    page_urls = request.all_page_urls()
+
+    async def event_stream():
+        start_time = time.time()
+        results: list = []
         try:
-            parsed = json.loads(raw_output)
+            # Pages one after another, so the first page's fields arrive as early as possible
+            for page, url in enumerate(page_urls, start=1):
+                async for event in stream_page_events(url, prompt, page, results):
+                    yield event
+                parsed, _, raw_output = results[-1]
+                if parsed is None:
+                    yield _sse("error", {"detail": f"Could not parse page {page}", "raw_output": raw_output})
+                    return
+
+            pages = [parsed for parsed, _, _ in results]
+            parsed = pages[0] if len(pages) == 1 else merge_page_results(pages)
+            elapsed = round(time.time() - start_time, 2)
+            logger.info(f"✅ Streamed analysis completed in {elapsed}s (no save)")
+            yield _sse("done", analysis_only_response(parsed, elapsed, all(c for _, c, _ in results)))
+        except asyncio.CancelledError:
+            logger.info(f"🛑 Client closed the stream after {time.time() - start_time:.1f}s, upstream request aborted")
+            raise
+        except HTTPException as e:
+            yield _sse("error", {"detail": e.detail})
         except Exception as e:
-            logger.error(f"⚠️ JSON parse failed: {e}")
-            return {"status": "error", "raw_output": raw_output}
+            logger.error(f"❌ Streamed VLM analysis failed: {e}")
+            yield _sse("error", {"detail": str(e)})
 
-        # ------------------------------------------------------------
-        # 🧹 Normalize Data
-        # ------------------------------------------------------------
-        category_raw = safe_get(parsed, "Category", "category")
-        normalized_category = normalize_category(category_raw)
-        ai_insight = safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned")
-        raw_date = safe_get(parsed, "Date", "date", "placed_at")
-        parsed_date = parse_date(raw_date)
-        
-        # 🔍 Extract Invoice Type and Keywords from VLM response
-        invoice_type_from_vlm = safe_get(parsed, "Invoice_Type", "invoice_type", default="Other")
-        keywords_detected = safe_get(parsed, "Keywords_Detected", "keywords_detected", default=[])
-        
-        # Log detected keywords for debugging
-        logger.info(f"🔑 Keywords detected: {keywords_detected}")
-        logger.info(f"📋 Invoice type from VLM: {invoice_type_from_vlm}")
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        # ------------------------------------------------------------
-        # 💾 Save Invoice
-        # ------------------------------------------------------------
-        # 🧾 Use invoice_type from VLM if available, otherwise fallback to category
-        invoice_type_ar = invoice_type_from_vlm if invoice_type_from_vlm != "Other" else normalized_category.get("ar", "شراء")
-        
-        invoice = Invoice(
-            invoice_number=safe_get(parsed, "Invoice Number", "invoice_number"),
-            invoice_date=parsed_date,
-            vendor=safe_get(parsed, "Vendor", "vendor"),
-            tax_number=safe_get(parsed, "Tax Number", "tax_number"),
-            cashier=safe_get(parsed, "Cashier", "cashier"),
-            branch=safe_get(parsed, "Branch", "branch"),
-            phone=safe_get(parsed, "Phone", "phone"),
-            subtotal=safe_float(safe_get(parsed, "Subtotal", "sub_total")),
-            tax=safe_float(safe_get(parsed, "Tax", "total_taxes")),
-            total_amount=safe_float(safe_get(parsed, "Total Amount", "bill_total_value")),
-            grand_total=safe_float(safe_get(parsed, "Grand Total (before tax)", "grand_total")),
-            discounts=safe_float(safe_get(parsed, "Discounts", "discount")),
-            payment_method=safe_get(parsed, "Payment Method", "payment_method", "paid_by"),
-            amount_paid=safe_float(safe_get(parsed, "Amount Paid", "amount_paid")),
-            ticket_number=safe_get(parsed, "Ticket Number", "ticket_number"),
-            category=json.dumps(normalized_category, ensure_ascii=False),
-            ai_insight=ai_insight,
-            invoice_type=invoice_type_ar,  # نوع الفاتورة بالعربية
-            image_url=request.image_url,  # حفظ رابط الصورة من Supabase
-        )
-        
-        logger.info(f"🧾 Stored invoice_type: {invoice_type_ar}")
-        logger.info(f"🖼️ Stored image_url: {request.image_url}")
-
-        db.add(invoice)
-        db.commit()
-        db.refresh(invoice)
+
+def save_analyzed_output(parsed: dict, image_url: str, db: Session,
+                         on_invoice_saved: Callable[[int], None] | None = None) -> Invoice:
+    """
+    Persist a parsed VLM result: invoice row, its items, and the embedding.
+    Blocking (DB + OpenAI) - async callers run it in the threadpool.
+    on_invoice_saved(invoice_id) runs right after the invoice row is committed.
+    """
+    # ------------------------------------------------------------
+    # 🧹 Normalize Data
+    # ------------------------------------------------------------
+    category_raw = safe_get(parsed, "Category", "category")
+    normalized_category = normalize_category(category_raw)
+    ai_insight = safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned")
+    raw_date = safe_get(parsed, "Date", "date", "placed_at")
+    parsed_date = parse_date(raw_date)
+    
+    # 🔍 Extract Invoice Type and Keywords from VLM response
+    invoice_type_from_vlm = safe_get(parsed, "Invoice_Type", "invoice_type", default="Other")
+    keywords_detected = safe_get(parsed, "Keywords_Detected", "keywords_detected", default=[])
+    
+    # Log detected keywords for debugging
+    logger.info(f"🔑 Keywords detected: {keywords_detected}")
+    logger.info(f"📋 Invoice type from VLM: {invoice_type_from_vlm}")
+
+    # ------------------------------------------------------------
+    # 💾 Save Invoice
+    # ------------------------------------------------------------
+    # 🧾 Use invoice_type from VLM if available, otherwise fallback to category
+    invoice_type_ar = invoice_type_from_vlm if invoice_type_from_vlm != "Other" else normalized_category.get("ar", "شراء")
+    
+    invoice = Invoice(
+        invoice_number=safe_get(parsed, "Invoice Number", "invoice_number"),
+        invoice_date=parsed_date,
+        vendor=safe_get(parsed, "Vendor", "vendor"),
+        tax_number=safe_get(parsed, "Tax Number", "tax_number"),
+        cashier=safe_get(parsed, "Cashier", "cashier"),
+        branch=safe_get(parsed, "Branch", "branch"),
+        phone=safe_get(parsed, "Phone", "phone"),
+        subtotal=safe_float(safe_get(parsed, "Subtotal", "sub_total")),
+        tax=safe_float(safe_get(parsed, "Tax", "total_taxes")),
+        total_amount=safe_float(safe_get(parsed, "Total Amount", "bill_total_value")),
+        grand_total=safe_float(safe_get(parsed, "Grand Total (before tax)", "grand_total")),
+        discounts=safe_float(safe_get(parsed, "Discounts", "discount")),
+        payment_method=safe_get(parsed, "Payment Method", "payment_method", "paid_by"),
+        amount_paid=safe_float(safe_get(parsed, "Amount Paid", "amount_paid")),
+        ticket_number=safe_get(parsed, "Ticket Number", "ticket_number"),
+        category=json.dumps(normalized_category, ensure_ascii=False),
+        ai_insight=ai_insight,
+        invoice_type=invoice_type_ar,  # نوع الفاتورة بالعربية
+        image_url=image_url,  # حفظ رابط الصورة من Supabase
+    )
+    
+    logger.info(f"🧾 Stored invoice_type: {invoice_type_ar}")
+    logger.info(f"🖼️ Stored image_url: {image_url}")
+
+    db.add(invoice)
+    db.commit()
+    db.refresh(invoice)
+    if on_invoice_saved is not None:
+        on_invoice_saved(invoice.id)
+    link_invoice(db, image_url, invoice.id)
+
+    # ------------------------------------------------------------
+    # 🧾 Save Items
+    # ------------------------------------------------------------
+    items = safe_get(parsed, "Items", "items", default=[])
+    if isinstance(items, list):
+        for it in items:
+            db.add(Item(
+                description=it.get("description", "Unknown Item"),
+                quantity=safe_int(it.get("quantity", 1)),
+                unit_price=safe_float(it.get("unit_price", 0.0)),
+                total=safe_float(it.get("total", 0.0)),
+                invoice_id=invoice.id
+            ))
+    db.commit()
+
+    # ------------------------------------------------------------
+    # 🔢 Generate Embedding
+    # ------------------------------------------------------------
+    generate_embedding(invoice.id, json.dumps(parsed, ensure_ascii=False), db)
+    return invoice
+
+
+# ================================================================
+# 🚀 Endpoint: Analyze Invoice (Original - Saves to DB)
+# ================================================================
+@router.post("/analyze")
+async def analyze_vlm(request: VLMRequest, db: Session = Depends(get_db)):
+    """
+    Analyze an invoice image using FriendliAI Qwen2.5-VL-32B-Instruct.
+    Handles Arabic + English invoices and generates richer insights.
+    """
+    try:
+        start_time = time.time()
+        logger.info(f"🔍 Analyzing image: {request.image_url}")
+
+        if not request.prompt:
+            request.prompt = INVOICE_ANALYSIS_PROMPT
 
         # ------------------------------------------------------------
-        # 🧾 Save Items
+        # 🌐 Send to FriendliAI
         # ------------------------------------------------------------
-        items = safe_get(parsed, "Items", "items", default=[])
-        if isinstance(items, list):
-            for it in items:
-                db.add(Item(
-                    description=it.get("description", "Unknown Item"),
-                    quantity=safe_int(it.get("quantity", 1)),
-                    unit_price=safe_float(it.get("unit_price", 0.0)),
-                    total=safe_float(it.get("total", 0.0)),
-                    invoice_id=invoice.id
-                ))
-        db.commit()
+        parsed, raw_output, from_cache = await analyze_invoice_pages(request.all_page_urls(), request.prompt)
+        if parsed is None:
+            return {"status": "error", "raw_output": raw_output}
 
         # ------------------------------------------------------------
-        # 🔢 Generate Embedding
+        # 💾 Save Invoice + Items + Embedding (blocking → threadpool)
         # ------------------------------------------------------------
-        generate_embedding(invoice.id, json.dumps(parsed, ensure_ascii=False), db)
+        invoice = await run_in_threadpool(save_analyzed_output, parsed, request.image_url, db)
 
         elapsed = round(time.time() - start_time, 2)
         logger.info(f"✅ Invoice {invoice.id} processed in {elapsed}s")
@@ -532,12 +767,292 @@ async def analyze_vlm(request: VLMRequest, db: Session = Depends(get_db)):
         return {
             "status": "success",
             "invoice_id": invoice.id,
-            "category": normalized_category,
-            "ai_insight": ai_insight,
+            "category": normalize_category(safe_get(parsed, "Category", "category")),
+            "ai_insight": safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned"),
             "output": parsed,
             "time_taken_seconds": elapsed,
+            "cached": from_cache,
         }
 
+    except HTTPException:
+        raise  # 429 / 503 (circuit open) / 504 keep their status and Retry-After
     except Exception as e:
         logger.error(f"❌ VLM analysis failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+# ================================================================
+# 📊 Endpoint: VLM Cache Stats
+# ================================================================
+@router.get("/cache/stats")
+def vlm_cache_stats():
+    """Hit/miss counters and size of the VLM result cache."""
+    return vlm_cache.stats()
+
+
+@router.get("/prep/metrics")
+def vlm_prep_stats():
+    """Pre-VLM image preparation: vision tokens before/after and estimated latency saved (recent images included)."""
+    return vlm_prep_metrics.snapshot()
+
+
+@router.get("/extraction/metrics")
+def vlm_extraction_stats():
+    """Structured extraction: parse-failure rate, truncations, output tokens and latency per VLM call."""
+    return extraction_metrics.snapshot()
+
+
+# ================================================================
+# 📬 Background Jobs: POST /vlm/jobs → poll GET /vlm/jobs/{id}
+# ================================================================
+async def process_analysis_job(job: dict, set_stage) -> dict:
+    """Job handler: the same analyze-and-save flow as /vlm/analyze, run by a queue worker."""
+    start_time = time.time()
+    prompt = job.get("prompt") or INVOICE_ANALYSIS_PROMPT
+
+    page_urls = json.loads(job["page_urls"]) if job.get("page_urls") else [job["image_url"]]
+
+    await set_stage("analyzing")
+    parsed, raw_output, from_cache = await analyze_invoice_pages(page_urls, prompt)
+    if parsed is None:
+        raise NonRetryableJobError(f"JSON parse failed: {(raw_output or '')[:500]}")
+
+    invoice_id = job.get("invoice_id")
+    if invoice_id is not None:
+        # A previous attempt already committed the invoice: don't insert a duplicate
+        logger.info(f"♻️ Job {job['id']}: invoice {invoice_id} already saved, skipping save")
+    else:
+        await set_stage("saving")
+        saved = []
+
+        def record(new_id: int):
+            saved.append(new_id)
+            job_queue.record_invoice(job["id"], new_id)
+
+        db = SessionLocal()
+        try:
+            invoice = await run_in_threadpool(save_analyzed_output, parsed, job["image_url"], db, record)
+            invoice_id = invoice.id
+        except Exception as e:
+            if saved:
+                # Items / embedding failed after the invoice was committed → retrying would duplicate it
+                raise NonRetryableJobError(f"Invoice {saved[0]} saved, but a later step failed: {e}") from e
+            raise
+        finally:
+            db.close()
+
+    return {
+        "status": "success",
+        "invoice_id": invoice_id,
+        "category": normalize_category(safe_get(parsed, "Category", "category")),
+        "ai_insight": safe_get(parsed, "AI_Insight", "ai_insight", default="Not Mentioned"),
+        "output": parsed,
+        "time_taken_seconds": round(time.time() - start_time, 2),
+        "cached": from_cache,
+    }
+
+
+job_queue = AnalysisJobQueue(handler=process_analysis_job)
+
+
+@router.post("/jobs", status_code=202)
+async def create_analysis_job(request: VLMRequest):
+    """Queue an invoice for analysis and return immediately with a job_id."""
+    try:
+        job = await job_queue.enqueue(request.image_url, request.prompt, request.page_urls)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Job queue is full: {e}")
+    return job_to_response(job)
+
+
+@router.get("/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    """Current status, stage and (when done) the analysis result of a job."""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_to_response(job)
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_analysis_job(job_id: str):
+    """Server-Sent Events: a `progress` event on every stage change, then `done` or `error`."""
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        last_seen = None
+        while True:
+            job = await job_queue.get(job_id)
+            if job is None:
+                yield "event: error\ndata: {\"detail\": \"Job not found\"}\n\n"
+                return
+            response = job_to_response(job)
+            state = (response["status"], response["stage"])
+            if state != last_seen:
+                last_seen = state
+                event = response["status"] if response["status"] in ("done", "error") else "progress"
+                yield f"event: {event}\ndata: {json.dumps(response, ensure_ascii=False, default=str)}\n\n"
+                if event != "progress":
+                    return
+            await job_queue.wait_for_update(job_id, timeout=VLM_JOB_SSE_POLL_SECONDS)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ================================================================
+# 📦 Batch Analysis (rate-limit-aware, streamed as NDJSON)
+# ================================================================
+class VLMBatchRequest(BaseModel):
+    image_urls: list[str] = Field(..., min_length=1)
+    prompt: str | None = None
+    save: bool = True
+    requests_per_minute: float | None = None
+    max_concurrency: int | None = None
+
+
+async def _run_batch_item(index: int, source, prompt: str, save: bool,
+                          bucket: TokenBucket, semaphore: asyncio.Semaphore, counters: dict) -> dict:
+    """Analyze one batch item; 429s pause the shared bucket and the item is retried."""
+    item_start = time.time()
+    image_url = source if isinstance(source, str) else None
+    page_urls = [image_url]
+    attempts = 0
+
+    async with semaphore:
+        try:
+            if image_url is None:
+                # Uploaded file → same storage + auto-fix path as /upload
+                from backend.routers.upload import upload_invoice
+                uploaded = await upload_invoice(source)
+                image_url = uploaded["url"]
+                page_urls = uploaded.get("page_urls") or [image_url]
+
+            while True:
+                attempts += 1
+                try:
+                    parsed, raw_output, from_cache = await analyze_invoice_pages(page_urls, prompt, rate_limiter=bucket)
+                    break
+                except FriendliRateLimitError as e:
+                    counters["rate_limited"] += 1
+                    bucket.pause(e.retry_after)
+                    if attempts > VLM_BATCH_MAX_RETRIES:
+                        raise
+
+            if parsed is None:
+                raise ValueError(f"JSON parse failed: {(raw_output or '')[:300]}")
+
+            invoice_id = None
+            if save:
+                db = SessionLocal()
+                try:
+                    invoice = await run_in_threadpool(save_analyzed_output, parsed, image_url, db)
+                    invoice_id = invoice.id
+                finally:
+                    db.close()
+
+            counters["succeeded"] += 1
+            counters["cached"] += int(from_cache)
+            return {
+                "type": "item", "index": index, "image_url": image_url, "status": "success",
+                "invoice_id": invoice_id, "cached": from_cache, "attempts": attempts,
+                "output": parsed, "time_taken_seconds": round(time.time() - item_start, 2),
+            }
+        except Exception as e:
+            counters["failed"] += 1
+            logger.error(f"❌ Batch item {index} failed: {e}")
+            return {
+                "type": "item", "index": index, "image_url": image_url, "status": "error",
+                "error": str(e), "attempts": attempts,
+                "time_taken_seconds": round(time.time() - item_start, 2),
+            }
+        finally:
+            if not isinstance(source, str):
+                await source.close()  # drop the temp file as soon as the item is done
+
+
+def _stream_batch(sources: list, prompt: str | None, save: bool,
+                  requests_per_minute: float | None, max_concurrency: int | None) -> StreamingResponse:
+    if len(sources) > VLM_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {VLM_BATCH_MAX_ITEMS} items)")
+
+    rpm = min(requests_per_minute or VLM_BATCH_REQUESTS_PER_MINUTE, VLM_BATCH_REQUESTS_PER_MINUTE)
+    concurrency = max(1, min(max_concurrency or VLM_BATCH_MAX_CONCURRENCY, VLM_BATCH_MAX_CONCURRENCY))
+    prompt = prompt or INVOICE_ANALYSIS_PROMPT
+
+    async def ndjson():
+        start = time.time()
+        bucket = TokenBucket(rate_per_minute=rpm)
+        semaphore = asyncio.Semaphore(concurrency)
+        counters = {"succeeded": 0, "failed": 0, "cached": 0, "rate_limited": 0}
+        logger.info(f"📦 Batch of {len(sources)} started (rpm={rpm}, concurrency={concurrency})")
+
+        tasks = [
+            asyncio.create_task(_run_batch_item(i, src, prompt, save, bucket, semaphore, counters))
+            for i, src in enumerate(sources)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished, ensure_ascii=False, default=str) + "\n"
+        finally:
+            # Client disconnected → stop scheduling the rest (and drop uploads never started)
+            for task in tasks:
+                task.cancel()
+            for src in sources:
+                if not isinstance(src, str):
+                    await src.close()
+
+        elapsed = time.time() - start
+        summary = {
+            "type": "summary",
+            "total": len(sources),
+            **counters,
+            "elapsed_seconds": round(elapsed, 2),
+            "throughput_per_minute": round(len(sources) / elapsed * 60, 2) if elapsed > 0 else None,
+            "rate_limit_wait_seconds": round(bucket.total_wait_seconds, 2),
+            "requests_per_minute": rpm,
+            "max_concurrency": concurrency,
+        }
+        logger.info(f"📦 Batch finished: {summary}")
+        yield json.dumps(summary, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@router.post("/batch")
+async def analyze_batch(request: VLMBatchRequest):
+    """
+    Analyze many invoice images. Results stream back as NDJSON, one `item` line per image
+    as it finishes, then a final `summary` line (throughput, failures, cache hits, 429s).
+    """
+    return _stream_batch(request.image_urls, request.prompt, request.save,
+                         request.requests_per_minute, request.max_concurrency)
+
+
+@router.post("/batch/upload")
+async def analyze_batch_upload(
+    files: list[UploadFile] = File(...),
+    prompt: str | None = Form(None),
+    save: bool = Form(True),
+    requests_per_minute: float | None = Form(None),
+    max_concurrency: int | None = Form(None),
+):
+    """
+    Same as /vlm/batch but for uploaded files (each goes through the /upload pipeline first).
+    The whole request is capped by UploadSizeLimitMiddleware (UPLOAD_BATCH_MAX_BYTES).
+    """
+    if len(files) > VLM_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {VLM_BATCH_MAX_ITEMS} items)")
+
+    # The multipart files are closed once this handler returns, so each one is copied to a
+    # temp file on disk for the stream (closed when its item finishes), never held in memory
+    sources = []
+    try:
+        for f in files:
+            sources.append(await detach_upload(f))  # per-file size limit (413)
+    except BaseException:
+        for source in sources:
+            await source.close()
+        raise
+    return _stream_batch(sources, prompt, save, requests_per_minute, max_concurrency)
@@ -0,0 +1,53 @@
+"""
+🧱 Schema Upgrades
+==================
+أعمدة أُضيفت للنماذج بعد إنشاء الجداول: Base.metadata.create_all لا يعدّل جدولاً موجوداً،
+فتُضاف هنا عند بدء التشغيل (ADD COLUMN IF NOT EXISTS) بدل تشغيل ملفات backend/migrations يدوياً.
+
+- يُقرأ information_schema أولاً، فلا يُنفَّذ ALTER TABLE (وقفله) إلا للأعمدة الناقصة فعلاً
+- الإضافة بدون DEFAULT → تعديل على الـ catalog فقط، بدون إعادة كتابة الجدول
+"""
+
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("backend.schema_upgrades")
+
+# (table, column, type) - keep in sync with the models and backend/migrations/*.sql
+ADDED_COLUMNS: List[Tuple[str, str, str]] = [
+    ("invoices", "thumbnail_url", "TEXT"),        # backend/migrations/add_thumbnail_url_columns.sql
+    ("uploaded_files", "thumbnail_url", "TEXT"),
+    ("uploaded_files", "medium_url", "TEXT"),
+    ("vlm_jobs", "page_urls", "TEXT"),
+    ("vlm_jobs", "invoice_id", "INTEGER"),
+]
+
+
+def ensure_columns(engine: Engine) -> List[str]:
+    """
+    يضيف الأعمدة الناقصة من ADDED_COLUMNS إلى الجداول الموجودة.
+
+    Returns:
+        list: الأعمدة التي أُضيفت ("table.column")
+    """
+    added = []
+    with engine.begin() as conn:
+        existing = {
+            (row[0], row[1])
+            for row in conn.execute(text(
+                "SELECT table_name, column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema()"
+            ))
+        }
+        tables = {table for table, _ in existing}
+        for table, column, sql_type in ADDED_COLUMNS:
+            if table not in tables or (table, column) in existing:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {sql_type}"))
+            added.append(f"{table}.{column}")
+    if added:
+        logger.info(f"🧱 Added missing columns: {', '.join(added)}")
+    return added
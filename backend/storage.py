@@ -0,0 +1,181 @@
+"""
+🗄️ Storage Backends
+===================
+واجهة تخزين موحدة (put / get / delete / url) لصور الفواتير.
+
+Backends (STORAGE_BACKEND):
+- supabase → Supabase Storage (الافتراضي)
+- local    → ملفات على القرص في STORAGE_LOCAL_DIR، تُخدم عبر GET /files/{path}
+             (مفيد للتطوير واختبارات الحمل بدون الخدمة الحقيقية). يجب تفعيله صراحةً:
+             نقص بيانات Supabase في الإنتاج يظهر كخطأ بدل أن تُحفظ الفواتير على قرص الحاوية
+
+لا يُنشأ أي عميل Supabase عند الاستيراد، فالتطبيق يعمل بدون بيانات الاعتماد.
+
+Configuration:
+- STORAGE_BACKEND           (default supabase | local)
+- STORAGE_LOCAL_DIR         (default .storage)
+- STORAGE_PUBLIC_BASE_URL   (default http://localhost:8000) أساس روابط الـ local backend
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger("backend.storage")
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+SUPABASE_ANON_KEY = os.getenv("SUPABASE_KEY")
+# Use service role key for admin operations (upload/delete)
+SUPABASE_KEY = SUPABASE_SERVICE_KEY or SUPABASE_ANON_KEY
+BUCKET_NAME = "invoices"
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", ".storage")
+STORAGE_PUBLIC_BASE_URL = os.getenv("STORAGE_PUBLIC_BASE_URL", "http://localhost:8000").rstrip("/")
+
+
+class StorageBackend:
+    """Minimal object-store interface. All methods are blocking - async callers use the threadpool."""
+
+    name = "base"
+
+    def put(self, path: str, data: bytes, content_type: str) -> str:
+        """Store data at path (overwriting) and return its public URL."""
+        raise NotImplementedError
+
+    def get(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    def delete(self, path: str):
+        raise NotImplementedError
+
+    def url(self, path: str) -> str:
+        raise NotImplementedError
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        """The storage key behind one of our public URLs, or None when the URL points elsewhere."""
+        prefix = self.url("")
+        if url.startswith(prefix) and len(url) > len(prefix):
+            return url[len(prefix):].split("?", 1)[0]
+        return None
+
+
+# ================================================================
+# ☁️ Supabase Storage
+# ================================================================
+class SupabaseStorage(StorageBackend):
+    name = "supabase"
+
+    def __init__(self, url: Optional[str] = SUPABASE_URL, key: Optional[str] = SUPABASE_KEY,
+                 bucket: str = BUCKET_NAME):
+        self.base_url = url
+        self.key = key
+        self.bucket = bucket
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _bucket(self):
+        """Create the client on first use (not at import), so missing credentials only fail real calls."""
+        with self._lock:
+            if self._client is None:
+                if not self.base_url or not self.key:
+                    raise RuntimeError("❌ Missing Supabase credentials in .env")
+                from supabase import create_client
+
+                # Log which key is being used (masked for security)
+                if SUPABASE_SERVICE_KEY:
+                    logger.info(f"🔑 Using SERVICE ROLE KEY: ...{SUPABASE_SERVICE_KEY[-10:]}")
+                else:
+                    logger.warning(f"⚠️ Using ANON KEY (may have limited permissions): ...{self.key[-10:]}")
+                self._client = create_client(self.base_url, self.key)
+        return self._client.storage.from_(self.bucket)
+
+    def put(self, path, data, content_type):
+        logger.info(f"📤 Uploading {path} to bucket {self.bucket}")
+        res = self._bucket().upload(
+            path=path,
+            file=data,
+            file_options={
+                "content-type": content_type,
+                "cache-control": "3600",
+                "upsert": "true"
+            }
+        )
+        logger.info(f"✅ Upload response: {res}")
+        return self.url(path)
+
+    def get(self, path):
+        return self._bucket().download(path)
+
+    def delete(self, path):
+        self._bucket().remove([path])
+
+    def url(self, path):
+        return f"{self.base_url}/storage/v1/object/public/{self.bucket}/{path}"
+
+
+# ================================================================
+# 💽 Local disk
+# ================================================================
+class LocalDiskStorage(StorageBackend):
+    """Files under `root`; writes are atomic (temp file + fsync + os.replace)."""
+
+    name = "local"
+
+    def __init__(self, root: str = STORAGE_LOCAL_DIR, public_base_url: str = STORAGE_PUBLIC_BASE_URL):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.public_base_url = public_base_url
+
+    def local_path(self, path: str) -> Path:
+        """Absolute path for a storage key; rejects keys that escape the root (../)."""
+        full = (self.root / path.lstrip("/")).resolve()
+        if full != self.root and self.root not in full.parents:
+            raise ValueError(f"Invalid storage path: {path}")
+        return full
+
+    def put(self, path, data, content_type):
+        dst = self.local_path(path)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, dst)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        logger.info(f"💾 Stored {path} ({len(data)} bytes) on local disk")
+        return self.url(path)
+
+    def get(self, path):
+        return self.local_path(path).read_bytes()
+
+    def delete(self, path):
+        self.local_path(path).unlink(missing_ok=True)
+
+    def url(self, path):
+        return f"{self.public_base_url}/files/{path.lstrip('/')}"
+
+
+_storage: Optional[StorageBackend] = None
+
+
+def get_storage() -> StorageBackend:
+    """The configured backend (created lazily, once per process)."""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "local":
+            _storage = LocalDiskStorage()
+        else:
+            _storage = SupabaseStorage()
+        logger.info(f"🗄️ Storage backend: {_storage.name}")
+    return _storage
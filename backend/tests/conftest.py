@@ -0,0 +1,11 @@
+"""
+🧪 pytest setup: `make test` runs `pytest backend/` from the repo root,
+so make the `backend` package importable regardless of the import mode.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
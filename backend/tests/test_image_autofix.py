@@ -0,0 +1,75 @@
+"""
+Page orientation in backend/utils_image_autofix.py (Tesseract OSD is faked, OpenCV is real).
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from backend import utils_image_autofix as autofix  # noqa: E402
+
+
+def receipt_page() -> "np.ndarray":
+    """Portrait page with horizontal text lines and a heavy header block at the top."""
+    page = np.full((900, 600, 3), 255, dtype=np.uint8)
+    page[40:120, 60:540] = 0  # header / logo
+    for y in range(180, 860, 36):
+        page[y:y + 14, 60:60 + 80 + (y * 7) % 400] = 0
+    return page
+
+
+def fake_osd(img) -> int:
+    """Stand-in for Tesseract: the page is upright when the header block is in the top half."""
+    ink = (cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) < 128).sum(axis=1)
+    top, bottom = ink[: len(ink) // 2].sum(), ink[len(ink) // 2:].sum()
+    return 0 if top >= bottom else 180
+
+
+@pytest.fixture
+def osd(monkeypatch):
+    calls = []
+
+    def detect(img):
+        calls.append(img.shape)
+        return fake_osd(img)
+
+    monkeypatch.setattr(autofix, "TESSERACT_AVAILABLE", True)
+    monkeypatch.setattr(autofix, "detect_osd_angle", detect)
+    return calls
+
+
+def test_line_axis_is_horizontal_for_both_flips():
+    page = receipt_page()
+    for img in (page, cv2.rotate(page, cv2.ROTATE_180)):
+        vertical, confidence = autofix.classify_line_axis(img)
+        assert not vertical
+        assert confidence >= autofix.AUTOFIX_ORIENTATION_MIN_CONFIDENCE
+
+
+def test_upside_down_page_is_flipped(osd):
+    page = receipt_page()
+    flipped = cv2.rotate(page, cv2.ROTATE_180)
+    timings = {}
+
+    angle = autofix.detect_orientation(flipped, timings)
+
+    assert angle == 180
+    assert osd, "a confident horizontal line axis must not skip OSD"
+    assert "orientation_osd" in timings
+    assert np.array_equal(autofix.rotate_right_angle(flipped, angle), page)
+
+
+def test_upright_page_is_left_alone(osd):
+    assert autofix.detect_orientation(receipt_page()) == 0
+    assert len(osd) == 1
+
+
+def test_osd_answer_on_the_other_axis_is_rejected(monkeypatch, osd):
+    monkeypatch.setattr(autofix, "detect_osd_angle", lambda img: 90)
+    assert autofix.detect_orientation(receipt_page()) == 0
+
+
+def test_no_rotation_without_osd(monkeypatch):
+    monkeypatch.setattr(autofix, "TESSERACT_AVAILABLE", False)
+    assert autofix.detect_orientation(cv2.rotate(receipt_page(), cv2.ROTATE_180)) == 0
@@ -0,0 +1,91 @@
+"""
+Tolerant / incremental JSON parsing of VLM output (backend/json_salvage.py).
+"""
+
+import json
+
+from backend.json_salvage import IncrementalJSONParser, salvage_json
+
+INVOICE = {
+    "Invoice Number": "INV-001",
+    "Vendor": "مطعم البيك",
+    "Items": [
+        {"description": "وجبة دجاج", "quantity": 2, "unit_price": 15.5},
+        {"description": "بيبسي", "quantity": 1, "unit_price": 3},
+    ],
+    "Total Amount": 34.0,
+}
+
+
+def test_valid_object_is_complete():
+    raw = json.dumps(INVOICE, ensure_ascii=False)
+    assert salvage_json(raw) == (INVOICE, True)
+
+
+def test_markdown_fences_and_prose_are_ignored():
+    raw = "Here is the invoice:\n```json\n" + json.dumps(INVOICE, ensure_ascii=False, indent=2) + "\n```\nDone."
+    assert salvage_json(raw) == (INVOICE, True)
+
+
+def test_truncated_mid_string_keeps_finished_fields():
+    raw = '{"Invoice Number": "INV-001", "Vendor": "مطعم الب'
+    data, complete = salvage_json(raw)
+    assert not complete
+    assert data == {"Invoice Number": "INV-001"}
+
+
+def test_truncated_mid_items_keeps_finished_elements():
+    raw = json.dumps(INVOICE, ensure_ascii=False)
+    cut = raw.index('"بيبسي"')
+    data, complete = salvage_json(raw[:cut])
+    assert not complete
+    assert data["Vendor"] == "مطعم البيك"
+    assert data["Items"] == INVOICE["Items"][:1]
+    assert "Total Amount" not in data
+
+
+def test_trailing_commas():
+    raw = '{"Vendor": "X", "Items": [{"description": "a"}, {"description": "b"},], "Total Amount": 5,}'
+    data, complete = salvage_json(raw)
+    assert not complete  # json.loads rejects it, the fields are still there
+    assert data == {"Vendor": "X", "Items": [{"description": "a"}, {"description": "b"}], "Total Amount": 5}
+
+
+def test_bad_field_between_good_ones_is_dropped():
+    raw = '{"Vendor": "X", "Tax": 15%, "Total Amount": 5}'
+    data, complete = salvage_json(raw)
+    assert not complete
+    assert data == {"Vendor": "X", "Total Amount": 5}
+
+
+def test_nothing_usable():
+    assert salvage_json("") == (None, False)
+    assert salvage_json("I could not read this image.") == (None, False)
+
+
+def test_char_by_char_feed_emits_events_in_order():
+    raw = "```json\n" + json.dumps(INVOICE, ensure_ascii=False) + "\n```"
+    parser = IncrementalJSONParser()
+    events = []
+    for ch in raw:
+        events.extend(parser.feed(ch))
+
+    assert events == [
+        ("field", "Invoice Number", "INV-001"),
+        ("field", "Vendor", "مطعم البيك"),
+        ("item", "Items", 0, INVOICE["Items"][0]),
+        ("item", "Items", 1, INVOICE["Items"][1]),
+        ("field", "Items", INVOICE["Items"]),
+        ("field", "Total Amount", 34.0),
+    ]
+    assert parser.finished
+    assert parser.strict_result() == INVOICE
+    assert parser.streamed_arrays == {"Items"}
+
+
+def test_header_fields_arrive_before_items_finish():
+    parser = IncrementalJSONParser()
+    first = parser.feed('{"Vendor": "X", "Items": [{"description": "a"}, {"descr')
+    assert first == [("field", "Vendor", "X"), ("item", "Items", 0, {"description": "a"})]
+    assert parser.result() == {"Vendor": "X", "Items": [{"description": "a"}]}
+    assert parser.strict_result() is None
@@ -0,0 +1,137 @@
+"""
+Circuit breaker / retry behaviour of backend/resilience.py (pure Python, no provider needed).
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from backend.resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy
+from fastapi import HTTPException
+
+
+def make_policy(**kwargs) -> ResiliencePolicy:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=0.05)
+    return ResiliencePolicy("test", deadline=1.0, max_attempts=kwargs.pop("max_attempts", 1),
+                            base_delay=0.0, max_delay=0.0, breaker=breaker, **kwargs)
+
+
+def open_breaker(policy: ResiliencePolicy):
+    def bad_gateway():
+        raise HTTPException(status_code=502)
+
+    with pytest.raises(HTTPException):
+        policy.call(bad_gateway)
+    assert policy.breaker.state == "open"
+    with pytest.raises(CircuitOpenError) as rejected:
+        policy.call(lambda: "ok")
+    assert rejected.value.status_code == 503
+    assert rejected.value.headers == {"Retry-After": "1"}
+    time.sleep(0.06)
+    assert policy.breaker.state == "half_open"
+
+
+def test_transient_errors_are_retried():
+    policy = make_policy(max_attempts=3)
+    policy.breaker.failure_threshold = 10
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise HTTPException(status_code=503)
+        return "ok"
+
+    assert policy.call(flaky) == "ok"
+    assert policy.retries == 2
+
+
+def test_client_errors_are_not_retried():
+    policy = make_policy(max_attempts=3)
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise HTTPException(status_code=400)
+
+    with pytest.raises(HTTPException):
+        policy.call(bad_request)
+    assert len(calls) == 1
+    assert policy.breaker.state == "closed"
+
+
+def test_successful_probe_closes_the_circuit():
+    policy = make_policy()
+    open_breaker(policy)
+    assert policy.call(lambda: "ok") == "ok"
+    assert policy.breaker.state == "closed"
+
+
+def test_cancelled_async_probe_frees_the_slot():
+    policy = make_policy()
+    open_breaker(policy)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(10)
+
+        probe = asyncio.ensure_future(policy.acall(hang))
+        await started.wait()
+        # while the probe is in flight everyone else fails fast
+        with pytest.raises(CircuitOpenError):
+            await policy.acall(asyncio.sleep, 0, result="ok")
+        probe.cancel()  # e.g. the SSE client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def ok():
+            return "ok"
+
+        return await policy.acall(ok)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert policy.breaker.state == "closed"
+
+
+def test_cancelled_stream_probe_frees_the_slot():
+    policy = make_policy()
+    open_breaker(policy)
+
+    async def scenario():
+        async def hanging_stream():
+            await asyncio.sleep(10)
+            yield "never"
+
+        async def consume():
+            return [chunk async for chunk in policy.astream(hanging_stream)]
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        async def stream():
+            yield "a"
+            yield "b"
+
+        return [chunk async for chunk in policy.astream(stream)]
+
+    assert asyncio.run(scenario()) == ["a", "b"]
+    assert policy.breaker.state == "closed"
+
+
+def test_interrupted_sync_probe_frees_the_slot():
+    policy = make_policy()
+    open_breaker(policy)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        policy.call(interrupted)
+    assert policy.call(lambda: "ok") == "ok"
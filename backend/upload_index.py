@@ -0,0 +1,112 @@
+"""
+🗂️ Upload Index (content-addressed storage)
+===========================================
+SHA-256 لمحتوى الملف المرفوع → الرابط المخزن (ورقم الفاتورة إن وُجد).
+
+- رفع نفس الملف مرة أخرى يرجع الرابط الموجود بدون أي اتصال بالتخزين
+- مسار التخزين مشتق من الـ hash، فلا يطغى ملف على آخر بنفس الاسم
+"""
+
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from backend.database import SessionLocal
+from backend.models.invoice_model import Invoice
+from backend.models.upload_model import UploadedFile
+
+logger = logging.getLogger("backend.upload_index")
+
+
+def content_path(sha256: str, extension: str, page_number: int = 1) -> str:
+    """Storage key for content: ab/abcdef....jpg (page N > 1 → ..._pN.jpg)"""
+    suffix = f"_p{page_number}" if page_number > 1 else ""
+    return f"{sha256[:2]}/{sha256}{suffix}{extension}"
+
+
+_CONTENT_KEY = re.compile(r"^[0-9a-f]{2}/(?P<sha>[0-9a-f]{64})(?P<page>_p\d+)?\.[A-Za-z0-9]+$")
+
+
+def content_id(storage_key: str) -> Optional[str]:
+    """
+    Inverse of content_path: the upload's SHA-256 (plus _pN for later pages) behind a storage key,
+    or None for keys that aren't content-addressed uploads.
+    """
+    match = _CONTENT_KEY.match(storage_key)
+    if match is None:
+        return None
+    return match.group("sha") + (match.group("page") or "")
+
+
+def _to_response(row: UploadedFile) -> Dict[str, Any]:
+    return {
+        "url": row.url,
+        "page_urls": json.loads(row.page_urls) if row.page_urls else [row.url],
+        "invoice_id": row.invoice_id,
+        "size_bytes": row.size_bytes,
+        "sha256": row.sha256,
+        "thumbnail_url": row.thumbnail_url,
+        "medium_url": row.medium_url,
+    }
+
+
+def find_upload(sha256: str) -> Optional[Dict[str, Any]]:
+    """Blocking (DB) - async callers run it in the threadpool."""
+    db = SessionLocal()
+    try:
+        row = db.query(UploadedFile).filter(UploadedFile.sha256 == sha256).first()
+        return _to_response(row) if row else None
+    finally:
+        db.close()
+
+
+def record_upload(sha256: str, url: str, page_urls: List[str], storage_path: str,
+                  content_type: str, size_bytes: int, thumbnail_url: Optional[str] = None,
+                  medium_url: Optional[str] = None):
+    """Index a freshly stored upload (a concurrent identical upload may have won the race - that's fine)."""
+    db = SessionLocal()
+    try:
+        db.add(UploadedFile(
+            sha256=sha256, url=url, page_urls=json.dumps(page_urls), storage_path=storage_path,
+            content_type=content_type, size_bytes=size_bytes,
+            thumbnail_url=thumbnail_url, medium_url=medium_url,
+        ))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+    finally:
+        db.close()
+
+
+def link_invoice(db: Session, image_url: str, invoice_id: int):
+    """Remember which invoice was created from an upload (the first one wins) and copy its thumbnail."""
+    if not image_url:
+        return
+    try:
+        db.query(UploadedFile).filter(
+            UploadedFile.url == image_url, UploadedFile.invoice_id.is_(None)
+        ).update({"invoice_id": invoice_id}, synchronize_session=False)
+        row = db.query(UploadedFile.thumbnail_url).filter(UploadedFile.url == image_url).first()
+        if row and row.thumbnail_url:
+            db.query(Invoice).filter(Invoice.id == invoice_id).update(
+                {"thumbnail_url": row.thumbnail_url}, synchronize_session=False
+            )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"⚠️ Could not link upload {image_url} to invoice {invoice_id}: {e}")
+
+
+def set_derivatives(db: Session, image_url: str, thumbnail_url: str, medium_url: Optional[str]):
+    """Backfill: attach renditions to the upload row and every invoice showing this image."""
+    db.query(UploadedFile).filter(UploadedFile.url == image_url).update(
+        {"thumbnail_url": thumbnail_url, "medium_url": medium_url}, synchronize_session=False
+    )
+    db.query(Invoice).filter(Invoice.image_url == image_url).update(
+        {"thumbnail_url": thumbnail_url}, synchronize_session=False
+    )
+    db.commit()
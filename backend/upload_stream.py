@@ -0,0 +1,242 @@
+"""
+🌊 Streaming Uploads
+====================
+قراءة الملفات المرفوعة على دفعات (chunks) بدلاً من await file.read() دفعة واحدة.
+
+Features:
+- رفض مبكر للملفات الكبيرة (413): من Content-Length قبل قراءة الـ body، وأثناء القراءة للطلبات بدون طول
+- SHA-256 والحجم يُحسبان أثناء القراءة (بدون نسخة إضافية)
+- دفعات الملفات (/vlm/batch/upload): حد إجمالي للطلب، وكل ملف يُنسخ إلى ملف مؤقت على القرص
+  (detach_upload) بدل إبقاء bytes جميع الملفات في الذاكرة حتى تنتهي الدفعة
+- الـ body يبقى في SpooledTemporaryFile (ذاكرة حتى 1MB ثم القرص) إلى أن نحتاج الـ bytes فعلاً
+- قياس أقصى عدد bytes محجوزة في الذاكرة لكل طلب (GET /upload/memory/metrics)
+
+Configuration:
+- UPLOAD_MAX_BYTES    (default 25MB) أقصى حجم للملف الواحد
+- UPLOAD_CHUNK_SIZE   (default 1MB)
+- UPLOAD_BATCH_MAX_BYTES  (default 512MB) أقصى حجم لطلب /vlm/batch/upload كاملاً
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Iterable
+
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+logger = logging.getLogger("backend.upload_stream")
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_BATCH_MAX_BYTES = int(os.getenv("UPLOAD_BATCH_MAX_BYTES", str(512 * 1024 * 1024)))
+_MULTIPART_OVERHEAD = 64 * 1024  # boundaries + part headers on top of the file itself
+_PEAK_WINDOW = 500
+
+
+# ================================================================
+# 📏 Early size limit (ASGI middleware - runs before multipart parsing)
+# ================================================================
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized upload requests with 413 before the body is buffered.
+    One instance per limit: single-file /upload (UPLOAD_MAX_BYTES), whole /vlm/batch/upload requests
+    (UPLOAD_BATCH_MAX_BYTES).
+
+    - Content-Length above the limit → 413 without reading the body
+    - no Content-Length (chunked) → count bytes as they arrive and stop at the limit
+    """
+
+    def __init__(self, app, max_bytes: int = UPLOAD_MAX_BYTES, paths: Iterable[str] = ("/upload", "/upload/"),
+                 what: str = "File"):
+        self.app = app
+        self.max_body = max_bytes + _MULTIPART_OVERHEAD
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+        self.what = what
+
+    async def _reject(self, send):
+        upload_memory_metrics.record_rejection()
+        body = json.dumps({"detail": f"{self.what} too large (max {self.max_bytes} bytes)"}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body:
+            logger.warning(f"🚫 Upload rejected early: Content-Length {int(content_length)} > {self.max_body}")
+            await self._reject(send)
+            return
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request" and not rejected:
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    rejected = True
+                    logger.warning(f"🚫 Upload rejected while streaming: more than {self.max_body} bytes")
+                    await self._reject(send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+
+# ================================================================
+# 🌊 Chunked read + hash
+# ================================================================
+@dataclass
+class SpooledUpload:
+    """An uploaded file still sitting in its spooled temp file, with size and SHA-256 known."""
+
+    upload: UploadFile
+    size: int
+    sha256: str
+
+    async def read_bytes(self) -> bytes:
+        """Materialize the payload once, when a consumer really needs contiguous bytes."""
+        await self.upload.seek(0)
+        return await self.upload.read()
+
+
+async def spool_upload(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES,
+                       chunk_size: int = UPLOAD_CHUNK_SIZE) -> SpooledUpload:
+    """
+    Read the upload in chunks: hash and count on the fly, 413 as soon as max_bytes is crossed.
+    Only one chunk is held in memory at a time; the body stays in Starlette's SpooledTemporaryFile.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    await upload.seek(0)
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            upload_memory_metrics.record_rejection()
+            raise HTTPException(status_code=413, detail=f"File too large (max {max_bytes} bytes)")
+        digest.update(chunk)
+    await upload.seek(0)
+    return SpooledUpload(upload=upload, size=size, sha256=digest.hexdigest())
+
+
+async def detach_upload(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES,
+                        chunk_size: int = UPLOAD_CHUNK_SIZE) -> UploadFile:
+    """
+    Copy an upload into our own temp file on disk, chunk by chunk (413 past max_bytes).
+
+    Multipart files are closed when the handler returns, but a streamed batch response
+    consumes them later; the copy lives until the caller closes it and never sits in memory.
+    """
+    tmp = tempfile.TemporaryFile()
+    size = 0
+    try:
+        await upload.seek(0)
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                upload_memory_metrics.record_rejection()
+                raise HTTPException(status_code=413, detail=f"File too large (max {max_bytes} bytes)")
+            await run_in_threadpool(tmp.write, chunk)
+        tmp.seek(0)
+    except BaseException:
+        tmp.close()
+        raise
+    return UploadFile(
+        file=tmp,
+        size=size,
+        filename=upload.filename,
+        headers=Headers({"content-type": upload.content_type or "application/octet-stream"}),
+    )
+
+
+# ================================================================
+# 📊 Per-request memory accounting
+# ================================================================
+@dataclass
+class RequestMemoryTracker:
+    """
+    Explicit accounting of the large buffers a request holds (original, page renders, fixed image...).
+    `peak` is the most bytes held at the same time during the request.
+    """
+
+    held: Dict[str, int] = field(default_factory=dict)
+    peak: int = 0
+
+    def hold(self, label: str, nbytes: int):
+        self.held[label] = nbytes
+        self.peak = max(self.peak, sum(self.held.values()))
+
+    def release(self, *labels: str):
+        for label in labels:
+            self.held.pop(label, None)
+
+    @property
+    def current(self) -> int:
+        return sum(self.held.values())
+
+
+class UploadMemoryMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peaks: deque = deque(maxlen=_PEAK_WINDOW)
+        self.requests = 0
+        self.rejected_too_large = 0
+        self.max_peak_bytes = 0
+
+    def record(self, tracker: RequestMemoryTracker):
+        with self._lock:
+            self.requests += 1
+            self._peaks.append(tracker.peak)
+            self.max_peak_bytes = max(self.max_peak_bytes, tracker.peak)
+
+    def record_rejection(self):
+        with self._lock:
+            self.rejected_too_large += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            ordered = sorted(self._peaks)
+
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] if ordered else 0
+
+        return {
+            "max_upload_bytes": UPLOAD_MAX_BYTES,
+            "requests": self.requests,
+            "rejected_too_large": self.rejected_too_large,
+            "peak_bytes_p50": pct(0.50),
+            "peak_bytes_p95": pct(0.95),
+            "peak_bytes_max": self.max_peak_bytes,
+        }
+
+
+upload_memory_metrics = UploadMemoryMetrics()
@@ -2,8 +2,12 @@ from openai import OpenAI
 import os
 import json
 from backend.models.embedding_model import InvoiceEmbedding
+from backend.embedding_index import add_to_embedding_index
+from backend.vector_index import schedule_index_maintenance
+from backend.resilience import openai_embeddings_policy
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are done by backend/resilience.py (with a breaker), not by the SDK
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 def generate_embedding(invoice_id: int, invoice_data, db):
     """
@@ -31,9 +35,11 @@ def generate_embedding(invoice_id: int, invoice_data, db):
         full_text = json.dumps(invoice_data, ensure_ascii=False)
 
     # Generate embedding from OpenAI
-    response = client.embeddings.create(
+    response = openai_embeddings_policy.call(
+        client.embeddings.create,
         model="text-embedding-3-small",
-        input=full_text
+        input=full_text,
+        timeout=openai_embeddings_policy.deadline,
     )
 
     embedding = response.data[0].embedding
@@ -43,4 +49,10 @@ def generate_embedding(invoice_id: int, invoice_data, db):
     db.add(emb)
     db.commit()
     db.refresh(emb)
+
+    # Keep the in-process index (RAG_ENGINE=memory) current without a reload
+    add_to_embedding_index(emb.id, invoice_id, embedding)
+
+    # Re-tune the ANN index in the background once the table has grown enough
+    schedule_index_maintenance(db.get_bind())
     return emb.id
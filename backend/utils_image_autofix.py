@@ -7,13 +7,32 @@ Features:
 - اكتشاف الصور المقلوبة وتصحيحها
 - تصحيح الميل الطفيف (Deskewing)
 - تصحيح المنظور للصور الملتقطة بزاوية
+
+الأداء:
+- تقدير الهندسة (زاوية OSD، زاوية الميل، أركان الفاتورة) يتم على نسخة مصغّرة
+  ثم تُكبَّر النتائج وتُطبَّق مرة واحدة على الصورة بدقتها الكاملة
+- مصنّف سريع (projection profiles) يحدد هل أسطر النص أفقية أم عمودية (0/180 أو 90/270)،
+  و Tesseract OSD على نسخة مصغّرة يحدد دائماً القائم من المقلوب؛ إجابة OSD المخالفة
+  لمحور الأسطر تُرفض
+- الدوران + الميل + المنظور تُدمج في مصفوفة homography واحدة (3x3) وتُطبَّق بـ
+  warpPerspective واحد: نسخة واحدة بالحجم الكامل وإعادة عيّنات (interpolation) مرة واحدة
+
+Configuration:
+- AUTOFIX_ANALYSIS_MAX_SIDE  (default 1024) أطول ضلع لنسخة تقدير الميل/المنظور (0 = دقة كاملة)
+- AUTOFIX_OSD_MAX_SIDE       (default 2048) أطول ضلع للصورة المرسلة إلى Tesseract OSD
+- AUTOFIX_ORIENTATION_MAX_SIDE       (default 800)  أطول ضلع لنسخة مصنّف الاتجاه
+- AUTOFIX_ORIENTATION_MIN_CONFIDENCE (default 0.6)  أقل ثقة محور لرفض إجابة OSD من المحور الآخر
 """
 
 import cv2
 import numpy as np
 import logging
+import os
+import time
 from pathlib import Path
 
+from backend.derivatives import make_derivatives
+
 # Try to import pytesseract (optional - for OSD detection)
 try:
     import pytesseract
@@ -24,6 +43,31 @@ except ImportError:
 
 logger = logging.getLogger("backend.image_autofix")
 
+AUTOFIX_ANALYSIS_MAX_SIDE = int(os.getenv("AUTOFIX_ANALYSIS_MAX_SIDE", "1024"))
+AUTOFIX_OSD_MAX_SIDE = int(os.getenv("AUTOFIX_OSD_MAX_SIDE", "2048"))
+AUTOFIX_ORIENTATION_MAX_SIDE = int(os.getenv("AUTOFIX_ORIENTATION_MAX_SIDE", "800"))
+AUTOFIX_ORIENTATION_MIN_CONFIDENCE = float(os.getenv("AUTOFIX_ORIENTATION_MIN_CONFIDENCE", "0.6"))
+
+
+# ================================================================
+# 🔎 نسخة مصغّرة لتقدير الهندسة
+# ================================================================
+def downscale_for_analysis(img, max_side: int = AUTOFIX_ANALYSIS_MAX_SIDE):
+    """
+    يرجع نسخة مصغّرة (INTER_AREA) أطول ضلع فيها max_side.
+    
+    الزوايا لا تتغير مع التصغير، والإحداثيات تُكبَّر بنسبة الأبعاد،
+    فلا داعي لتحليل 12 ميغابكسل لتقدير زاوية أو أربع نقاط.
+    
+    Returns:
+        numpy array: النسخة المصغّرة (أو نفس الصورة إذا كانت أصغر / max_side <= 0)
+    """
+    h, w = img.shape[:2]
+    if max_side <= 0 or max(h, w) <= max_side:
+        return img
+    scale = max_side / float(max(h, w))
+    return cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
 
 # ================================================================
 # 🔍 دالة اكتشاف زاوية الدوران (OSD - Orientation and Script Detection)
@@ -32,6 +76,8 @@ def detect_osd_angle(img):
     """
     يكتشف زاوية دوران النص في الصورة باستخدام Tesseract OSD.
     
+    الصورة تُصغَّر أولاً إلى AUTOFIX_OSD_MAX_SIDE (يكفي لقراءة اتجاه النص).
+    
     Args:
         img: الصورة (numpy array)
     
@@ -43,7 +89,7 @@ def detect_osd_angle(img):
     
     try:
         # تحويل الصورة إلى رمادي لتحسين الدقة
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(downscale_for_analysis(img, AUTOFIX_OSD_MAX_SIDE), cv2.COLOR_BGR2GRAY)
         
         # اكتشاف الـ OSD (يحتاج Tesseract مثبت)
         osd = pytesseract.image_to_osd(gray)
@@ -60,12 +106,168 @@ def detect_osd_angle(img):
 
 
 # ================================================================
-# 📐 دالة تصحيح الميل باستخدام Minimum Area Rectangle
+# 🧭 مصنّف اتجاه سريع (Projection Profiles)
+# ================================================================
+def _profile_peakiness(profile: np.ndarray) -> float:
+    """أسطر النص تجعل الإسقاط العمودي على اتجاهها متذبذباً (تباين عالٍ نسبةً للمتوسط)"""
+    mean = profile.mean()
+    return float(profile.var() / (mean * mean)) if mean > 0 else 0.0
+
+
+def classify_line_axis(img):
+    """
+    يقدّر بدون OSD (على نسخة مصغّرة) هل أسطر النص أفقية أم عمودية:
+    مقارنة تذبذب إسقاط الصفوف مقابل الأعمدة.
+    
+    لا يحاول التمييز بين قائم ومقلوب (0/180 أو 90/270): أي اختبار على شكل الحروف
+    يفترض حروفاً لاتينية، والفواتير أغلبها عربية → اتجاه الدوران يقرره OSD وحده.
+    
+    Returns:
+        (bool, float): هل الأسطر عمودية (الصفحة على جنبها)، والثقة بين 0 و 1
+    """
+    small = downscale_for_analysis(img, AUTOFIX_ORIENTATION_MAX_SIDE)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    binary = (thresh > 0).astype(np.float32)
+    
+    h_score = _profile_peakiness(binary.sum(axis=1))
+    v_score = _profile_peakiness(binary.sum(axis=0))
+    if max(h_score, v_score) == 0:
+        return False, 0.0
+    return v_score > h_score, abs(h_score - v_score) / max(h_score, v_score)
+
+
+def detect_orientation(img, timings: dict | None = None) -> int:
+    """
+    اتجاه الصفحة: Tesseract OSD (على نسخة مصغّرة) يحدد الدوران دائماً، والمصنّف السريع
+    يحصر الإجابة في محور واحد.
+    
+    - المصنّف يقول أفقي/عمودي فقط → المرشحان 0/180 أو 90/270؛ لا يعرف قائم من مقلوب،
+      فثقته ثقة في المحور وليست في الاتجاه ولا تُغني عن OSD
+    - OSD يختار بين المرشحَين؛ إجابة من المحور الآخر (بثقة محور عالية) تُرفض → 0
+    - ثقة محور منخفضة → إجابة OSD كما هي
+    لا تدوير بدون OSD.
+    
+    timings يُملأ بـ orientation_classifier و orientation_osd.
+    
+    Returns:
+        int: الزاوية (0, 90, 180, 270)
+    """
+    timings = timings if timings is not None else {}
+    
+    t0 = time.perf_counter()
+    try:
+        vertical, confidence = classify_line_axis(img)
+    except Exception as e:
+        logger.warning(f"⚠️ Orientation classifier failed: {e}")
+        vertical, confidence = False, 0.0
+    timings["orientation_classifier"] = time.perf_counter() - t0
+    
+    if not TESSERACT_AVAILABLE:
+        # بدون OSD لا نخاطر بتدوير الصورة
+        return 0
+    
+    t0 = time.perf_counter()
+    angle = detect_osd_angle(img)
+    timings["orientation_osd"] = time.perf_counter() - t0
+    
+    if confidence < AUTOFIX_ORIENTATION_MIN_CONFIDENCE:
+        logger.info(f"🧭 Low line-axis confidence ({confidence:.2f}), using OSD {angle}° as is")
+        return angle
+    
+    candidates = (90, 270) if vertical else (0, 180)
+    if angle not in candidates:
+        logger.warning(f"⚠️ OSD rotation {angle}° contradicts {'vertical' if vertical else 'horizontal'} "
+                       f"text lines (confidence {confidence:.2f}). Not rotating.")
+        return 0
+    logger.info(f"🧭 Orientation {angle}° (OSD, {'vertical' if vertical else 'horizontal'} lines)")
+    return angle
+
+
+def rotate_right_angle(img, rotation_angle: int):
+    """تطبيق دوران OSD (90/180/270) بدون إعادة عيّنات"""
+    if rotation_angle == 90:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if rotation_angle == 180:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if rotation_angle == 270:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+
+def right_angle_matrix(rotation_angle: int, w: int, h: int) -> np.ndarray:
+    """
+    مصفوفة 3x3 مكافئة لـ cv2.rotate على صورة w×h
+    (تحوّل إحداثيات الصورة الأصلية إلى إحداثيات الصورة المدوَّرة).
+    """
+    if rotation_angle == 90:
+        return np.array([[0, -1, h - 1], [1, 0, 0], [0, 0, 1]], dtype=np.float64)
+    if rotation_angle == 180:
+        return np.array([[-1, 0, w - 1], [0, -1, h - 1], [0, 0, 1]], dtype=np.float64)
+    if rotation_angle == 270:
+        return np.array([[0, 1, 0], [-1, 0, w - 1], [0, 0, 1]], dtype=np.float64)
+    return np.eye(3, dtype=np.float64)
+
+
+# ================================================================
+# 📐 تقدير وتصحيح الميل باستخدام Minimum Area Rectangle
 # ================================================================
+def estimate_skew_angle(img) -> float:
+    """
+    يقدّر زاوية الميل الطفيف (بالدرجات) - يُفضَّل تمرير نسخة مصغّرة.
+    
+    Returns:
+        float: الزاوية، أو 0.0 إذا كانت الصورة مستقيمة / لا توجد نقاط كافية
+    """
+    # تحويل إلى رمادي
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    
+    # Threshold لفصل النص عن الخلفية
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    
+    # إيجاد جميع النقاط البيضاء (النص)
+    coords = np.column_stack(np.where(thresh > 0))
+    
+    if len(coords) < 5:
+        logger.warning("⚠️ Not enough points for deskewing. Skipping.")
+        return 0.0
+    
+    # حساب أصغر مستطيل يحيط بالنص
+    rect = cv2.minAreaRect(coords)
+    angle = rect[-1]
+    
+    # تصحيح الزاوية
+    if angle < -45:
+        angle = 90 + angle
+    elif angle > 45:
+        angle = angle - 90
+    
+    # إذا الزاوية صغيرة جداً، لا داعي للتصحيح
+    if abs(angle) < 0.5:
+        logger.info("✅ Image is already straight (angle < 0.5°)")
+        return 0.0
+    
+    return float(angle)
+
+
+def skew_matrix(angle: float, w: int, h: int) -> np.ndarray:
+    """مصفوفة 3x3 لتدوير صورة w×h حول مركزها بزاوية angle (نفس الأبعاد)"""
+    return np.vstack([cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0), [0, 0, 1]])
+
+
+def rotate_about_center(img, angle: float):
+    """تدوير الصورة حول مركزها بنفس الأبعاد"""
+    (h, w) = img.shape[:2]
+    M = skew_matrix(angle, w, h)[:2]
+    return cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
 def deskew_via_min_area_rect(img):
     """
     يصحح الميل الطفيف في الصورة باستخدام كشف الحواف وحساب الزاوية.
     
+    الزاوية تُقدَّر على نسخة مصغّرة والتدوير يُطبَّق على الصورة الكاملة.
+    
     Args:
         img: الصورة (numpy array)
     
@@ -73,43 +275,12 @@ def deskew_via_min_area_rect(img):
         numpy array: الصورة بعد تصحيح الميل
     """
     try:
-        # تحويل إلى رمادي
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Threshold لفصل النص عن الخلفية
-        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-        
-        # إيجاد جميع النقاط البيضاء (النص)
-        coords = np.column_stack(np.where(thresh > 0))
-        
-        if len(coords) < 5:
-            logger.warning("⚠️ Not enough points for deskewing. Skipping.")
-            return img
-        
-        # حساب أصغر مستطيل يحيط بالنص
-        rect = cv2.minAreaRect(coords)
-        angle = rect[-1]
-        
-        # تصحيح الزاوية
-        if angle < -45:
-            angle = 90 + angle
-        elif angle > 45:
-            angle = angle - 90
-        
-        # إذا الزاوية صغيرة جداً، لا داعي للتصحيح
-        if abs(angle) < 0.5:
-            logger.info("✅ Image is already straight (angle < 0.5°)")
+        angle = estimate_skew_angle(downscale_for_analysis(img))
+        if angle == 0.0:
             return img
         
         logger.info(f"📐 Deskewing by {angle:.2f}°")
-        
-        # تطبيق التدوير
-        (h, w) = img.shape[:2]
-        center = (w // 2, h // 2)
-        M = cv2.getRotationMatrix2D(center, angle, 1.0)
-        rotated = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-        
-        return rotated
+        return rotate_about_center(img, angle)
     
     except Exception as e:
         logger.error(f"❌ Deskewing failed: {e}")
@@ -117,12 +288,140 @@ def deskew_via_min_area_rect(img):
 
 
 # ================================================================
-# 🔲 دالة تصحيح المنظور (Perspective Correction)
+# 🔲 تقدير وتصحيح المنظور (Perspective Correction)
 # ================================================================
+def find_document_quad(img):
+    """
+    يبحث عن أركان الفاتورة الأربعة - يُفضَّل تمرير نسخة مصغّرة.
+    
+    Returns:
+        numpy array (4x2 float32): النقاط مرتبة (أعلى-يسار، أعلى-يمين، أسفل-يمين، أسفل-يسار)
+        بإحداثيات الصورة الممرّرة، أو None إذا لم يوجد مستطيل مناسب
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    
+    # تطبيق Gaussian Blur لتقليل الضوضاء
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    
+    # كشف الحواف باستخدام Canny
+    edged = cv2.Canny(blurred, 50, 150)
+    
+    # إيجاد الـ Contours
+    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    if len(contours) == 0:
+        logger.info("ℹ️ No contours found. Skipping perspective correction.")
+        return None
+    
+    # ترتيب الـ Contours حسب المساحة (الأكبر أولاً)
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+    
+    # البحث عن contour مستطيل (4 نقاط)
+    document_contour = None
+    for contour in contours:
+        # تقريب الـ contour
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
+        
+        # إذا كان له 4 نقاط، يُحتمل أنه الفاتورة
+        if len(approx) == 4:
+            document_contour = approx
+            break
+    
+    # إذا ما لقينا مستطيل واضح، نرجع الصورة كما هي
+    if document_contour is None:
+        logger.info("ℹ️ No rectangular document detected. Skipping perspective correction.")
+        return None
+    
+    # التأكد من أن المستطيل كبير بما يكفي (على الأقل 30% من مساحة الصورة)
+    contour_area = cv2.contourArea(document_contour)
+    image_area = img.shape[0] * img.shape[1]
+    
+    if contour_area < 0.3 * image_area:
+        logger.info("ℹ️ Detected rectangle too small. Skipping perspective correction.")
+        return None
+    
+    # ترتيب النقاط الأربع: أعلى-يسار، أعلى-يمين، أسفل-يمين، أسفل-يسار
+    pts = document_contour.reshape(4, 2)
+    rect = np.zeros((4, 2), dtype="float32")
+    
+    # مجموع الإحداثيات: أعلى-يسار له أصغر مجموع، أسفل-يمين له أكبر مجموع
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]
+    rect[2] = pts[np.argmax(s)]
+    
+    # الفرق بين الإحداثيات: أعلى-يمين له أصغر فرق، أسفل-يسار له أكبر فرق
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)]
+    rect[3] = pts[np.argmax(diff)]
+    return rect
+
+
+def scale_quad(rect, analysis_shape, full_shape):
+    """تكبير أركان الفاتورة من إحداثيات النسخة المصغّرة إلى الصورة الكاملة"""
+    sx = full_shape[1] / float(analysis_shape[1])
+    sy = full_shape[0] / float(analysis_shape[0])
+    return (rect * np.array([sx, sy], dtype="float32")).astype("float32")
+
+
+def quad_warp_matrix(rect):
+    """
+    مصفوفة المنظور التي تسوّي أركان الفاتورة إلى مستطيل.
+    
+    Returns:
+        (M 3x3, (maxWidth, maxHeight))
+    """
+    # حساب العرض والطول الجديدين
+    (tl, tr, br, bl) = rect
+    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
+    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
+    maxWidth = max(int(widthA), int(widthB))
+    
+    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
+    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
+    maxHeight = max(int(heightA), int(heightB))
+    
+    # إنشاء مستطيل الوجهة
+    dst = np.array([
+        [0, 0],
+        [maxWidth - 1, 0],
+        [maxWidth - 1, maxHeight - 1],
+        [0, maxHeight - 1]
+    ], dtype="float32")
+    
+    # حساب مصفوفة التحويل
+    M = cv2.getPerspectiveTransform(rect, dst)
+    return M, (maxWidth, maxHeight)
+
+
+def warp_document_quad(img, rect):
+    """قص الفاتورة وتسويتها حسب أركانها الأربعة (بإحداثيات img)"""
+    M, size = quad_warp_matrix(rect)
+    return cv2.warpPerspective(img, M, size)
+
+
+def apply_homography(img, H: np.ndarray, size):
+    """
+    تطبيق التحويل المركّب على الصورة الكاملة مرة واحدة.
+    
+    إذا كان التحويل دوراناً قائماً فقط (أو لا شيء) نستخدم cv2.rotate / نفس الصورة
+    لأنها نسخ بكسلات بدون interpolation.
+    """
+    h, w = img.shape[:2]
+    for rotation_angle in (0, 90, 180, 270):
+        R = right_angle_matrix(rotation_angle, w, h)
+        expected = (h, w) if rotation_angle in (90, 270) else (w, h)
+        if tuple(size) == expected and np.allclose(H, R, atol=1e-6):
+            return rotate_right_angle(img, rotation_angle)
+    return cv2.warpPerspective(img, H, tuple(size), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
 def correct_perspective(img):
     """
     يصحح المنظور للصور الملتقطة بزاوية (مثل تصوير الفاتورة من جنب).
     
+    الأركان تُكتشف على نسخة مصغّرة ثم تُكبَّر ويُطبَّق التحويل على الصورة الكاملة.
+    
     Args:
         img: الصورة (numpy array)
     
@@ -130,113 +429,173 @@ def correct_perspective(img):
         numpy array: الصورة بعد تصحيح المنظور
     """
     try:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # تطبيق Gaussian Blur لتقليل الضوضاء
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        
-        # كشف الحواف باستخدام Canny
-        edged = cv2.Canny(blurred, 50, 150)
-        
-        # إيجاد الـ Contours
-        contours, _ = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if len(contours) == 0:
-            logger.info("ℹ️ No contours found. Skipping perspective correction.")
-            return img
-        
-        # ترتيب الـ Contours حسب المساحة (الأكبر أولاً)
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
-        
-        # البحث عن contour مستطيل (4 نقاط)
-        document_contour = None
-        for contour in contours:
-            # تقريب الـ contour
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            # إذا كان له 4 نقاط، يُحتمل أنه الفاتورة
-            if len(approx) == 4:
-                document_contour = approx
-                break
-        
-        # إذا ما لقينا مستطيل واضح، نرجع الصورة كما هي
-        if document_contour is None:
-            logger.info("ℹ️ No rectangular document detected. Skipping perspective correction.")
-            return img
-        
-        # التأكد من أن المستطيل كبير بما يكفي (على الأقل 30% من مساحة الصورة)
-        contour_area = cv2.contourArea(document_contour)
-        image_area = img.shape[0] * img.shape[1]
-        
-        if contour_area < 0.3 * image_area:
-            logger.info("ℹ️ Detected rectangle too small. Skipping perspective correction.")
+        small = downscale_for_analysis(img)
+        rect = find_document_quad(small)
+        if rect is None:
             return img
         
         logger.info("🔲 Applying perspective correction")
+        return warp_document_quad(img, scale_quad(rect, small.shape, img.shape))
+    
+    except Exception as e:
+        logger.error(f"❌ Perspective correction failed: {e}")
+        return img
+
+
+# ================================================================
+# 🚀 الدالة الرئيسية (ndarray → ndarray): auto_fix_image_array
+# ================================================================
+def auto_fix_image_array(img: np.ndarray, timings: dict | None = None,
+                         analysis_max_side: int = AUTOFIX_ANALYSIS_MAX_SIDE) -> np.ndarray:
+    """
+    تصحيح صورة موجودة في الذاكرة (بدون أي قراءة/كتابة على القرص).
+    
+    تقوم بـ:
+    1. اكتشاف الدوران (OSD، محصوراً في محور الأسطر الذي يحدده المصنّف السريع)
+    2. تقدير الميل الطفيف
+    3. اكتشاف أركان الفاتورة (المنظور)
+    4. تطبيق التحويلات الثلاثة كـ homography واحدة على الصورة الكاملة
+    
+    الخطوات 1-3 لا تنتج بكسلات بالدقة الكاملة: التقدير يتم على نسخة مصغّرة
+    (تُدوَّر معها خطوة بخطوة) وكل خطوة تضيف مصفوفة 3x3 فقط.
+    
+    Args:
+        img: الصورة (numpy array, BGR)
+        timings (dict): اختياري - يُملأ بزمن كل مرحلة بالثواني (orientation, orientation_classifier, orientation_osd, deskew, perspective, warp)
+        analysis_max_side: أطول ضلع لنسخة التقدير (0 = التقدير بالدقة الكاملة)
+    
+    Returns:
+        numpy array: الصورة المصححة (أو نفس الصورة إذا لم يلزم تصحيح)
+    """
+    timings = timings if timings is not None else {}
+    
+    h, w = img.shape[:2]
+    logger.info(f"📏 Original image size: {w}x{h}")
+    small = downscale_for_analysis(img, analysis_max_side)
+    
+    # H: إحداثيات الصورة الأصلية → إحداثيات الناتج، و (out_w, out_h) أبعاد الناتج
+    H = np.eye(3, dtype=np.float64)
+    out_w, out_h = w, h
+    
+    # ============================================================
+    # خطوة 1️⃣: اكتشاف الدوران (محور الأسطر ← OSD يختار الاتجاه)
+    # ============================================================
+    t0 = time.perf_counter()
+    rotation_angle = detect_orientation(img, timings)
+    
+    if rotation_angle in (90, 180, 270):
+        logger.info(f"🔄 Rotating image by {rotation_angle}°")
+        H = right_angle_matrix(rotation_angle, out_w, out_h) @ H
+        if rotation_angle in (90, 270):
+            out_w, out_h = out_h, out_w
+        small = rotate_right_angle(small, rotation_angle)
+    timings["orientation"] = time.perf_counter() - t0
+    
+    # ============================================================
+    # خطوة 2️⃣: تقدير الميل الطفيف (Deskewing)
+    # ============================================================
+    t0 = time.perf_counter()
+    try:
+        skew_angle = estimate_skew_angle(small)
+        if skew_angle != 0.0:
+            logger.info(f"📐 Deskewing by {skew_angle:.2f}°")
+            H = skew_matrix(skew_angle, out_w, out_h) @ H
+            small = rotate_about_center(small, skew_angle)
+    except Exception as e:
+        logger.error(f"❌ Deskewing failed: {e}")
+    timings["deskew"] = time.perf_counter() - t0
+    
+    # ============================================================
+    # خطوة 3️⃣: تقدير المنظور (Perspective Correction)
+    # ============================================================
+    t0 = time.perf_counter()
+    try:
+        rect = find_document_quad(small)
+        if rect is not None:
+            logger.info("🔲 Applying perspective correction")
+            M, (out_w, out_h) = quad_warp_matrix(scale_quad(rect, small.shape, (out_h, out_w)))
+            H = M @ H
+    except Exception as e:
+        logger.error(f"❌ Perspective correction failed: {e}")
+    timings["perspective"] = time.perf_counter() - t0
+    
+    # ============================================================
+    # خطوة 4️⃣: تطبيق التحويل المركّب مرة واحدة
+    # ============================================================
+    t0 = time.perf_counter()
+    img = apply_homography(img, H, (out_w, out_h))
+    timings["warp"] = time.perf_counter() - t0
+    
+    new_shape = img.shape
+    logger.info(f"✅ Auto-fix completed! New size: {new_shape[1]}x{new_shape[0]}")
+    return img
+
+
+# ================================================================
+# 🚀 (bytes → bytes): auto_fix_image_bytes
+# ================================================================
+def auto_fix_image_bytes(image_bytes: bytes, quality: int = 95, timings: dict | None = None,
+                         derivatives: dict | None = None) -> bytes | None:
+    """
+    تصحيح صورة من bytes وإرجاع JPEG bytes - بدون ملفات مؤقتة.
+    
+    cv2.imdecode يقرأ مباشرة من الـ buffer (np.frombuffer بدون نسخ)،
+    و cv2.imencode يرمّز الناتج في الذاكرة.
+    
+    Args:
+        image_bytes: محتوى الصورة (JPEG/PNG/...)
+        quality: جودة JPEG للناتج
+        timings (dict): اختياري - decode, osd, deskew, perspective, encode
+        derivatives (dict): اختياري - يُملأ بنسخ WebP المصغّرة من الصورة المصححة (backend.derivatives)
+    
+    Returns:
+        bytes: الصورة المصححة بصيغة JPEG، أو None إذا فشلت العملية
+    """
+    timings = timings if timings is not None else {}
+    try:
+        t0 = time.perf_counter()
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        timings["decode"] = time.perf_counter() - t0
         
-        # ترتيب النقاط الأربع: أعلى-يسار، أعلى-يمين، أسفل-يمين، أسفل-يسار
-        pts = document_contour.reshape(4, 2)
-        rect = np.zeros((4, 2), dtype="float32")
-        
-        # مجموع الإحداثيات: أعلى-يسار له أصغر مجموع، أسفل-يمين له أكبر مجموع
-        s = pts.sum(axis=1)
-        rect[0] = pts[np.argmin(s)]
-        rect[2] = pts[np.argmax(s)]
-        
-        # الفرق بين الإحداثيات: أعلى-يمين له أصغر فرق، أسفل-يسار له أكبر فرق
-        diff = np.diff(pts, axis=1)
-        rect[1] = pts[np.argmin(diff)]
-        rect[3] = pts[np.argmax(diff)]
-        
-        # حساب العرض والطول الجديدين
-        (tl, tr, br, bl) = rect
-        widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-        widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-        maxWidth = max(int(widthA), int(widthB))
+        if img is None:
+            logger.error("❌ Failed to decode image bytes")
+            return None
         
-        heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-        heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-        maxHeight = max(int(heightA), int(heightB))
+        img = auto_fix_image_array(img, timings=timings)
         
-        # إنشاء مستطيل الوجهة
-        dst = np.array([
-            [0, 0],
-            [maxWidth - 1, 0],
-            [maxWidth - 1, maxHeight - 1],
-            [0, maxHeight - 1]
-        ], dtype="float32")
+        t0 = time.perf_counter()
+        success, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        timings["encode"] = time.perf_counter() - t0
         
-        # حساب مصفوفة التحويل وتطبيقها
-        M = cv2.getPerspectiveTransform(rect, dst)
-        warped = cv2.warpPerspective(img, M, (maxWidth, maxHeight))
+        if not success:
+            logger.error("❌ Failed to encode corrected image")
+            return None
         
-        return warped
+        if derivatives is not None:
+            # من المصفوفة المصححة مباشرة - بدون فك ترميز الـ JPEG مرة أخرى
+            derivatives.update(make_derivatives(img, timings))
+        return encoded.tobytes()
     
     except Exception as e:
-        logger.error(f"❌ Perspective correction failed: {e}")
-        return img
+        logger.error(f"❌ Auto-fix failed with error: {e}")
+        return None
 
 
 # ================================================================
-# 🚀 الدالة الرئيسية: auto_fix_invoice_image
+# 🚀 (path → path): auto_fix_invoice_image - غلاف بسيط للـ CLI
 # ================================================================
-def auto_fix_invoice_image(image_path: str) -> bool:
+def auto_fix_invoice_image(image_path: str, timings: dict | None = None) -> bool:
     """
-    الدالة الرئيسية لتصحيح الصورة تلقائياً.
-    
-    تقوم بـ:
-    1. اكتشاف وتصحيح الدوران (OSD)
-    2. تصحيح الميل الطفيف
-    3. تصحيح المنظور
-    4. حفظ الصورة المصححة في نفس المسار
+    تصحيح صورة على القرص وحفظها في نفس المسار (يستخدم auto_fix_image_array).
     
     Args:
         image_path (str): مسار الصورة المراد تصحيحها
+        timings (dict): اختياري - يُملأ بزمن كل مرحلة بالثواني (decode, osd, deskew, perspective, encode)
     
     Returns:
         bool: True إذا نجحت العملية، False إذا فشلت
     """
+    timings = timings if timings is not None else {}
     try:
         logger.info(f"🔧 Starting auto-fix for: {image_path}")
         
@@ -246,49 +605,22 @@ def auto_fix_invoice_image(image_path: str) -> bool:
             return False
         
         # قراءة الصورة
+        t0 = time.perf_counter()
         img = cv2.imread(image_path)
+        timings["decode"] = time.perf_counter() - t0
         
         if img is None:
             logger.error(f"❌ Failed to read image: {image_path}")
             return False
         
-        original_shape = img.shape
-        logger.info(f"📏 Original image size: {original_shape[1]}x{original_shape[0]}")
-        
-        # ============================================================
-        # خطوة 1️⃣: اكتشاف وتصحيح الدوران (OSD)
-        # ============================================================
-        rotation_angle = detect_osd_angle(img)
-        
-        if rotation_angle != 0:
-            logger.info(f"🔄 Rotating image by {rotation_angle}°")
-            
-            # تطبيق الدوران المناسب
-            if rotation_angle == 90:
-                img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-            elif rotation_angle == 180:
-                img = cv2.rotate(img, cv2.ROTATE_180)
-            elif rotation_angle == 270:
-                img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        
-        # ============================================================
-        # خطوة 2️⃣: تصحيح الميل الطفيف (Deskewing)
-        # ============================================================
-        img = deskew_via_min_area_rect(img)
-        
-        # ============================================================
-        # خطوة 3️⃣: تصحيح المنظور (Perspective Correction)
-        # ============================================================
-        img = correct_perspective(img)
+        img = auto_fix_image_array(img, timings=timings)
         
-        # ============================================================
         # حفظ الصورة المصححة في نفس المسار
-        # ============================================================
+        t0 = time.perf_counter()
         success = cv2.imwrite(image_path, img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        timings["encode"] = time.perf_counter() - t0
         
         if success:
-            new_shape = img.shape
-            logger.info(f"✅ Auto-fix completed! New size: {new_shape[1]}x{new_shape[0]}")
             logger.info(f"💾 Corrected image saved to: {image_path}")
             return True
         else:
@@ -301,7 +633,7 @@ def auto_fix_invoice_image(image_path: str) -> bool:
 
 
 # ================================================================
-# 🧪 للاختبار المحلي فقط
+# 🧪 للاختبار المحلي فقط (لمعالجة مجلد كامل: python -m backend.autofix_batch)
 # ================================================================
 if __name__ == "__main__":
     import sys
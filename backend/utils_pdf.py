@@ -0,0 +1,163 @@
+"""
+📄 PDF Rendering Utilities
+==========================
+تحويل صفحات PDF إلى صور للتحليل بدون دورات ترميز/فك ترميز وسيطة.
+
+- بكسلات الـ Pixmap (PyMuPDF) تُغلَّف كـ numpy array مباشرة فوق الـ buffer (بدون نسخ)
+- التصحيح التلقائي (Auto-Fix) يعمل على هذه المصفوفة، والترميز إلى JPEG يتم مرة واحدة للناتج النهائي
+- دقة العرض (DPI) تتكيف مع حجم الصفحة بدلاً من zoom = 2 الثابت
+- ملفات متعددة الصفحات: حد أعلى لعدد الصفحات ولإجمالي ذاكرة العرض، ثم كل صفحة
+  تُعرض في عملية مستقلة (autofix_pool)، وتُرسل كمجموعة صور مرتبة أو تُدمج في صورة طويلة
+
+Configuration:
+- PDF_RENDER_TARGET_LONG_EDGE  (default 2200) أطول ضلع مستهدف بالبكسل
+- PDF_RENDER_MIN_DPI           (default 100)
+- PDF_RENDER_MAX_DPI           (default 300)
+- PDF_RENDER_MAX_PIXELS        (default 16000000) حد أعلى لبكسلات الصفحة الواحدة (حماية الذاكرة)
+- PDF_MAX_PAGES                (default 20) الصفحات بعدها تُتجاهل
+- PDF_MAX_RENDER_MB            (default 512) مجموع بكسلات كل الصفحات المعروضة (RGB) بالميغابايت
+- PDF_STITCH_MAX_HEIGHT        (default 12000) أقصى ارتفاع للصورة المدموجة
+"""
+
+import logging
+import math
+import os
+import time
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+from backend.utils_image_autofix import auto_fix_image_array
+
+logger = logging.getLogger("backend.utils_pdf")
+
+PDF_RENDER_TARGET_LONG_EDGE = int(os.getenv("PDF_RENDER_TARGET_LONG_EDGE", "2200"))
+PDF_RENDER_MIN_DPI = float(os.getenv("PDF_RENDER_MIN_DPI", "100"))
+PDF_RENDER_MAX_DPI = float(os.getenv("PDF_RENDER_MAX_DPI", "300"))
+PDF_RENDER_MAX_PIXELS = int(os.getenv("PDF_RENDER_MAX_PIXELS", "16000000"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "20"))
+PDF_MAX_RENDER_MB = float(os.getenv("PDF_MAX_RENDER_MB", "512"))
+PDF_STITCH_MAX_HEIGHT = int(os.getenv("PDF_STITCH_MAX_HEIGHT", "12000"))
+
+
+def choose_render_zoom(page_rect) -> float:
+    """
+    Zoom factor (DPI / 72) so the page's long edge lands near PDF_RENDER_TARGET_LONG_EDGE.
+
+    A4 → ~190 DPI, a small receipt → up to PDF_RENDER_MAX_DPI, a poster-sized page →
+    PDF_RENDER_MIN_DPI. PDF_RENDER_MAX_PIXELS always wins, so one huge page can't exhaust memory.
+    """
+    width, height = float(page_rect.width), float(page_rect.height)
+    if width <= 0 or height <= 0:
+        return PDF_RENDER_MIN_DPI / 72.0
+    zoom = PDF_RENDER_TARGET_LONG_EDGE / max(width, height)
+    zoom = min(max(zoom, PDF_RENDER_MIN_DPI / 72.0), PDF_RENDER_MAX_DPI / 72.0)
+    zoom = min(zoom, math.sqrt(PDF_RENDER_MAX_PIXELS / (width * height)))
+    return zoom
+
+
+def render_page_array(page):
+    """
+    Render a page to RGB and wrap the pixmap samples as a numpy array (no copy).
+
+    Returns:
+        (pixmap, array HxWx3 RGB) - keep the pixmap alive as long as the array is used
+    """
+    zoom = choose_render_zoom(page.rect)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    samples = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+    arr = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, : pix.width * pix.n]
+    arr = arr.reshape(pix.height, pix.width, pix.n)
+    logger.info(f"🖨️ Rendered page at {zoom * 72:.0f} DPI ({pix.width}x{pix.height})")
+    return pix, arr
+
+
+def encode_jpeg_rgb(arr: np.ndarray, quality: int = 95) -> bytes:
+    """Encode an RGB array once as JPEG (OpenCV expects BGR)"""
+    success, encoded = cv2.imencode(".jpg", cv2.cvtColor(arr, cv2.COLOR_RGB2BGR),
+                                    [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        raise ValueError("JPEG encoding failed")
+    return encoded.tobytes()
+
+
+def render_pdf_page_jpeg(pdf_bytes: bytes, page_index: int = 0, autofix: bool = True,
+                         quality: int = 95, timings: dict | None = None) -> bytes:
+    """
+    PDF page → (auto-fix) → JPEG, with a single encode at the end.
+
+    Auto-fix failures are logged and the rendered page is used as-is.
+    Raises if the PDF can't be opened or rendered.
+    """
+    timings = timings if timings is not None else {}
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        t0 = time.perf_counter()
+        pix, arr = render_page_array(pdf_document[page_index])
+        timings["render"] = time.perf_counter() - t0
+
+        if autofix:
+            try:
+                # auto-fix only reads the buffer; its single warp allocates the output
+                arr = auto_fix_image_array(arr, timings=timings)
+            except Exception as e:
+                logger.warning(f"⚠️ Auto-fix failed on PDF page {page_index}: {e}. Using rendered page.")
+
+        t0 = time.perf_counter()
+        data = encode_jpeg_rgb(arr, quality)
+        timings["encode"] = time.perf_counter() - t0
+    return data
+
+
+def plan_pdf_pages(pdf_bytes: bytes) -> tuple[list[int], int]:
+    """
+    Pick which pages to render: at most PDF_MAX_PAGES, and stop once the rendered pixels
+    of the chosen pages would exceed PDF_MAX_RENDER_MB. Only page sizes are read here.
+
+    Returns:
+        (page indexes in order, total page count in the file)
+    """
+    budget = PDF_MAX_RENDER_MB * 1024 * 1024
+    pages, used = [], 0.0
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        total = pdf_document.page_count
+        for index in range(min(total, PDF_MAX_PAGES)):
+            rect = pdf_document[index].rect
+            zoom = choose_render_zoom(rect)
+            size = rect.width * zoom * rect.height * zoom * 3
+            if pages and used + size > budget:
+                break
+            pages.append(index)
+            used += size
+    if len(pages) < total:
+        logger.warning(f"⚠️ PDF has {total} pages; only the first {len(pages)} will be processed "
+                       f"(PDF_MAX_PAGES={PDF_MAX_PAGES}, PDF_MAX_RENDER_MB={PDF_MAX_RENDER_MB})")
+    return pages, total
+
+
+def stitch_pages_jpeg(page_jpegs: list[bytes], quality: int = 95) -> bytes:
+    """
+    Stack page images vertically (in order) into one JPEG for a single-image VLM call.
+    Pages are scaled to a common width, and the whole strip to at most PDF_STITCH_MAX_HEIGHT.
+    """
+    pages = [cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) for data in page_jpegs]
+    pages = [p for p in pages if p is not None]
+    if not pages:
+        raise ValueError("No decodable pages to stitch")
+
+    width = min(p.shape[1] for p in pages)
+    total_height = sum(int(round(p.shape[0] * width / p.shape[1])) for p in pages)
+    scale = min(1.0, PDF_STITCH_MAX_HEIGHT / float(total_height))
+    target_w = max(1, int(width * scale))
+
+    resized = []
+    for p in pages:
+        target_h = max(1, int(round(p.shape[0] * target_w / p.shape[1])))
+        if (target_h, target_w) != p.shape[:2]:
+            p = cv2.resize(p, (target_w, target_h), interpolation=cv2.INTER_AREA)
+        resized.append(p)
+
+    success, encoded = cv2.imencode(".jpg", cv2.vconcat(resized), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        raise ValueError("JPEG encoding failed")
+    return encoded.tobytes()
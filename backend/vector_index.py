@@ -0,0 +1,291 @@
+"""
+🗂️ Vector Index Lifecycle (pgvector)
+====================================
+إدارة فهرس البحث الدلالي على جدول invoice_embeddings.
+
+Features:
+- إنشاء فهرس HNSW (أو IVFFlat) على البُعد الحقيقي للعمود (1536)
+- اختيار معاملات الفهرس (m / ef_construction / lists) حسب عدد الصفوف
+- إعادة بناء الفهرس CONCURRENTLY عندما يكبر الجدول (IVFFlat عند التضاعف، HNSW عند تغيّر شريحة المعاملات)
+- معاملات البحث لكل استعلام (hnsw.ef_search / ivfflat.probes)
+
+يتم حفظ حالة الفهرس (النوع، المعاملات، عدد الصفوف وقت البناء) في COMMENT على الفهرس نفسه،
+فلا نحتاج جدولاً إضافياً.
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("backend.vector_index")
+
+# ================================================================
+# ⚙️ Configuration
+# ================================================================
+# OpenAI text-embedding-3-small dimensions (must match InvoiceEmbedding.embedding)
+EMBEDDING_DIM = 1536
+
+INDEX_NAME = "idx_invoice_embeddings_ann"
+LEGACY_INDEX_NAMES = ["idx_embedding_cosine"]  # IVFFlat قديم من database_setup.sql (VECTOR(384))
+
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()  # hnsw | ivfflat
+# أقل عدد صفوف لإنشاء IVFFlat (التجميع على جدول فارغ يعطي قوائم سيئة). HNSW يُنشأ دائماً.
+IVFFLAT_MIN_ROWS = int(os.getenv("VECTOR_INDEX_IVFFLAT_MIN_ROWS", "1000"))
+# نعيد البناء عندما يصل عدد الصفوف إلى (عدد الصفوف وقت البناء × هذا المعامل)
+REBUILD_GROWTH_FACTOR = float(os.getenv("VECTOR_INDEX_REBUILD_GROWTH", "2.0"))
+# فحص الحاجة لإعادة البناء كل N embeddings جديدة (داخل نفس العملية)
+MAINTENANCE_EVERY_N_INSERTS = int(os.getenv("VECTOR_INDEX_CHECK_EVERY", "500"))
+
+# Per-query overrides (None = derive from the current index)
+RAG_EF_SEARCH = int(os.getenv("RAG_EF_SEARCH")) if os.getenv("RAG_EF_SEARCH") else None
+RAG_PROBES = int(os.getenv("RAG_PROBES")) if os.getenv("RAG_PROBES") else None
+
+# Last known index state (filled by ensure_vector_index)
+_index_state: Dict[str, Any] = {}
+_maintenance_lock = threading.Lock()
+_inserts_since_check = 0
+
+
+# ================================================================
+# 📐 Parameter selection
+# ================================================================
+def choose_index_params(row_count: int, index_type: str = VECTOR_INDEX_TYPE) -> Dict[str, int]:
+    """
+    اختيار معاملات الفهرس حسب حجم الجدول (وفق توصيات pgvector).
+
+    - HNSW: m و ef_construction يكبران مع حجم الجدول
+    - IVFFlat: lists = rows / 1000 حتى مليون صف، ثم sqrt(rows)
+    """
+    if index_type == "ivfflat":
+        if row_count <= 1_000_000:
+            lists = max(1, row_count // 1000)
+        else:
+            lists = int(math.sqrt(row_count))
+        return {"lists": lists}
+
+    if row_count < 100_000:
+        return {"m": 16, "ef_construction": 64}
+    if row_count < 1_000_000:
+        return {"m": 24, "ef_construction": 128}
+    return {"m": 32, "ef_construction": 200}
+
+
+def default_search_params(top_k: int = 5, state: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    """
+    معاملات البحث الافتراضية لكل استعلام.
+
+    - ef_search: على الأقل 40 (افتراضي pgvector) و 4×top_k لتعويض فلترة WHERE بعد البحث
+    - probes: sqrt(lists) كما توصي pgvector
+    """
+    state = state if state is not None else _index_state
+    index_type = state.get("type", VECTOR_INDEX_TYPE)
+
+    if index_type == "ivfflat":
+        lists = state.get("params", {}).get("lists", 1)
+        return {"probes": RAG_PROBES or max(1, int(math.sqrt(lists)))}
+    return {"ef_search": RAG_EF_SEARCH or max(40, top_k * 4)}
+
+
+def apply_search_params(db: Session, ef_search: Optional[int] = None, probes: Optional[int] = None):
+    """
+    Apply per-query ANN knobs with SET LOCAL (scoped to the current transaction).
+    SET does not accept bind parameters, so values are coerced to int first.
+    """
+    if ef_search is not None:
+        db.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+    if probes is not None:
+        db.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+
+
+# ================================================================
+# 🔍 Introspection
+# ================================================================
+def _embedding_column_dim(conn) -> Optional[int]:
+    """Return the declared dimension of invoice_embeddings.embedding (atttypmod for vector)"""
+    row = conn.execute(text("""
+        SELECT a.atttypmod
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        WHERE c.relname = 'invoice_embeddings' AND a.attname = 'embedding' AND NOT a.attisdropped
+    """)).fetchone()
+    return row[0] if row and row[0] and row[0] > 0 else None
+
+
+def _row_count(conn) -> int:
+    return conn.execute(text("SELECT COUNT(*) FROM invoice_embeddings")).scalar() or 0
+
+
+def _read_index_state(conn, name: str = INDEX_NAME) -> Optional[Dict[str, Any]]:
+    """Read the JSON metadata stored in the index comment (None if the index doesn't exist)"""
+    row = conn.execute(
+        text("SELECT obj_description(to_regclass(:name), 'pg_class') AS meta, to_regclass(:name) IS NOT NULL AS present"),
+        {"name": name},
+    ).fetchone()
+    if not row or not row.present:
+        return None
+    try:
+        return json.loads(row.meta) if row.meta else {}
+    except Exception:
+        return {}
+
+
+# ================================================================
+# 🏗️ Build / Rebuild
+# ================================================================
+def _index_ddl(name: str, index_type: str, params: Dict[str, int], concurrently: bool) -> str:
+    with_clause = ", ".join(f"{k} = {int(v)}" for k, v in params.items())
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} "
+        f"ON invoice_embeddings USING {index_type} (embedding vector_cosine_ops) "
+        f"WITH ({with_clause})"
+    )
+
+
+def build_vector_index(engine: Engine, row_count: int, index_type: str = VECTOR_INDEX_TYPE) -> Dict[str, Any]:
+    """
+    بناء الفهرس (أو إعادة بنائه) بدون قفل الكتابة وبدون لحظة بلا فهرس ANN:
+    CREATE INDEX CONCURRENTLY على اسم مؤقت (مع COMMENT) → تبديل الاسمين في transaction واحدة
+    → DROP القديم CONCURRENTLY بعد أن صار الجديد هو INDEX_NAME.
+    """
+    params = choose_index_params(row_count, index_type)
+    state = {"type": index_type, "params": params, "rows": row_count, "dim": EMBEDDING_DIM, "built_at": int(time.time())}
+    tmp_name = f"{INDEX_NAME}_new"
+    old_name = f"{INDEX_NAME}_old"
+
+    logger.info(f"🏗️ Building {index_type} index on {row_count:,} embeddings with {params}...")
+    start = time.time()
+
+    # CONCURRENTLY لا يعمل داخل transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}"))
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {old_name}"))  # left over from an interrupted swap
+        conn.execute(text(_index_ddl(tmp_name, index_type, params, concurrently=True)))
+        conn.exec_driver_sql(f"COMMENT ON INDEX {tmp_name} IS '{json.dumps(state)}'")
+
+    # Both renames commit together: INDEX_NAME always exists and always carries its metadata
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER INDEX IF EXISTS {INDEX_NAME} RENAME TO {old_name}"))
+        conn.execute(text(f"ALTER INDEX {tmp_name} RENAME TO {INDEX_NAME}"))
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {old_name}"))
+
+    _index_state.clear()
+    _index_state.update(state)
+    logger.info(f"✅ Vector index ready in {time.time() - start:.1f}s")
+    return state
+
+
+def ensure_vector_index(engine: Engine, index_type: str = VECTOR_INDEX_TYPE) -> Optional[Dict[str, Any]]:
+    """
+    🗂️ تأكد من وجود فهرس صحيح، وأعد بناءه إذا لزم.
+
+    يُعيد بناء الفهرس إذا:
+    - لم يكن موجوداً (وعدد الصفوف كافٍ لـ IVFFlat)
+    - نوعه أو بُعده لا يطابق الإعدادات الحالية
+    - IVFFlat: تجاوز عدد الصفوف (rows وقت البناء × REBUILD_GROWTH_FACTOR)
+    - HNSW: تغيّرت معاملات الشريحة (m / ef_construction) لعدد الصفوف الحالي
+
+    Returns:
+        حالة الفهرس الحالية، أو None إذا لم يُنشأ فهرس
+    """
+    with engine.connect() as conn:
+        column_dim = _embedding_column_dim(conn)
+        if column_dim is None:
+            logger.warning("⚠️ invoice_embeddings.embedding not found. Skipping vector index.")
+            return None
+        if column_dim != EMBEDDING_DIM:
+            logger.error(
+                f"❌ invoice_embeddings.embedding is VECTOR({column_dim}) but the model writes "
+                f"VECTOR({EMBEDDING_DIM}). Migrate the column before indexing."
+            )
+            return None
+
+        rows = _row_count(conn)
+        state = _read_index_state(conn)
+
+    # Legacy IVFFlat index from database_setup.sql never matched the live column
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for legacy in LEGACY_INDEX_NAMES:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {legacy}"))
+
+    if index_type == "ivfflat" and rows < IVFFLAT_MIN_ROWS:
+        logger.info(f"ℹ️ Only {rows} embeddings - exact scan is fine, IVFFlat deferred until {IVFFLAT_MIN_ROWS}")
+        return state
+
+    if index_type == "ivfflat":
+        # IVFFlat centroids are trained on the rows present at build time
+        outgrown = rows >= max(1, state.get("rows", 0)) * REBUILD_GROWTH_FACTOR if state else False
+    else:
+        # HNSW is maintained incrementally → rebuild only when the tier's m / ef_construction change
+        outgrown = bool(state) and choose_index_params(rows, index_type) != state.get("params")
+
+    needs_build = (
+        state is None
+        or state.get("type") != index_type
+        or state.get("dim") != EMBEDDING_DIM
+        or outgrown
+    )
+
+    if needs_build:
+        return build_vector_index(engine, rows, index_type)
+
+    _index_state.clear()
+    _index_state.update(state)
+    logger.info(f"✅ Vector index up to date ({state.get('type')} {state.get('params')}, built at {state.get('rows'):,} rows)")
+    return state
+
+
+def schedule_index_maintenance(engine: Engine, inserted: int = 1):
+    """
+    يُستدعى بعد إضافة embeddings جديدة. كل MAINTENANCE_EVERY_N_INSERTS إضافة
+    نفحص الحاجة لإعادة البناء في thread خلفي (لا يعطّل الطلب الحالي).
+    """
+    global _inserts_since_check
+    _inserts_since_check += inserted
+    if _inserts_since_check < MAINTENANCE_EVERY_N_INSERTS:
+        return
+    _inserts_since_check = 0
+
+    if not _maintenance_lock.acquire(blocking=False):
+        return  # فحص آخر يعمل حالياً
+
+    def _run():
+        try:
+            ensure_vector_index(engine)
+        except Exception as e:
+            logger.error(f"❌ Vector index maintenance failed: {e}")
+        finally:
+            _maintenance_lock.release()
+
+    threading.Thread(target=_run, name="vector-index-maintenance", daemon=True).start()
+
+
+# ================================================================
+# 🧪 CLI: python -m backend.vector_index [--rebuild] [--type hnsw|ivfflat]
+# ================================================================
+if __name__ == "__main__":
+    import argparse
+
+    from backend.database import engine as db_engine
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Manage the invoice_embeddings ANN index")
+    parser.add_argument("--type", choices=["hnsw", "ivfflat"], default=VECTOR_INDEX_TYPE)
+    parser.add_argument("--rebuild", action="store_true", help="force a concurrent rebuild")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        with db_engine.connect() as c:
+            count = _row_count(c)
+        print(build_vector_index(db_engine, count, args.type))
+    else:
+        print(ensure_vector_index(db_engine, args.type))
@@ -0,0 +1,121 @@
+"""
+🔎 Vector Search Utilities
+==========================
+البحث الدلالي داخل قاعدة البيانات باستخدام pgvector.
+
+بدلاً من جلب جميع الـ embeddings وحساب التشابه في Python، يتم الترتيب
+داخل Postgres عبر `ORDER BY embedding <=> :q LIMIT :k` وإرجاع أفضل k فقط.
+"""
+
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from backend.vector_index import apply_search_params, default_search_params
+
+logger = logging.getLogger("backend.vector_search")
+
+# pgvector (default) | memory (in-process NumPy index - see backend/embedding_index.py)
+RAG_ENGINE = os.getenv("RAG_ENGINE", "pgvector").lower()
+
+
+def to_vector_literal(embedding: Sequence[float]) -> str:
+    """
+    Convert an embedding to pgvector's text format: '[0.1,0.2,...]'.
+    The literal is bound as a normal string parameter and cast with CAST(:q AS vector).
+    """
+    return "[" + ",".join(repr(float(x)) for x in embedding) + "]"
+
+
+SIMILAR_INVOICES_SQL = text("""
+    SELECT i.*, 1 - (e.embedding <=> CAST(:query_embedding AS vector)) AS similarity
+    FROM invoice_embeddings e
+    JOIN invoices i ON i.id = e.invoice_id
+    WHERE i.is_valid_invoice = true
+    AND i.image_url IS NOT NULL
+    ORDER BY e.embedding <=> CAST(:query_embedding AS vector)
+    LIMIT :top_k
+""")
+
+
+def search_similar_invoices(
+    db: Session,
+    query_embedding: Sequence[float],
+    top_k: int = 5,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    🔎 Rank invoices by cosine distance inside Postgres and return only the top_k rows.
+
+    Args:
+        db: Database session
+        query_embedding: embedding of the user query
+        top_k: number of rows to return
+        ef_search: HNSW candidate list size for this query (None = derived from the index)
+        probes: IVFFlat lists to probe for this query (None = derived from the index)
+
+    Returns:
+        List of invoice dicts (without the raw embedding), each with a `similarity` key
+    """
+    if ef_search is None and probes is None:
+        defaults = default_search_params(top_k)
+        ef_search = defaults.get("ef_search")
+        probes = defaults.get("probes")
+    apply_search_params(db, ef_search=ef_search, probes=probes)
+
+    rows = db.execute(
+        SIMILAR_INVOICES_SQL,
+        {"query_embedding": to_vector_literal(query_embedding), "top_k": top_k},
+    ).fetchall()
+
+    results = [dict(row._mapping) for row in rows]
+    for item in results:
+        item["similarity"] = float(item["similarity"]) if item.get("similarity") is not None else 0.0
+
+    logger.info(f"📊 pgvector returned {len(results)} nearest invoices (top_k={top_k})")
+    return results
+
+
+def search_similar_invoices_in_memory(
+    db: Session,
+    query_embedding: Sequence[float],
+    top_k: int = 5,
+) -> List[Dict[str, Any]]:
+    """
+    🧮 Same contract as search_similar_invoices, ranked by the in-process NumPy index.
+    Over-fetches candidates because the is_valid_invoice / image_url filters run afterwards.
+    """
+    from backend.embedding_index import get_embedding_index
+
+    candidates = get_embedding_index(db).search(query_embedding, top_k=top_k * 4)
+    if not candidates:
+        return []
+
+    rows = db.execute(
+        text("""
+            SELECT *
+            FROM invoices
+            WHERE id = ANY(:ids)
+            AND is_valid_invoice = true
+            AND image_url IS NOT NULL
+        """),
+        {"ids": [invoice_id for invoice_id, _ in candidates]},
+    ).fetchall()
+    by_id = {row._mapping["id"]: dict(row._mapping) for row in rows}
+
+    results = []
+    for invoice_id, similarity in candidates:
+        invoice = by_id.get(invoice_id)
+        if invoice is None:
+            continue
+        invoice["similarity"] = similarity
+        results.append(invoice)
+        if len(results) == top_k:
+            break
+
+    logger.info(f"📊 In-memory index returned {len(results)} nearest invoices (top_k={top_k})")
+    return results
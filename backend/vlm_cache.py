@@ -0,0 +1,427 @@
+"""
+🗃️ VLM Result Cache
+===================
+كاش لنتائج تحليل الفواتير (VLM) حسب محتوى الصورة وليس رابطها.
+
+المفتاح = SHA-256(bytes الصورة) + SHA-256(البرومبت الفعلي + معرف النموذج)
+فإعادة المحاولة، أو استدعاء /vlm/analyze-only ثم /vlm/analyze، أو رفع نفس الملف مرة أخرى
+يرجع النتيجة المحفوظة خلال أجزاء من الثانية بدون استدلال جديد.
+
+- صور /upload: الـ SHA-256 مأخوذ من مسار التخزين (content_path) → لا تنزيل للصورة عند الـ hit
+- التخزين المحلي: تُقرأ الـ bytes المحفوظة وقت الرفع من القرص مباشرة بدل طلب HTTP لنفس الخادم
+- أي تنزيل من الخادم (fetch_image_bytes) محصور في رابط التخزين (storage.url("")) وما في
+  VLM_IMAGE_FETCH_ALLOWED_PREFIXES، بدون redirects، وبحد أقصى للحجم (منع SSRF واستنزاف الذاكرة)
+
+Backends (VLM_CACHE_BACKEND):
+- memory   → LRU داخل العملية (افتراضي)
+- disk     → ملفات JSON في VLM_CACHE_DIR
+- postgres → جدول vlm_result_cache في نفس قاعدة البيانات
+- none     → تعطيل الكاش
+
+Eviction:
+- VLM_CACHE_TTL_SECONDS   (default 7 days)
+- VLM_CACHE_MAX_ENTRIES   (default 1000)
+
+Image fetch:
+- VLM_CACHE_IMAGE_FETCH_TIMEOUT     (default 15)
+- VLM_IMAGE_FETCH_MAX_BYTES         (default UPLOAD_MAX_BYTES)
+- VLM_IMAGE_FETCH_ALLOWED_PREFIXES  (comma-separated, default empty) أصول إضافية موثوقة غير التخزين
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from backend.storage import get_storage
+from backend.upload_index import content_id
+from backend.upload_stream import UPLOAD_MAX_BYTES
+
+logger = logging.getLogger("backend.vlm_cache")
+
+VLM_CACHE_BACKEND = os.getenv("VLM_CACHE_BACKEND", "memory").lower()
+VLM_CACHE_DIR = os.getenv("VLM_CACHE_DIR", ".cache/vlm")
+VLM_CACHE_TTL_SECONDS = int(os.getenv("VLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+VLM_CACHE_MAX_ENTRIES = int(os.getenv("VLM_CACHE_MAX_ENTRIES", "1000"))
+IMAGE_FETCH_TIMEOUT = float(os.getenv("VLM_CACHE_IMAGE_FETCH_TIMEOUT", "15"))
+IMAGE_FETCH_MAX_BYTES = int(os.getenv("VLM_IMAGE_FETCH_MAX_BYTES", str(UPLOAD_MAX_BYTES)))
+IMAGE_FETCH_ALLOWED_PREFIXES = [
+    p.strip() for p in os.getenv("VLM_IMAGE_FETCH_ALLOWED_PREFIXES", "").split(",") if p.strip()
+]
+
+
+# ================================================================
+# 🔑 Keys
+# ================================================================
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_cache_key(image_sha256: str, prompt: str, model_id: str) -> str:
+    """Content-addressed key: image hash + hash of (effective prompt, model id)"""
+    prompt_hash = hashlib.sha256(f"{model_id}\n{prompt}".encode("utf-8")).hexdigest()
+    return f"{image_sha256}:{prompt_hash}"
+
+
+# ================================================================
+# 🧱 Backends
+# ================================================================
+class CacheBackend:
+    """Minimal interface: get/set/clear/size. `blocking` backends run in the threadpool."""
+
+    blocking = False
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryLRUBackend(CacheBackend):
+    """In-process LRU with TTL (OrderedDict: most recently used at the end)"""
+
+    def __init__(self, max_entries: int = VLM_CACHE_MAX_ENTRIES, ttl: int = VLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def size(self):
+        return len(self._data)
+
+
+class DiskBackend(CacheBackend):
+    """One JSON file per key; TTL and LRU-ish eviction by file mtime"""
+
+    blocking = True
+
+    def __init__(self, directory: str = VLM_CACHE_DIR, max_entries: int = VLM_CACHE_MAX_ENTRIES,
+                 ttl: int = VLM_CACHE_TTL_SECONDS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key.replace(':', '_')}.json"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                return None
+            value = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)  # touch → recently used
+            return value
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Disk cache read failed for {path.name}: {e}")
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(value, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        files = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files[: max(0, len(files) - self.max_entries)]:
+            path.unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self.directory.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+    def size(self):
+        return sum(1 for _ in self.directory.glob("*.json"))
+
+
+class PostgresBackend(CacheBackend):
+    """Shared across workers/instances via the vlm_result_cache table"""
+
+    blocking = True
+
+    def __init__(self, max_entries: int = VLM_CACHE_MAX_ENTRIES, ttl: int = VLM_CACHE_TTL_SECONDS):
+        from backend.database import engine
+
+        self.engine = engine
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS vlm_result_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    result JSONB NOT NULL,
+                    created_at TIMESTAMP DEFAULT NOW(),
+                    last_hit_at TIMESTAMP DEFAULT NOW()
+                )
+            """))
+
+    def get(self, key):
+        with self.engine.begin() as conn:
+            row = conn.execute(
+                text("""
+                    UPDATE vlm_result_cache SET last_hit_at = NOW()
+                    WHERE cache_key = :key AND created_at > NOW() - make_interval(secs => :ttl)
+                    RETURNING result
+                """),
+                {"key": key, "ttl": self.ttl},
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0] if isinstance(row[0], dict) else json.loads(row[0])
+
+    def set(self, key, value):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO vlm_result_cache (cache_key, result)
+                    VALUES (:key, CAST(:result AS JSONB))
+                    ON CONFLICT (cache_key) DO UPDATE
+                    SET result = EXCLUDED.result, created_at = NOW(), last_hit_at = NOW()
+                """),
+                {"key": key, "result": json.dumps(value, ensure_ascii=False)},
+            )
+            conn.execute(
+                text("""
+                    DELETE FROM vlm_result_cache
+                    WHERE created_at < NOW() - make_interval(secs => :ttl)
+                    OR cache_key IN (
+                        SELECT cache_key FROM vlm_result_cache
+                        ORDER BY last_hit_at DESC
+                        OFFSET :max_entries
+                    )
+                """),
+                {"ttl": self.ttl, "max_entries": self.max_entries},
+            )
+
+    def clear(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM vlm_result_cache"))
+
+    def size(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT COUNT(*) FROM vlm_result_cache")).scalar() or 0
+
+
+def _make_backend(name: str) -> Optional[CacheBackend]:
+    if name == "none":
+        return None
+    if name == "disk":
+        return DiskBackend()
+    if name == "postgres":
+        return PostgresBackend()
+    return MemoryLRUBackend()
+
+
+# ================================================================
+# 🗃️ Cache facade (hit/miss counters)
+# ================================================================
+class VLMResultCache:
+    def __init__(self, backend: Optional[CacheBackend]):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def _call(self, fn, *args):
+        if self.backend.blocking:
+            return await run_in_threadpool(fn, *args)
+        return fn(*args)
+
+    async def get(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not self.enabled or key is None:
+            return None
+        try:
+            value = await self._call(self.backend.get, key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ VLM cache get failed: {e}")
+            return None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.info(f"⚡ VLM cache hit: {key[:16]}...")
+        return value
+
+    async def set(self, key: Optional[str], value: Dict[str, Any]):
+        if not self.enabled or key is None:
+            return
+        try:
+            await self._call(self.backend.set, key, value)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ VLM cache set failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        try:
+            size = self.backend.size() if self.enabled else 0
+        except Exception:
+            size = None
+        return {
+            "backend": VLM_CACHE_BACKEND if self.enabled else "none",
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": size,
+            "ttl_seconds": VLM_CACHE_TTL_SECONDS,
+            "max_entries": VLM_CACHE_MAX_ENTRIES,
+        }
+
+
+# ================================================================
+# 🌐 Image fetch (allowlisted, size-capped, pooled)
+# ================================================================
+_http: Optional[httpx.AsyncClient] = None
+
+
+def _image_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None or _http.is_closed:
+        # No redirects: an allowed URL must not be able to bounce the server to another host
+        _http = httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=False,
+                                  limits=httpx.Limits(max_connections=32, max_keepalive_connections=16))
+    return _http
+
+
+async def close_image_client():
+    """Close pooled connections (called on app shutdown)"""
+    global _http
+    if _http is not None and not _http.is_closed:
+        await _http.aclose()
+    _http = None
+
+
+def _within(url: httpx.URL, prefix: str) -> bool:
+    allowed = httpx.URL(prefix)
+    return ((url.scheme, url.host, url.port) == (allowed.scheme, allowed.host, allowed.port)
+            and url.path.startswith(allowed.path) and ".." not in url.path)
+
+
+def is_fetchable_image_url(image_url: str) -> bool:
+    """Only our storage origin (and explicitly configured prefixes) may be fetched server-side."""
+    try:
+        url = httpx.URL(image_url)
+    except Exception:
+        return False
+    if url.scheme not in ("http", "https"):
+        return False
+    return any(_within(url, prefix) for prefix in [get_storage().url(""), *IMAGE_FETCH_ALLOWED_PREFIXES])
+
+
+def storage_image_sha256(image_url: str) -> Optional[str]:
+    """
+    Content hash of one of our uploads, read from its content-addressed storage key (no download).
+    None for URLs that aren't /upload results.
+    """
+    key = get_storage().key_for_url(image_url)
+    return content_id(key) if key else None
+
+
+def _read_stored_image(image_url: str, max_bytes: int):
+    """
+    Local storage: the bytes written at upload time are read straight from disk (no HTTP
+    round-trip to ourselves). Returns (handled, data); handled=False → fall back to HTTP.
+    """
+    storage = get_storage()
+    key = storage.key_for_url(image_url)
+    if key is None or storage.name != "local":
+        return False, None
+    try:
+        path = storage.local_path(key)
+        size = path.stat().st_size
+    except (ValueError, OSError):
+        return False, None
+    if size > max_bytes:
+        logger.warning(f"🚫 Stored image too large to load ({size} > {max_bytes} bytes)")
+        return True, None
+    return True, path.read_bytes()
+
+
+async def fetch_image_bytes(image_url: str, max_bytes: int = IMAGE_FETCH_MAX_BYTES) -> Optional[bytes]:
+    """
+    Load an image from storage (local disk read, or a streamed download of at most max_bytes).
+    None if the URL isn't allowed, the image is too large, or it can't be fetched.
+    """
+    if not is_fetchable_image_url(image_url):
+        logger.warning(f"🚫 Not fetching image outside the storage origin: {image_url[:120]}")
+        return None
+    handled, data = await run_in_threadpool(_read_stored_image, image_url, max_bytes)
+    if handled:
+        return data
+    try:
+        async with _image_client().stream("GET", image_url) as response:
+            if response.status_code != 200:
+                logger.warning(f"⚠️ Could not fetch image: HTTP {response.status_code}")
+                return None
+            declared = response.headers.get("content-length")
+            if declared is not None and declared.isdigit() and int(declared) > max_bytes:
+                logger.warning(f"🚫 Image too large to fetch ({declared} > {max_bytes} bytes)")
+                return None
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) > max_bytes:
+                    logger.warning(f"🚫 Image too large to fetch (> {max_bytes} bytes)")
+                    return None
+            return bytes(body)
+    except httpx.HTTPError as e:
+        logger.warning(f"⚠️ Could not fetch image: {e!r}")
+        return None
+
+
+try:
+    vlm_cache = VLMResultCache(_make_backend(VLM_CACHE_BACKEND))
+except Exception as e:
+    logger.error(f"❌ VLM cache backend '{VLM_CACHE_BACKEND}' unavailable ({e}). Falling back to memory.")
+    vlm_cache = VLMResultCache(MemoryLRUBackend())
@@ -0,0 +1,211 @@
+"""
+🧾 Structured VLM Extraction
+============================
+مخطط JSON (JSON Schema) لحقول الفاتورة يُرسل مع الطلب (response_format) بدلاً من
+الاعتماد على البرومبت فقط، مع max_tokens محسوب من المخطط وعدد الأصناف بدل 16384 ثابتة.
+
+- المخطط يُولَّد من تعريف الحقول أدناه (نفس الأسماء التي يقرأها save_analyzed_output)
+- Items في آخر المخطط: حقول الرأس والإجماليات تُولَّد أولاً
+- max_tokens = تقدير طول المخرجات من maxLength لكل حقل × عدد الأصناف المتوقع
+  وإذا انقطع الرد (finish_reason = "length") يُعاد مرة واحدة بميزانية VLM_MAX_ITEMS
+- مقاييس لكل طلب: نسبة فشل الـ parse، output tokens، الزمن (GET /vlm/extraction/metrics)
+
+Configuration:
+- VLM_STRUCTURED_OUTPUT   (default true) إرسال response_format مع برومبت الفواتير الافتراضي
+- VLM_TEMPERATURE         (default 0.0)  للاستخراج المنظم
+- VLM_EXPECTED_ITEMS      (default 25)   عدد الأصناف الذي تُحسب له الميزانية أولاً
+- VLM_MAX_ITEMS           (default 100)  maxItems في المخطط وميزانية إعادة المحاولة
+- VLM_CHARS_PER_TOKEN     (default 2.0)  تقدير محافظ (النص العربي أقل حروفاً لكل token)
+- VLM_MAX_TOKENS_CAP      (default 16384)
+"""
+
+import math
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+VLM_STRUCTURED_OUTPUT = os.getenv("VLM_STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+VLM_TEMPERATURE = float(os.getenv("VLM_TEMPERATURE", "0.0"))
+VLM_EXPECTED_ITEMS = int(os.getenv("VLM_EXPECTED_ITEMS", "25"))
+VLM_MAX_ITEMS = int(os.getenv("VLM_MAX_ITEMS", "100"))
+VLM_CHARS_PER_TOKEN = float(os.getenv("VLM_CHARS_PER_TOKEN", "2.0"))
+VLM_MAX_TOKENS_CAP = int(os.getenv("VLM_MAX_TOKENS_CAP", "16384"))
+SCHEMA_VERSION = 1
+_NUMBER_TOKENS = 6
+_WINDOW = 500
+
+CATEGORIES = ["Cafe", "Restaurant", "Supermarket", "Pharmacy", "Clothing", "Electronics",
+              "Utility", "Education", "Health", "Transport", "Delivery", "Other"]
+INVOICE_TYPES = ["فاتورة شراء", "فاتورة ضمان", "فاتورة صيانة", "فاتورة ضريبية", "أخرى"]
+
+# Header fields in output order → max characters ("Not Mentioned" must always fit)
+HEADER_FIELDS = {
+    "Vendor": 80,
+    "Date": 16,
+    "Total Amount": 20,
+    "Invoice Number": 40,
+    "Tax Number": 30,
+    "Cashier": 40,
+    "Branch": 80,
+    "Phone": 30,
+    "Subtotal": 20,
+    "Tax": 20,
+    "Grand Total (before tax)": 20,
+    "Discounts": 20,
+    "Payment Method": 40,
+    "Amount Paid": 20,
+    "Ticket Number": 40,
+}
+ITEM_DESCRIPTION_MAX = 120
+AI_INSIGHT_MAX = 400
+
+
+def build_invoice_schema(max_items: int = VLM_MAX_ITEMS) -> Dict[str, Any]:
+    """JSON Schema of one invoice, in the order the fields should be generated."""
+    properties: Dict[str, Any] = {
+        name: {"type": "string", "maxLength": max_len} for name, max_len in HEADER_FIELDS.items()
+    }
+    properties["Category"] = {"type": "string", "enum": CATEGORIES}
+    properties["Invoice_Type"] = {"type": "string", "enum": INVOICE_TYPES}
+    properties["AI_Insight"] = {"type": "string", "maxLength": AI_INSIGHT_MAX}
+    properties["Items"] = {
+        "type": "array",
+        "maxItems": max_items,
+        "items": {
+            "type": "object",
+            "properties": {
+                "description": {"type": "string", "maxLength": ITEM_DESCRIPTION_MAX},
+                "quantity": {"type": "number"},
+                "unit_price": {"type": "number"},
+                "total": {"type": "number"},
+            },
+            "required": ["description", "quantity", "unit_price", "total"],
+            "additionalProperties": False,
+        },
+    }
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+INVOICE_SCHEMA = build_invoice_schema()
+
+
+def response_format() -> Dict[str, Any]:
+    """OpenAI-compatible structured-output block (accepted by Friendli)."""
+    return {"type": "json_schema", "json_schema": {"name": "invoice", "schema": INVOICE_SCHEMA}}
+
+
+def extraction_signature() -> str:
+    """Output-shaping settings - part of the VLM cache key."""
+    if not VLM_STRUCTURED_OUTPUT:
+        return "free"
+    return f"schema:v{SCHEMA_VERSION}:t{VLM_TEMPERATURE}"
+
+
+# ================================================================
+# 📏 max_tokens from the schema
+# ================================================================
+def _key_tokens(name: str) -> int:
+    return math.ceil(len(name) / 4) + 3  # "name": plus separator
+
+
+def estimate_output_tokens(schema: Dict[str, Any], item_count: int) -> int:
+    """Upper-bound token estimate of a JSON document matching `schema` with `item_count` array entries."""
+    kind = schema.get("type")
+    if kind == "object":
+        return 2 + sum(_key_tokens(name) + estimate_output_tokens(sub, item_count)
+                       for name, sub in schema.get("properties", {}).items())
+    if kind == "array":
+        count = min(item_count, schema.get("maxItems", item_count))
+        return 2 + count * (estimate_output_tokens(schema["items"], item_count) + 1)
+    if kind == "string":
+        if "enum" in schema:
+            max_len = max(len(v) for v in schema["enum"])
+        else:
+            max_len = schema.get("maxLength", 100)
+        return math.ceil(max_len / VLM_CHARS_PER_TOKEN) + 2
+    return _NUMBER_TOKENS
+
+
+def size_max_tokens(item_count: int = VLM_EXPECTED_ITEMS) -> int:
+    """max_tokens for the invoice schema: the estimate + 20% headroom, capped."""
+    return min(VLM_MAX_TOKENS_CAP, math.ceil(estimate_output_tokens(INVOICE_SCHEMA, item_count) * 1.2) + 32)
+
+
+# ================================================================
+# 📊 Metrics
+# ================================================================
+class VLMExtractionMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.structured_calls = 0
+        self.truncated = 0
+        self.truncation_retries = 0
+        self.parsed = 0
+        self.parse_failures = 0
+        self.salvaged = 0  # parsed only partially (backend/json_salvage.py)
+        self._latency: deque = deque(maxlen=_WINDOW)
+        self._output_tokens: deque = deque(maxlen=_WINDOW)
+        self._max_tokens: deque = deque(maxlen=_WINDOW)
+
+    def record_call(self, seconds: float, output_tokens: Optional[int], finish_reason: Optional[str],
+                    max_tokens: int, structured: bool):
+        with self._lock:
+            self.calls += 1
+            self.structured_calls += int(structured)
+            self.truncated += int(finish_reason == "length")
+            self._latency.append(seconds)
+            self._max_tokens.append(max_tokens)
+            if output_tokens is not None:
+                self._output_tokens.append(output_tokens)
+
+    def record_truncation_retry(self):
+        with self._lock:
+            self.truncation_retries += 1
+
+    def record_parse(self, ok: bool, salvaged: bool = False):
+        with self._lock:
+            if ok:
+                self.parsed += 1
+                self.salvaged += int(salvaged)
+            else:
+                self.parse_failures += 1
+
+    @staticmethod
+    def _pct(values, q: float):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latency, tokens, budgets = list(self._latency), list(self._output_tokens), list(self._max_tokens)
+            attempts = self.parsed + self.parse_failures
+            return {
+                "structured_output": VLM_STRUCTURED_OUTPUT,
+                "temperature": VLM_TEMPERATURE,
+                "default_max_tokens": size_max_tokens(),
+                "calls": self.calls,
+                "structured_calls": self.structured_calls,
+                "truncated": self.truncated,
+                "truncation_retries": self.truncation_retries,
+                "parsed": self.parsed,
+                "parse_failures": self.parse_failures,
+                "salvaged": self.salvaged,
+                "parse_failure_rate": round(self.parse_failures / attempts, 3) if attempts else 0.0,
+                "latency_p50_s": round(self._pct(latency, 0.50), 2) if latency else None,
+                "latency_p95_s": round(self._pct(latency, 0.95), 2) if latency else None,
+                "output_tokens_p50": self._pct(tokens, 0.50),
+                "output_tokens_p95": self._pct(tokens, 0.95),
+                "max_tokens_avg": round(sum(budgets) / len(budgets)) if budgets else None,
+            }
+
+
+extraction_metrics = VLMExtractionMetrics()
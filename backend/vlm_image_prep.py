@@ -0,0 +1,211 @@
+"""
+🎯 VLM Image Preparation
+========================
+تجهيز صورة الفاتورة قبل إرسالها إلى الـ VLM لتقليل vision tokens وزمن الاستدلال.
+
+Steps:
+1. قص الصورة إلى منطقة الفاتورة (نفس منطق الأركان في correct_perspective: find_document_quad)
+2. تصغير أطول ضلع إلى VLM_IMAGE_MAX_LONG_EDGE
+3. ترميز JPEG مرة واحدة، ثم إرسالها كـ data URL (base64) أو تخزينها ورفع رابطها
+
+إذا كانت الصورة أصلاً ضمن الحد ولم يُكتشف مستطيل للقص، يُرسل الرابط الأصلي كما هو.
+
+Metrics (GET /vlm/prep/metrics):
+- vision tokens قبل/بعد لكل صورة (تقدير بعدد الـ patches)
+- الزمن الموفَّر المقدَّر (tokens × VLM_PREFILL_MS_PER_1K_TOKENS) ناقص زمن التجهيز الفعلي
+
+Configuration:
+- VLM_PREP_ENABLED                (default true)
+- VLM_IMAGE_MAX_LONG_EDGE         (default 1568) أطول ضلع يُرسل للنموذج
+- VLM_IMAGE_CROP                  (default true) القص إلى منطقة الفاتورة
+- VLM_IMAGE_INLINE                (default false) إرسال الصورة كـ base64 data URL بدل رابط تخزين
+- VLM_IMAGE_JPEG_QUALITY          (default 85)
+- VLM_VISION_TOKEN_PATCH          (default 28) ضلع الـ patch بالبكسل (token واحد لكل patch)
+- VLM_PREFILL_MS_PER_1K_TOKENS    (default 60) لتقدير الزمن الموفَّر
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from backend.utils_image_autofix import downscale_for_analysis, find_document_quad, scale_quad
+
+logger = logging.getLogger("backend.vlm_image_prep")
+
+VLM_PREP_ENABLED = os.getenv("VLM_PREP_ENABLED", "true").lower() in ("1", "true", "yes")
+VLM_IMAGE_MAX_LONG_EDGE = int(os.getenv("VLM_IMAGE_MAX_LONG_EDGE", "1568"))
+VLM_IMAGE_CROP = os.getenv("VLM_IMAGE_CROP", "true").lower() in ("1", "true", "yes")
+VLM_IMAGE_INLINE = os.getenv("VLM_IMAGE_INLINE", "false").lower() in ("1", "true", "yes")
+VLM_IMAGE_JPEG_QUALITY = int(os.getenv("VLM_IMAGE_JPEG_QUALITY", "85"))
+VLM_VISION_TOKEN_PATCH = int(os.getenv("VLM_VISION_TOKEN_PATCH", "28"))
+VLM_PREFILL_MS_PER_1K_TOKENS = float(os.getenv("VLM_PREFILL_MS_PER_1K_TOKENS", "60"))
+_CROP_MARGIN = 0.01  # keep a thin border around the detected document
+_WINDOW = 500
+
+
+def prep_signature() -> str:
+    """Settings that change what the model sees - part of the VLM cache key."""
+    if not VLM_PREP_ENABLED:
+        return "prep:off"
+    return f"prep:{VLM_IMAGE_MAX_LONG_EDGE}:{int(VLM_IMAGE_CROP)}:{VLM_IMAGE_JPEG_QUALITY}"
+
+
+def estimate_vision_tokens(width: int, height: int) -> int:
+    """Patch-based estimate: one token per VLM_VISION_TOKEN_PATCH² pixels."""
+    return math.ceil(width / VLM_VISION_TOKEN_PATCH) * math.ceil(height / VLM_VISION_TOKEN_PATCH)
+
+
+@dataclass
+class PreparedImage:
+    """Result of prepare_image_bytes. `data` is None when the original is already within budget."""
+
+    data: Optional[bytes]
+    original_size: Tuple[int, int]
+    prepared_size: Tuple[int, int]
+    cropped: bool
+    tokens_before: int
+    tokens_after: int
+    prep_seconds: float
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    @property
+    def estimated_seconds_saved(self) -> float:
+        return self.tokens_saved / 1000 * VLM_PREFILL_MS_PER_1K_TOKENS / 1000 - self.prep_seconds
+
+
+def crop_to_document(img: np.ndarray) -> Tuple[np.ndarray, bool]:
+    """Axis-aligned crop around the detected invoice quad (a view, no copy). (img, False) if none found."""
+    small = downscale_for_analysis(img)
+    rect = find_document_quad(small)
+    if rect is None:
+        return img, False
+    h, w = img.shape[:2]
+    quad = scale_quad(rect, small.shape, img.shape)
+    x, y, bw, bh = cv2.boundingRect(quad.astype(np.int32))
+    mx, my = int(bw * _CROP_MARGIN), int(bh * _CROP_MARGIN)
+    x0, y0 = max(0, x - mx), max(0, y - my)
+    x1, y1 = min(w, x + bw + mx), min(h, y + bh + my)
+    if (x1 - x0) * (y1 - y0) >= 0.95 * w * h:
+        return img, False  # the document already fills the frame
+    return img[y0:y1, x0:x1], True
+
+
+def prepare_image_bytes(image_bytes: bytes, max_long_edge: int = VLM_IMAGE_MAX_LONG_EDGE,
+                        crop: bool = VLM_IMAGE_CROP, quality: int = VLM_IMAGE_JPEG_QUALITY) -> Optional[PreparedImage]:
+    """
+    Crop + downscale + encode once. Blocking CPU work - runs in the auto-fix process pool.
+
+    Returns:
+        PreparedImage, or None if the image can't be decoded
+    """
+    t0 = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        logger.error("❌ Failed to decode image for VLM preparation")
+        return None
+    h, w = img.shape[:2]
+    tokens_before = estimate_vision_tokens(w, h)
+
+    cropped = False
+    if crop:
+        try:
+            img, cropped = crop_to_document(img)
+        except Exception as e:
+            logger.warning(f"⚠️ Document crop failed: {e}")
+
+    ch, cw = img.shape[:2]
+    scale = max_long_edge / max(ch, cw) if max_long_edge > 0 else 1.0
+    if not cropped and scale >= 1.0:
+        return PreparedImage(None, (w, h), (w, h), False, tokens_before, tokens_before,
+                             time.perf_counter() - t0)
+
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, round(cw * scale)), max(1, round(ch * scale))), interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        logger.error("❌ Failed to encode prepared image")
+        return None
+    ph, pw = img.shape[:2]
+    return PreparedImage(encoded.tobytes(), (w, h), (pw, ph), cropped, tokens_before,
+                         estimate_vision_tokens(pw, ph), time.perf_counter() - t0)
+
+
+# ================================================================
+# 📊 Metrics
+# ================================================================
+class VLMPrepMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.prepared = 0
+        self.unchanged = 0
+        self.skipped = 0  # pool full / fetch or decode failed → original URL sent
+        self.cropped = 0
+        self.inlined = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.seconds_saved = 0.0
+        self._recent: deque = deque(maxlen=_WINDOW)
+
+    def record(self, prepared: PreparedImage, inlined: bool):
+        with self._lock:
+            self.images += 1
+            if prepared.data is None:
+                self.unchanged += 1
+            else:
+                self.prepared += 1
+            self.cropped += int(prepared.cropped)
+            self.inlined += int(inlined)
+            self.tokens_before += prepared.tokens_before
+            self.tokens_after += prepared.tokens_after
+            self.seconds_saved += prepared.estimated_seconds_saved
+            self._recent.append({
+                "original_size": prepared.original_size,
+                "prepared_size": prepared.prepared_size,
+                "cropped": prepared.cropped,
+                "inlined": inlined,
+                "tokens_before": prepared.tokens_before,
+                "tokens_after": prepared.tokens_after,
+                "prep_ms": round(prepared.prep_seconds * 1000, 1),
+                "estimated_ms_saved": round(prepared.estimated_seconds_saved * 1000, 1),
+            })
+
+    def record_skipped(self):
+        with self._lock:
+            self.images += 1
+            self.skipped += 1
+
+    def snapshot(self, recent: int = 20) -> dict:
+        with self._lock:
+            return {
+                "enabled": VLM_PREP_ENABLED,
+                "max_long_edge": VLM_IMAGE_MAX_LONG_EDGE,
+                "crop": VLM_IMAGE_CROP,
+                "inline": VLM_IMAGE_INLINE,
+                "images": self.images,
+                "prepared": self.prepared,
+                "unchanged": self.unchanged,
+                "skipped": self.skipped,
+                "cropped": self.cropped,
+                "inlined": self.inlined,
+                "vision_tokens_before": self.tokens_before,
+                "vision_tokens_after": self.tokens_after,
+                "vision_tokens_saved": self.tokens_before - self.tokens_after,
+                "token_reduction": round(1 - self.tokens_after / self.tokens_before, 3) if self.tokens_before else 0.0,
+                "estimated_seconds_saved": round(self.seconds_saved, 2),
+                "recent": list(self._recent)[-recent:],
+            }
+
+
+vlm_prep_metrics = VLMPrepMetrics()
@@ -53,7 +53,7 @@ CREATE TABLE IF NOT EXISTS items (
 CREATE TABLE IF NOT EXISTS invoice_embeddings (
     id SERIAL PRIMARY KEY,
     invoice_id INTEGER REFERENCES invoices(id) ON DELETE CASCADE,
-    embedding VECTOR(384)
+    embedding VECTOR(1536)  -- OpenAI text-embedding-3-small
 );
 
 -- ----------------------------------------
@@ -76,11 +76,17 @@ ON invoices(invoice_number);
 CREATE INDEX IF NOT EXISTS idx_invoice_category 
 ON invoices(category);
 
--- Vector Index للبحث الدلالي (IVFFlat)
-CREATE INDEX IF NOT EXISTS idx_embedding_cosine 
+-- Vector Index للبحث الدلالي (HNSW)
+-- ملاحظة: الـ Backend يدير هذا الفهرس تلقائياً (backend/vector_index.py)
+-- ويعيد بناءه CONCURRENTLY بمعاملات أكبر عندما يكبر الجدول
+CREATE INDEX IF NOT EXISTS idx_invoice_embeddings_ann 
 ON invoice_embeddings 
-USING ivfflat (embedding vector_cosine_ops)
-WITH (lists = 100);
+USING hnsw (embedding vector_cosine_ops)
+WITH (m = 16, ef_construction = 64);
+
+-- حالة الفهرس التي يقرأها backend/vector_index.py (بدونها يُعاد البناء عند أول تشغيل)
+COMMENT ON INDEX idx_invoice_embeddings_ann IS
+'{"type": "hnsw", "params": {"m": 16, "ef_construction": 64}, "rows": 0, "dim": 1536, "built_at": 0}';
 
 -- ----------------------------------------
 -- 6. إنشاء Views للاستعلامات السريعة
@@ -125,7 +131,7 @@ ORDER BY month DESC;
 
 -- Function للبحث عن فواتير قريبة (Semantic Search)
 CREATE OR REPLACE FUNCTION search_similar_invoices(
-    query_embedding VECTOR(384),
+    query_embedding VECTOR(1536),
     match_count INT DEFAULT 5
 )
 RETURNS TABLE (
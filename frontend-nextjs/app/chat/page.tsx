@@ -22,6 +22,7 @@ interface Invoice {
   tax?: string;
   payment_method?: string;
   image_url?: string;
+  thumbnail_url?: string | null;
   category?: string;
 }
 
@@ -270,7 +271,7 @@ export default function ChatPage() {
                                     {invoice.image_url ? (
                                       <>
                                         <img
-                                          src={invoice.image_url}
+                                          src={invoice.thumbnail_url || invoice.image_url}
                                           alt={`فاتورة ${invoice.vendor}`}
                                           className="w-full h-full object-cover transition-transform duration-300 group-hover:scale-105"
                                           onError={(e) => {
@@ -29,6 +29,7 @@ interface Invoice {
   ai_insight: string;
   invoice_type?: string;
   image_url?: string;
+  thumbnail_url?: string | null;
   created_at: string;
 }
 
@@ -277,7 +278,7 @@ export default function InvoicesPage() {
                   {invoice.image_url ? (
                     <>
                       <img
-                        src={invoice.image_url}
+                        src={invoice.thumbnail_url || invoice.image_url}
                         alt={`فاتورة ${invoice.vendor}`}
                         className="w-full h-full object-cover transition-transform duration-300 group-hover:scale-105"
                         onError={(e) => {
@@ -8,6 +8,7 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from "@/com
 import { Progress } from "@/components/ui/progress";
 import { useToast } from "@/components/ui/use-toast";
 import { API_BASE } from "@/lib/utils";
+import { AnalyzeStreamError, analyzeInvoiceStream } from "@/lib/analyzeStream";
 import InvoiceResultCard from "@/components/InvoiceResultCard";
 import Image from "next/image";
 import { useTheme } from "next-themes";
@@ -142,27 +143,27 @@ export default function UploadPage() {
       setProgress(55);
       setProgressMessage("🤖 جاري قراءة بيانات الفاتورة...");
 
-      const analyzeResponse = await fetch(`${API_BASE}/vlm/analyze-only`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({
+      // Streamed: vendor / total show up while the model is still reading the items
+      const isMentioned = (value: unknown) => value != null && value !== "" && value !== "Not Mentioned";
+      const analyzeData = await analyzeInvoiceStream(
+        {
           image_url: uploadedImageUrl,
-        }),
-      });
-
-      setProgress(75);
-      setProgressMessage("📊 جاري استخراج المعلومات...");
-
-      if (!analyzeResponse.ok) {
-        const errorData = await analyzeResponse.json().catch(() => ({}));
-        const errorMessage = errorData.detail || analyzeResponse.statusText || "فشل تحليل الفاتورة";
-        console.error("Analysis error:", errorMessage);
-        throw new Error(errorMessage);
-      }
-
-      const analyzeData = await analyzeResponse.json();
+          page_urls: uploadData.page_urls,
+        },
+        {
+          onField: (key, value) => {
+            if (key === "Vendor" && isMentioned(value)) {
+              setProgressMessage(`🏪 ${value}`);
+            } else if (key === "Total Amount" && isMentioned(value)) {
+              setProgress(75);
+              setProgressMessage(`💰 الإجمالي: ${value}`);
+            }
+          },
+          onItem: (_item, index) => {
+            setProgressMessage(`📊 جاري استخراج الأصناف (${index + 1})...`);
+          },
+        },
+      );
       setProgress(95);
       setProgressMessage("✨ تقريباً انتهينا...");
       
@@ -304,6 +305,9 @@ export default function UploadPage() {
         description: "راجع البيانات وعدلها إذا لزم الأمر",
       });
     } catch (error: any) {
+      if (error instanceof AnalyzeStreamError && error.rawOutput) {
+        console.error("🧾 Raw model output that could not be parsed:", error.rawOutput);
+      }
       // Show error in a dialog (popup) instead of toast
       setErrorMessage(error.message || "حدث خطأ أثناء معالجة الفاتورة");
       setErrorDialogOpen(true);
@@ -0,0 +1,78 @@
+import { API_BASE } from "@/lib/utils";
+
+/** `error` event of the stream; rawOutput is the model text that could not be parsed (if any). */
+export class AnalyzeStreamError extends Error {
+  rawOutput?: string;
+
+  constructor(message: string, rawOutput?: string) {
+    super(message);
+    this.name = "AnalyzeStreamError";
+    this.rawOutput = rawOutput;
+  }
+}
+
+export interface AnalyzeStreamHandlers {
+  onField?: (key: string, value: unknown, page: number) => void;
+  onItem?: (item: any, index: number, page: number) => void;
+}
+
+/**
+ * POST /vlm/analyze-only/stream and dispatch its SSE events as they arrive.
+ * Resolves with the `done` payload (same shape as /vlm/analyze-only).
+ * Aborting `signal` closes the connection, which also cancels the model request on the server.
+ */
+export async function analyzeInvoiceStream(
+  body: object,
+  handlers: AnalyzeStreamHandlers = {},
+  signal?: AbortSignal,
+): Promise<any> {
+  const response = await fetch(`${API_BASE}/vlm/analyze-only/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+    signal,
+  });
+
+  if (!response.ok || !response.body) {
+    const errorData = await response.json().catch(() => ({}));
+    throw new Error(errorData.detail || response.statusText || "فشل تحليل الفاتورة");
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let separator;
+    while ((separator = buffer.indexOf("\n\n")) !== -1) {
+      const block = buffer.slice(0, separator);
+      buffer = buffer.slice(separator + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      if (!data) continue;
+      const payload = JSON.parse(data);
+
+      if (event === "field") {
+        handlers.onField?.(payload.key, payload.value, payload.page);
+      } else if (event === "item") {
+        handlers.onItem?.(payload.item, payload.index, payload.page);
+      } else if (event === "done") {
+        reader.cancel();
+        return payload;
+      } else if (event === "error") {
+        reader.cancel();
+        throw new AnalyzeStreamError(payload.detail || "فشل تحليل الفاتورة", payload.raw_output ?? undefined);
+      }
+    }
+  }
+  throw new Error("انقطع الاتصال قبل اكتمال التحليل");
+}